@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+
+# bench_import.py
+
+# Measures what it costs a fresh worker process to import
+# parsefeaturejsons, and then to load the wordlists on first use.
+# Each measurement runs in a new interpreter, so nothing is cached in
+# memory; the wordlist snapshot on disk is either deleted first
+# ("cold") or left in place ("warm").
+
+# Usage: python benchmarks/bench_import.py [--repeats N] [--output results.json]
+
+import os, sys, json, time, subprocess, statistics, argparse
+
+benchdir = os.path.dirname(os.path.abspath(__file__))
+librarydir = os.path.dirname(benchdir)
+
+probe = '''
+import sys, time, json
+sys.path.insert(0, {librarydir!r})
+start = time.perf_counter()
+import parsefeaturejsons
+imported = time.perf_counter()
+parsefeaturejsons.normalize_token('London')
+loaded = time.perf_counter()
+print(json.dumps({{'import': imported - start, 'firstuse': loaded - imported,
+    'modules': sorted(x for x in ('numpy', 'pandas', 'scipy') if x in sys.modules)}}))
+'''
+
+def run_probe():
+    result = subprocess.run([sys.executable, '-c', probe.format(librarydir = librarydir)],
+        capture_output = True, text = True, check = True)
+    return json.loads(result.stdout.strip().split('\n')[-1])
+
+def measure(repeats, cold):
+    snapshotpath = os.path.join(librarydir, 'wordlists.snapshot')
+    imports = []
+    firstuses = []
+    for i in range(repeats):
+        if cold and os.path.isfile(snapshotpath):
+            os.remove(snapshotpath)
+        result = run_probe()
+        imports.append(result['import'])
+        firstuses.append(result['firstuse'])
+
+    return {'import_ms': 1000 * statistics.median(imports),
+        'firstuse_ms': 1000 * statistics.median(firstuses),
+        'heavymodules': result['modules']}
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--repeats', type = int, default = 10)
+    parser.add_argument('--output', default = None, help = 'append results as a json line to this file')
+    args = parser.parse_args()
+
+    results = {'benchmark': 'import', 'time': time.time(),
+        'cold': measure(args.repeats, cold = True),
+        'warm': measure(args.repeats, cold = False)}
+
+    for condition in ['cold', 'warm']:
+        r = results[condition]
+        print(condition + ': import ' + str(round(r['import_ms'], 2)) + ' ms, wordlists on first use ' +
+            str(round(r['firstuse_ms'], 2)) + ' ms, heavy modules loaded: ' + str(r['heavymodules']))
+
+    if args.output is not None:
+        with open(args.output, mode = 'a', encoding = 'utf-8') as f:
+            f.write(json.dumps(results) + '\n')
@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+
+# bench_memory.py
+
+# Measures the peak resident memory of a worker that builds a
+# VolumeFromJson, with each setting of pagestorage ('memory' keeps a
+# Counter per page, 'none' keeps only volume totals, 'spill' writes
+# pages to a memory-mapped temporary file), with and without compact.
+# Each measurement runs in a new interpreter, because peak RSS only
+# ever goes up. We also check that every mode produces the same totals.
+
+# Usage: python benchmarks/bench_memory.py volume.json.bz2 [more volumes]
+#     [--streaming] [--output results.json]
+
+import os, sys, json, time, subprocess, argparse
+
+benchdir = os.path.dirname(os.path.abspath(__file__))
+librarydir = os.path.dirname(benchdir)
+
+probe = '''
+import sys, time, json, resource, hashlib
+sys.path.insert(0, {librarydir!r})
+import parsefeaturejsons
+import numpy
+parsefeaturejsons.get_normalizer()
+# numpy is loaded up front by every mode, so it isn't counted as growth
+baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+start = time.perf_counter()
+totaldigest = hashlib.sha1()
+for path in {paths!r}:
+    vol = parsefeaturejsons.VolumeFromJson(path, None, streaming = {streaming!r},
+        compact = {compact!r}, pagestorage = {pagestorage!r})
+    totaldigest.update(json.dumps(sorted(vol.totalcounts.items())).encode('utf-8'))
+elapsed = time.perf_counter() - start
+peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+# Only now, so that it doesn't count toward the peak, we parse again and
+# read the pages back, to check them against the other modes.
+pagedigest = hashlib.sha1()
+for path in {paths!r}:
+    vol = parsefeaturejsons.VolumeFromJson(path, None, streaming = {streaming!r},
+        compact = {compact!r}, pagestorage = {pagestorage!r})
+    if vol.pagecounts is None:
+        pagedigest = None
+        break
+    pagedigest.update(json.dumps([sorted(x.items()) for x in vol.pagecounts]).encode('utf-8'))
+if pagedigest is not None:
+    pagedigest = pagedigest.hexdigest()
+
+print(json.dumps({{'baseline_kb': baseline, 'peak_kb': peak, 'seconds': elapsed,
+    'totaldigest': totaldigest.hexdigest(), 'pagedigest': pagedigest}}))
+'''
+
+def run_probe(paths, streaming, compact, pagestorage):
+    code = probe.format(librarydir = librarydir, paths = paths, streaming = streaming,
+        compact = compact, pagestorage = pagestorage)
+    result = subprocess.run([sys.executable, '-c', code], capture_output = True, text = True, check = True)
+    return json.loads(result.stdout.strip().split('\n')[-1])
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('volumes', nargs = '+', help = 'extracted feature files to parse')
+    parser.add_argument('--streaming', action = 'store_true')
+    parser.add_argument('--output', default = None, help = 'append results as a json line to this file')
+    args = parser.parse_args()
+
+    paths = [os.path.abspath(x) for x in args.volumes]
+    results = {'benchmark': 'memory', 'time': time.time(), 'volumes': paths,
+        'streaming': args.streaming, 'modes': dict()}
+
+    totaldigests = set()
+    pagedigests = set()
+    for compact in [False, True]:
+        for pagestorage in ['memory', 'none', 'spill']:
+            name = pagestorage + ('-compact' if compact else '')
+            r = run_probe(paths, args.streaming, compact, pagestorage)
+            results['modes'][name] = r
+            growth = (r['peak_kb'] - r['baseline_kb']) / 1024
+            print(name.ljust(16) + ' peak ' + str(round(r['peak_kb'] / 1024, 1)).rjust(8) + ' MB, growth ' +
+                str(round(growth, 1)).rjust(8) + ' MB, ' + str(round(r['seconds'], 2)) + ' sec')
+            totaldigests.add(r['totaldigest'])
+            if r['pagedigest'] is not None:
+                pagedigests.add(r['pagedigest'])
+
+    results['consistent'] = len(totaldigests) == 1 and len(pagedigests) <= 1
+    if results['consistent']:
+        print('All modes agree about the counts.')
+    else:
+        print('Warning: the modes disagree about the counts.')
+
+    if args.output is not None:
+        with open(args.output, mode = 'a', encoding = 'utf-8') as f:
+            f.write(json.dumps(results) + '\n')
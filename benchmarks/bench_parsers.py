@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+
+# bench_parsers.py
+
+# Measures how fast VolumeFromJson, PagelistFromJson and
+# LiteralVolumeFromJson (and extract_views, which produces all three
+# from one decode) parse a synthetic corpus made by synthetic_ef.py.
+# For each parser we report volumes/sec, tokens/sec, MB/sec of input
+# files, and peak RSS. Each parser runs in a new interpreter, so peak
+# RSS belongs to that parser alone.
+
+# Results are appended as a json line to --output, so runs can be
+# compared over time. Given --baseline (a file of earlier results) we
+# compare against the most recent result there for the same corpus,
+# and exit with status 1 if any parser has become slower than
+# --threshold times its earlier speed, or needs more than its earlier
+# peak RSS divided by --threshold.
+
+# Usage: python benchmarks/bench_parsers.py [corpus arguments, as for
+#     synthetic_ef.py] [--parsers volume,pagelist,literal,views]
+#     [--repeats N] [--corpusfolder F] [--withimport]
+#     [--output results.json] [--baseline results.json] [--threshold 0.8]
+
+import os, sys, csv, json, time, tempfile, subprocess, statistics, argparse
+
+benchdir = os.path.dirname(os.path.abspath(__file__))
+librarydir = os.path.dirname(benchdir)
+sys.path.insert(0, benchdir)
+
+import synthetic_ef
+
+parsers = {'volume': 'parsefeaturejsons.VolumeFromJson(path, docid)',
+    'volumestreaming': 'parsefeaturejsons.VolumeFromJson(path, docid, streaming = True)',
+    'pagelist': 'parsefeaturejsons.PagelistFromJson(path, docid)',
+    'literal': 'parsefeaturejsons.LiteralVolumeFromJson(path, docid)',
+    'views': 'parsefeaturejsons.extract_views(path, docid)'}
+
+probe = '''
+import sys, time, json, resource
+sys.path.insert(0, {librarydir!r})
+import parsefeaturejsons
+import numpy
+parsefeaturejsons.get_normalizer(romannumerals = False)
+parsefeaturejsons.get_normalizer(romannumerals = True)
+# so that one-time costs aren't charged to the first parser
+baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+times = []
+for repeat in range({repeats!r}):
+    start = time.perf_counter()
+    for docid, path in {volumes!r}:
+        result = {call}
+        result = None
+    times.append(time.perf_counter() - start)
+peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+print(json.dumps({{'times': times, 'baseline_kb': baseline, 'peak_kb': peak}}))
+'''
+
+def read_corpus(metapath):
+    volumes = []
+    tokens = 0
+    inputbytes = 0
+    with open(metapath, encoding = 'utf-8') as f:
+        for row in csv.DictReader(f):
+            volumes.append((row['docid'], row['filepath']))
+            tokens += int(row['tokens'])
+            inputbytes += os.path.getsize(row['filepath'])
+
+    return volumes, tokens, inputbytes
+
+def run_parser(name, volumes, repeats):
+    code = probe.format(librarydir = librarydir, repeats = repeats, volumes = volumes, call = parsers[name])
+    result = subprocess.run([sys.executable, '-c', code], capture_output = True, text = True, check = True)
+    return json.loads(result.stdout.strip().split('\n')[-1])
+
+def measure(names, metapath, repeats):
+    volumes, tokens, inputbytes = read_corpus(metapath)
+
+    measurements = dict()
+    for name in names:
+        r = run_parser(name, volumes, repeats)
+        seconds = statistics.median(r['times'])
+        measurements[name] = {'seconds': seconds,
+            'volumes_per_sec': len(volumes) / seconds,
+            'tokens_per_sec': tokens / seconds,
+            'mb_per_sec': inputbytes / seconds / 1000000,
+            'peak_rss_mb': r['peak_kb'] / 1024,
+            'rss_growth_mb': (r['peak_kb'] - r['baseline_kb']) / 1024}
+
+    return measurements
+
+def find_baseline(path, config):
+    '''Returns the most recent parser results in path for the same corpus.'''
+
+    found = None
+    with open(path, encoding = 'utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if len(line) < 1:
+                continue
+            record = json.loads(line)
+            if record.get('benchmark') == 'parsers' and record.get('corpus') == config:
+                found = record
+
+    return found
+
+def check_thresholds(results, baseline, threshold):
+    '''Returns a list of descriptions of regressions.'''
+
+    problems = []
+    for name, now in results['parsers'].items():
+        if name not in baseline['parsers']:
+            continue
+        before = baseline['parsers'][name]
+        if now['volumes_per_sec'] < threshold * before['volumes_per_sec']:
+            problems.append(name + ': ' + str(round(now['volumes_per_sec'], 2)) + ' volumes/sec, was ' +
+                str(round(before['volumes_per_sec'], 2)))
+        if now['rss_growth_mb'] * threshold > max(before['rss_growth_mb'], 1.0):
+            problems.append(name + ': peak RSS grew by ' + str(round(now['rss_growth_mb'], 1)) + ' MB, was ' +
+                str(round(before['rss_growth_mb'], 1)))
+
+    return problems
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    synthetic_ef.add_corpus_arguments(parser)
+    parser.add_argument('--parsers', default = 'volume,volumestreaming,pagelist,literal,views',
+        help = 'comma-separated; any of ' + ', '.join(parsers.keys()))
+    parser.add_argument('--repeats', type = int, default = 3)
+    parser.add_argument('--corpusfolder', default = None, help = 'keep the synthetic corpus here (default: a temporary folder)')
+    parser.add_argument('--withimport', action = 'store_true', help = 'also run bench_import.py and include its results')
+    parser.add_argument('--output', default = None, help = 'append results as a json line to this file')
+    parser.add_argument('--baseline', default = None, help = 'file of earlier results to compare against')
+    parser.add_argument('--threshold', type = float, default = 0.8)
+    args = parser.parse_args()
+
+    names = args.parsers.split(',')
+    for name in names:
+        if name not in parsers:
+            parser.error('unknown parser ' + name)
+
+    config = synthetic_ef.corpus_config(args)
+
+    if args.corpusfolder is not None:
+        metapath = synthetic_ef.make_corpus_from_config(args.corpusfolder, config)
+        measurements = measure(names, metapath, args.repeats)
+    else:
+        with tempfile.TemporaryDirectory() as folder:
+            metapath = synthetic_ef.make_corpus_from_config(folder, config)
+            measurements = measure(names, metapath, args.repeats)
+
+    results = {'benchmark': 'parsers', 'time': time.time(), 'corpus': config,
+        'repeats': args.repeats, 'python': sys.version.split()[0], 'parsers': measurements}
+
+    for name in names:
+        m = measurements[name]
+        print(name.ljust(16) + str(round(m['volumes_per_sec'], 2)).rjust(8) + ' vols/sec' +
+            str(round(m['tokens_per_sec'] / 1000000, 3)).rjust(8) + ' Mtokens/sec' +
+            str(round(m['mb_per_sec'], 2)).rjust(8) + ' MB/sec' +
+            str(round(m['peak_rss_mb'], 1)).rjust(8) + ' MB peak RSS')
+
+    if args.withimport:
+        import bench_import
+        results['import'] = {'cold': bench_import.measure(args.repeats, cold = True),
+            'warm': bench_import.measure(args.repeats, cold = False)}
+        for condition in ['cold', 'warm']:
+            print('import (' + condition + ') ' + str(round(results['import'][condition]['import_ms'], 2)) + ' ms')
+
+    problems = []
+    if args.baseline is not None and os.path.isfile(args.baseline):
+        baseline = find_baseline(args.baseline, config)
+        if baseline is None:
+            print('No earlier results for this corpus in ' + args.baseline + '.')
+        else:
+            problems = check_thresholds(results, baseline, args.threshold)
+            for problem in problems:
+                print('Regression: ' + problem)
+        results['regressions'] = problems
+
+    if args.output is not None:
+        with open(args.output, mode = 'a', encoding = 'utf-8') as f:
+            f.write(json.dumps(results) + '\n')
+
+    if len(problems) > 0:
+        sys.exit(1)
@@ -0,0 +1,314 @@
+#!/usr/bin/env python3
+
+# bench_tokenizer.py
+
+# Checks that tokenizetexts.TextScanner produces exactly the counts that
+# calling tokenize_line on each line (and adding up the Counters, as
+# FeatureVector used to) produces, and so does a FeatureVector fed a few
+# lines at a time; and measures how many tokens per second tokenize_line
+# and the scanner handle. Also checks that RuleNormalizer, which the
+# scanner uses, agrees with normalize_token on every form the rules
+# mention, in several cases, and on random forms besides; and that a
+# FeatureVector told to keep only some bigrams keeps exactly those, in
+# the same order, and still counts them all.
+
+# The rule files that get_rules() reads aren't distributed with this
+# repository, so by default we make up a small set of rules, and texts
+# that exercise the awkward cases: contractions at the start and end of
+# lines, curly and back quotes, underscores, tabs and other whitespace
+# inside and at the ends of lines, blank lines, digits and names. Given
+# --rules and some text files, we use those instead.
+
+# Usage: python benchmarks/bench_tokenizer.py [--volumes N] [--lines N]
+#     [--seed N] [--repeats N] [--rules folder] [--texts file.txt ...]
+#     [--output results.json]
+
+import os, sys, json, time, random, argparse
+from collections import Counter
+
+benchdir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(benchdir))
+
+import tokenizetexts
+
+def make_rules(rng, vocabularysize = 3000):
+    '''Returns a rule tuple shaped like the one get_rules() returns, and
+    a vocabulary to write texts with.'''
+
+    letters = 'abcdefghijklmnopqrstuvwxyz'
+    words = set()
+    while len(words) < vocabularysize:
+        words.add(''.join(rng.choice(letters) for i in range(rng.randint(1, 9))))
+    words = sorted(words)
+
+    lexicon = set(rng.sample(words, vocabularysize // 2))
+    lexicon.update(['can', 'was', 'i', 'the', 'said', 'o', 'colour', 'color'])
+    lexicon.update(["#arabicnumeral", "#romannumeral", "#dayoftheweek", "#monthoftheyear", "#personalname", "#placename"])
+
+    personalnames = {'john', 'mary', 'smith'}
+    placenames = {'london', 'paris'}
+    romannumerals = {'ii', 'iv', 'xii'}
+    daysoftheweek = {'monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday', 'sunday'}
+    monthsoftheyear = {'january', 'february', 'march', 'april', 'may', 'june', 'july', 'august', 'september', 'october', 'november', 'december'}
+    correctionrules = {'tbe': 'the', 'colonr': 'colour', 'lnndon': 'london', 'mondav': 'monday', 'l8o7': '1807',
+        'jobn': 'John', 'iii': 'ii', 'Tbe': 'the', 'honr': 'honour'}
+    variants = {'colour': 'color', 'honour': 'honor', 'smyth': 'smith', 'parys': 'paris', '4th': 'fourth',
+        'ix': 'nine', 'julye': 'july', 'xab': 'x_y', 'xbc': 'y_z'}
+    # corrections and variants that lead into each other, into the
+    # categories and numbers, out of them, and to keys that aren't
+    # lowercase; and two that make words with underscores, so that
+    # 'x xbc' and 'xab z' are both #bi_x_y_z
+    lexicon.update(['x', 'z', 'x_y', 'y_z'])
+
+    contractionrules = {('can', 't'): "can't", ('was', 'n'): "wasn", ("wasn", 't'): "wasn't",
+        ('i', 'll'): "i'll", ('o', ''): "o'", ("can't", 've'): "can't've", ('the', 's'): "the's"}
+    for word in rng.sample(words, 50):
+        contractionrules[(word, 's')] = word + "'s"
+
+    top5kbigrams = set()
+    bigramlex = set(rng.sample(sorted(lexicon), 200))
+
+    vocabulary = words + ['Can', 'can', 'was', 'I', 'The', 'the', 'said', 'O', 'o', 'John', 'MARY', 'London',
+        'Lnndon', 'Monday', 'May', 'IV', 'xii', 'Colour', 'colonr', 'tbe', 'honour', '1867', '3rd', '42',
+        'é', 'naïve', 'Ærø', '２', '½', 'x', 'z', 'xab', 'xbc']
+
+    rules = (lexicon, personalnames, placenames, daysoftheweek, monthsoftheyear, correctionrules, variants,
+        romannumerals, contractionrules, top5kbigrams, bigramlex)
+    return rules, vocabulary
+
+separators = [' '] * 30 + [', ', '. ', '; ', ' — ', '-', ' "', '" ', '“', '”', "'", "' ", " '", '`', '‘', '’',
+    '_', ' _ ', '\t', ' \t ', '\xa0', '!', '?', '(', ')', "''", " ' ", 'é', ' ']
+
+edges = ['', '', '', '', ' ', '  ', '\t', ' \t', '_', '\xa0', "'", "'t ", "'s", ' ']
+
+def make_text(rng, vocabulary, numlines):
+    '''Returns a list of lines, each ending in a newline, as from readlines().'''
+
+    lines = []
+    for i in range(numlines):
+        if rng.random() < 0.05:
+            lines.append(rng.choice(['\n', ' \n', '\t\n', "'\n", '_\n', '...\n']))
+            continue
+
+        parts = [rng.choice(edges)]
+        for j in range(rng.randint(1, 14)):
+            roll = rng.random()
+            if roll < 0.12:
+                parts.append(rng.choice(['can', 'Can', 'was', 'I', 'o', 'O', 'the']) + rng.choice(["'", '’', '‘', '`']) +
+                    rng.choice(['t', 'T', 'll', 'n', 's', 've', '', ' ']))
+            else:
+                parts.append(rng.choice(vocabulary))
+            parts.append(rng.choice(separators))
+        parts.append(rng.choice(edges))
+        lines.append(''.join(parts) + '\n')
+
+    return lines
+
+def check_normalizer(rules, rng, vocabulary, numforms = 20000):
+    '''Returns the forms on which RuleNormalizer and normalize_token
+    disagree. We try every key and member of the rules as it is,
+    lowercased, capitalized and uppercased, and then random forms.'''
+
+    personalnames, placenames, daysoftheweek, monthsoftheyear, correctionrules, variants, romannumerals = rules[1: 8]
+    normalizer = tokenizetexts.RuleNormalizer(*rules[1: 8], cachesize = 1000)
+
+    forms = set(['', '0', '7a', 'a7', '1st', '½', '２', 'İstanbul', 'ǅ'])
+    for table in rules[1: 8]:
+        for x in table:
+            forms.update([x, x.lower(), x.capitalize(), x.upper()])
+        for x in table.values() if isinstance(table, dict) else []:
+            forms.update([x, x.capitalize(), x.upper()])
+
+    for i in range(numforms):
+        roll = rng.random()
+        if roll < 0.5:
+            forms.add(rng.choice(vocabulary))
+        elif roll < 0.8:
+            forms.add(rng.choice(vocabulary) + str(rng.randint(0, 99)))
+        else:
+            forms.add(str(rng.randint(0, 99)) + rng.choice(vocabulary) + rng.choice(['', '1', 'x']))
+
+    disagreements = []
+    for form in sorted(forms):
+        # each form twice, so the second lookup comes from the cache
+        for repeat in range(2):
+            if normalizer.normalize(form) != tokenizetexts.normalize_token(form, *rules[1: 8]):
+                disagreements.append(form)
+                break
+
+    return disagreements, len(forms)
+
+def reference_counts(lines, rules):
+    '''Counts the lines with tokenize_line, as FeatureVector used to.'''
+
+    lexicon, personalnames, placenames, daysoftheweek, monthsoftheyear, correctionrules, variants, romannumerals, contractionrules = rules[0: 9]
+
+    wordcounts = Counter()
+    punctcounts = Counter()
+    capitalized = 0
+    allwords = 0
+    allpunct = 0
+    lengths = []
+    bigrams = Counter()
+    previous_word = ''
+
+    for l in lines:
+        linewords, linepunct, linecaps, linenumwords, linenumpunct, linelens, previous_word, linebigrams = tokenizetexts.tokenize_line(l, previous_word, lexicon, personalnames, placenames, daysoftheweek, monthsoftheyear, correctionrules, variants, romannumerals, contractionrules)
+        wordcounts = wordcounts + linewords
+        punctcounts = punctcounts + linepunct
+        capitalized += linecaps
+        allwords += linenumwords
+        allpunct += linenumpunct
+        lengths.extend(linelens)
+        bigrams = bigrams + linebigrams
+
+    return wordcounts, punctcounts, capitalized, allwords, allpunct, lengths, previous_word, bigrams
+
+def line_counts(lines, rules):
+    '''Like reference_counts, but adding up in place, so that timing it
+    measures tokenize_line rather than the addition of Counters.'''
+
+    lexicon, personalnames, placenames, daysoftheweek, monthsoftheyear, correctionrules, variants, romannumerals, contractionrules = rules[0: 9]
+
+    wordcounts = Counter()
+    previous_word = ''
+    for l in lines:
+        linewords, linepunct, linecaps, linenumwords, linenumpunct, linelens, previous_word, linebigrams = tokenizetexts.tokenize_line(l, previous_word, lexicon, personalnames, placenames, daysoftheweek, monthsoftheyear, correctionrules, variants, romannumerals, contractionrules)
+        wordcounts.update(linewords)
+
+    return wordcounts
+
+def scanner_counts(lines, rules):
+    scanner = tokenizetexts.TextScanner(*rules[0: 9])
+    return scanner.scan_lines(lines)
+
+def vector_counts(lines, rules):
+    '''Feeds the lines to a FeatureVector a few at a time, as update()
+    allows, to check that it doesn't matter where the pieces break.'''
+
+    vector = tokenizetexts.FeatureVector(None, *rules[0: 9])
+    for start in range(0, len(lines), 97):
+        vector.update(iter(lines[start: start + 97]))
+
+    return (vector.wordcounts, vector.punctcounts, vector.capitalized, vector.totalnumwords,
+        vector.totalnumpunct, vector.allwordlengths, vector.previous_word, vector.allbigrams)
+
+def filtered_vector(lines, rules, topbigrams):
+    vector = tokenizetexts.FeatureVector(None, *rules[0: 9], topbigrams = topbigrams)
+    for start in range(0, len(lines), 97):
+        vector.update(iter(lines[start: start + 97]))
+    return vector
+
+def check_filtered(expected, lines, rules, rng):
+    '''Keeps a random half of the bigrams in expected (and some that
+    don't occur), and returns a list of what a FeatureVector that only
+    keeps those gets wrong.'''
+
+    bigrams = expected[7]
+    topbigrams = set(rng.sample(sorted(bigrams), len(bigrams) // 2))
+    topbigrams.update(['#bi_nothing_here', '#bi_x_y_z', '#bi_x', 'bigram'])
+
+    vector = filtered_vector(lines, rules, topbigrams)
+    kept = [(x, y) for x, y in bigrams.items() if x in topbigrams]
+
+    different = []
+    if list(vector.allbigrams.items()) != kept:
+        different.append('kept bigrams')
+    if vector.totalbigrams != sum(bigrams.values()):
+        different.append('total bigrams')
+
+    return different
+
+fieldnames = ['wordcounts', 'punctcounts', 'capitalized', 'allwords', 'allpunct', 'lengths', 'previous_word', 'bigrams']
+
+def compare(expected, actual):
+    '''Returns the names of the fields that differ. Counters have to
+    list their keys in the same order too, since that's the order in
+    which features are written.'''
+
+    different = []
+    for name, x, y in zip(fieldnames, expected, actual):
+        if x != y or (isinstance(x, Counter) and list(x.items()) != list(y.items())):
+            different.append(name)
+
+    return different
+
+def time_counts(function, volumes, rules, repeats):
+    times = []
+    for repeat in range(repeats):
+        start = time.perf_counter()
+        for lines in volumes:
+            function(lines, rules)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--volumes', type = int, default = 10, help = 'synthetic volumes to check')
+    parser.add_argument('--lines', type = int, default = 500, help = 'lines per synthetic volume')
+    parser.add_argument('--seed', type = int, default = 0)
+    parser.add_argument('--repeats', type = int, default = 3)
+    parser.add_argument('--rules', default = None, help = 'folder of rule files for get_rules()')
+    parser.add_argument('--texts', nargs = '*', default = [], help = 'text files to use instead of synthetic volumes')
+    parser.add_argument('--output', default = None, help = 'append results as a json line to this file')
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    rules, vocabulary = make_rules(rng)
+    if args.rules is not None:
+        rules = tokenizetexts.get_rules(args.rules)
+
+    if len(args.texts) > 0:
+        volumes = []
+        for path in args.texts:
+            with open(path, encoding = 'utf-8') as f:
+                volumes.append(f.readlines())
+    else:
+        volumes = [make_text(rng, vocabulary, args.lines) for i in range(args.volumes)]
+
+    disagreements, numforms = check_normalizer(rules, rng, vocabulary)
+    if len(disagreements) > 0:
+        print('RuleNormalizer disagrees with normalize_token on ' + str(len(disagreements)) + ' of ' + str(numforms) +
+            ' forms, e.g. ' + ', '.join([repr(x) for x in disagreements[0: 5]]))
+    else:
+        print('RuleNormalizer agrees with normalize_token on all ' + str(numforms) + ' forms.')
+
+    mismatches = 0
+    numtokens = 0
+    for i, lines in enumerate(volumes):
+        expected = reference_counts(lines, rules)
+        different = compare(expected, scanner_counts(lines, rules))
+        different += ['FeatureVector ' + x for x in compare(expected, vector_counts(lines, rules))]
+        different += ['filtered FeatureVector ' + x for x in check_filtered(expected, lines, rules, rng)]
+        numtokens += expected[3] + expected[4]
+        if len(different) > 0:
+            mismatches += 1
+            print('Volume ' + str(i) + ' differs in ' + ', '.join(different))
+
+    results = {'benchmark': 'tokenizer', 'time': time.time(), 'volumes': len(volumes), 'tokens': numtokens,
+        'mismatches': mismatches, 'normalizerdisagreements': len(disagreements), 'seed': args.seed}
+
+    topbigrams = set()
+    for lines in volumes:
+        bigrams = scanner_counts(lines, rules)[7]
+        topbigrams.update([x for x, y in bigrams.most_common(len(bigrams) // 20)])
+    # as if the most common twentieth of each volume's bigrams were the top ones
+
+    timings = [('tokenize_line', line_counts), ('scanner', scanner_counts), ('vector', vector_counts),
+        ('filtered vector', lambda lines, rules: filtered_vector(lines, rules, topbigrams))]
+    for name, function in timings:
+        seconds = time_counts(function, volumes, rules, args.repeats)
+        results[name] = {'seconds': seconds, 'tokens_per_sec': numtokens / seconds}
+        print(name.ljust(16) + str(round(numtokens / seconds / 1000000, 3)).rjust(8) + ' Mtokens/sec')
+
+    print('Speedup: ' + str(round(results['tokenize_line']['seconds'] / results['scanner']['seconds'], 2)) + 'x')
+    if mismatches == 0:
+        print('The scanner agrees with tokenize_line on all ' + str(len(volumes)) + ' volumes.')
+
+    if args.output is not None:
+        with open(args.output, mode = 'a', encoding = 'utf-8') as f:
+            f.write(json.dumps(results) + '\n')
+
+    if mismatches > 0 or len(disagreements) > 0:
+        sys.exit(1)
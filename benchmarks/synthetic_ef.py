@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+
+# synthetic_ef.py
+
+# Generates synthetic HTRC extracted-feature files, so that parsers can
+# be benchmarked reproducibly without shipping real volumes around. The
+# files have the same structure as real ones: pages with header, body
+# and footer sections, each with a tokenPosCount that maps tokens to
+# counts for one or more parts of speech.
+
+# Word frequencies follow a Zipf distribution over a made-up vocabulary.
+# Some of the vocabulary is capitalized, or is a name, place, month,
+# number or roman numeral, so the normalizers' different paths all get
+# exercised. A few pages have seqs that aren't integers, as in real data.
+
+# Usage: python benchmarks/synthetic_ef.py outfolder [--volumes N]
+#     [--pages N] [--vocabulary N] [--zipf S] [--posfanout N]
+#     [--codec bz2|plain] [--seed N]
+# Writes the volumes and a metadata file, metadata.csv, with columns
+# docid, filepath and tokens (the total count of tokens in the volume).
+
+import os, csv, json, bz2, random, bisect, itertools, argparse
+
+partsofspeech = ['NN', 'NNP', 'VB', 'VBD', 'JJ', 'DT', 'IN', 'RB', 'PRP', 'CC']
+
+specialwords = ['I', 'the', 'The', 'said', 'she', 'he', 'his', 'her', 'you', 'my',
+    'John', 'Mary', 'Smith', 'London', 'Paris', 'Boston', 'Monday', 'May', 'December',
+    '1867', '12', 'iv', 'IV', 'xii', 'ii', 'colour', 'color', 'honor', 'THE', 'é', '—']
+
+def make_vocabulary(size, rng):
+    '''Returns a list of words, most frequent first.'''
+
+    words = list(specialwords)
+    letters = 'abcdefghijklmnopqrstuvwxyz'
+    while len(words) < size:
+        length = rng.randint(2, 10)
+        word = ''.join(rng.choice(letters) for i in range(length))
+        roll = rng.random()
+        if roll < 0.1:
+            word = word.title()
+        elif roll < 0.12:
+            word = word.upper()
+        words.append(word)
+
+    return words[0: size]
+
+class SyntheticVolumeMaker:
+
+    def __init__(self, vocabularysize = 50000, zipf = 1.1, posfanout = 3, seed = 0):
+        '''zipf is the exponent of the distribution of word frequencies;
+        posfanout is the largest number of parts of speech a word can be
+        split across on one page.'''
+
+        self.rng = random.Random(seed)
+        self.vocabulary = make_vocabulary(vocabularysize, self.rng)
+        weights = [1 / (rank ** zipf) for rank in range(1, vocabularysize + 1)]
+        self.cumulative = list(itertools.accumulate(weights))
+        self.posfanout = posfanout
+
+    def sample_words(self, n):
+        total = self.cumulative[-1]
+        rng = self.rng
+        return [self.vocabulary[bisect.bisect_left(self.cumulative, rng.random() * total)] for i in range(n)]
+
+    def make_section(self, numtokens, lines):
+        '''Returns a section (header, body or footer) containing numtokens tokens.'''
+
+        counts = dict()
+        for word in self.sample_words(numtokens):
+            counts[word] = counts.get(word, 0) + 1
+
+        tokenposcount = dict()
+        for word, count in counts.items():
+            numparts = min(count, self.rng.randint(1, self.posfanout))
+            parts = self.rng.sample(partsofspeech, numparts)
+            split = sorted(self.rng.sample(range(1, count), numparts - 1)) if numparts > 1 else []
+            bounds = [0] + split + [count]
+            tokenposcount[word] = {part: bounds[i + 1] - bounds[i] for i, part in enumerate(parts)}
+
+        return {'tokenCount': numtokens, 'lineCount': lines, 'emptyLineCount': 0,
+            'capAlphaSeq': 0, 'sentenceCount': max(1, numtokens // 18) if numtokens > 0 else 0,
+            'tokenPosCount': tokenposcount,
+            'beginCharCount': {}, 'endCharCount': {}}
+
+    def make_volume(self, volumeid, numpages, tokensperpage = 300):
+        '''Returns (volume as a dictionary, total tokens in it).'''
+
+        pages = []
+        totaltokens = 0
+        for i in range(numpages):
+            seq = str(i + 1).zfill(8)
+            if self.rng.random() < 0.01:
+                seq = 'notes'
+            bodytokens = max(0, int(self.rng.gauss(tokensperpage, tokensperpage / 4)))
+            headertokens = self.rng.randint(0, 5)
+            footertokens = self.rng.randint(0, 3)
+            lines = max(1, bodytokens // 10)
+            page = {'seq': seq, 'version': 'synthetic', 'languages': [{'en': '1.00'}],
+                'tokenCount': bodytokens + headertokens + footertokens,
+                'lineCount': lines + 2, 'emptyLineCount': 0, 'sentenceCount': max(1, bodytokens // 18),
+                'header': self.make_section(headertokens, 1),
+                'body': self.make_section(bodytokens, lines),
+                'footer': self.make_section(footertokens, 1)}
+            pages.append(page)
+            totaltokens += bodytokens + headertokens + footertokens
+
+        volume = {'id': volumeid,
+            'metadata': {'title': 'Synthetic volume ' + volumeid, 'pubDate': '1867', 'language': 'eng'},
+            'features': {'schemaVersion': '3.0', 'dateCreated': '2016-01-01T00:00', 'pageCount': numpages,
+                'pages': pages}}
+
+        return volume, totaltokens
+
+def write_volume(volume, path, codec):
+    data = json.dumps(volume, ensure_ascii = False).encode('utf-8')
+    if codec == 'bz2':
+        data = bz2.compress(data)
+    with open(path, mode = 'wb') as f:
+        f.write(data)
+
+def make_corpus(outfolder, numvolumes = 5, numpages = 300, tokensperpage = 300, vocabularysize = 50000, zipf = 1.1,
+        posfanout = 3, codec = 'bz2', seed = 0):
+    '''Writes a synthetic corpus, and returns the path to its metadata
+    file. Folders generated with the same arguments are identical.'''
+
+    if not os.path.isdir(outfolder):
+        os.makedirs(outfolder)
+
+    maker = SyntheticVolumeMaker(vocabularysize, zipf, posfanout, seed)
+    if codec == 'bz2':
+        extension = '.json.bz2'
+    else:
+        extension = '.json'
+
+    rows = []
+    for i in range(numvolumes):
+        volumeid = 'syn.' + str(i).zfill(5)
+        volume, totaltokens = maker.make_volume(volumeid, numpages, tokensperpage)
+        path = os.path.join(outfolder, volumeid + extension)
+        write_volume(volume, path, codec)
+        rows.append([volumeid, os.path.abspath(path), totaltokens])
+
+    metapath = os.path.join(outfolder, 'metadata.csv')
+    with open(metapath, mode = 'w', encoding = 'utf-8') as f:
+        writer = csv.writer(f)
+        writer.writerow(['docid', 'filepath', 'tokens'])
+        writer.writerows(rows)
+
+    return metapath
+
+def add_corpus_arguments(parser):
+    '''The arguments that describe a synthetic corpus, which
+    bench_parsers.py accepts too.'''
+
+    parser.add_argument('--volumes', type = int, default = 5)
+    parser.add_argument('--pages', type = int, default = 300, help = 'pages per volume')
+    parser.add_argument('--tokensperpage', type = int, default = 300)
+    parser.add_argument('--vocabulary', type = int, default = 50000, help = 'number of distinct words')
+    parser.add_argument('--zipf', type = float, default = 1.1, help = 'exponent of the word frequency distribution')
+    parser.add_argument('--posfanout', type = int, default = 3, help = 'most parts of speech per word per page')
+    parser.add_argument('--codec', choices = ['bz2', 'plain'], default = 'bz2')
+    parser.add_argument('--seed', type = int, default = 0)
+
+def corpus_config(args):
+    return {'volumes': args.volumes, 'pages': args.pages, 'tokensperpage': args.tokensperpage,
+        'vocabulary': args.vocabulary, 'zipf': args.zipf, 'posfanout': args.posfanout,
+        'codec': args.codec, 'seed': args.seed}
+
+def make_corpus_from_config(outfolder, config):
+    return make_corpus(outfolder, numvolumes = config['volumes'], numpages = config['pages'],
+        tokensperpage = config['tokensperpage'], vocabularysize = config['vocabulary'],
+        zipf = config['zipf'], posfanout = config['posfanout'], codec = config['codec'], seed = config['seed'])
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description = 'Generate synthetic extracted feature files.')
+    parser.add_argument('outfolder')
+    add_corpus_arguments(parser)
+    args = parser.parse_args()
+
+    metapath = make_corpus_from_config(args.outfolder, corpus_config(args))
+    print('Wrote ' + str(args.volumes) + ' volumes; metadata in ' + metapath)
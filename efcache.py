@@ -0,0 +1,464 @@
+#!/usr/bin/env python3
+
+# efcache.py
+
+# Whenever we change a model downstream, we tend to re-run VolumeFromJson
+# or PagelistFromJson over exactly the same .json.bz2 files, paying for
+# decompression and parsing every time. A ResultCache keeps the parsed
+# counts and statistics on disk instead, as .npy arrays that can be
+# memory-mapped, so a warm re-run skips the json entirely.
+
+# Each entry is keyed by the volume's path, size and modification time,
+# plus a hash of the configuration that affects parsing: the kind of
+# object, the normalizer's table (i.e. the wordlists) and pagestoinclude.
+# If any of those change, the key changes and the old entry is simply
+# never read again; it ages out of the cache, or prune() removes it.
+
+# Layout of a cache folder:
+#   ab/abcdef.../          one entry, named by its key
+#       meta.json          source file, scalar statistics
+#       tokens.json        the entry's own list of words; position is the id
+#       indptr.npy         int64, pages + 1
+#       ids.npy            int32 word ids, page by page
+#       values.npy         int64 counts
+#       totals.npy         int64 volume counts, one per word (volumes only)
+#       pagestats.npy      int64 pages x pagestatfields (pagelists only)
+#       features.npy       float64 pages x structuralfeatures (pagelists only)
+
+# The cache is bounded in size. Reading an entry touches its meta.json,
+# so when the cache grows past maxbytes, the entries least recently used
+# are evicted first, until it's back down to evictto of maxbytes (so that
+# a full cache isn't scanned again on every write).
+
+# Several worker processes usually write to one cache. If each kept its
+# own running total, each would only count its own writes, and the cache
+# could grow to several times maxbytes before any of them evicted. So
+# the parent adds up the cache once, in a shared counter (see
+# shared_counter()) that it passes to every worker's ResultCache; workers
+# add their writes to it, and whoever takes it past maxbytes evicts.
+
+# Restoring a volume reads its totals into a Counter, since that's what
+# gets written; its pages stay in the memory-mapped arrays, and
+# VolumeFromJson.pagecounts only builds Counters from them if asked.
+# Pagelists are different: PagelistFromJson keeps a dictionary per page,
+# so restore_pagelist() does rebuild every page.
+
+import os, json, hashlib, shutil
+from collections import Counter
+
+import numpy as np
+
+cacheversion = 1
+
+evictto = 0.9
+# the fraction of maxbytes that eviction brings the cache down to
+
+volumefields = ['volumeid', 'numpages', 'totaltokens', 'bodytokens', 'sentencecount',
+    'linecount', 'typetokenratios', 'typetoken', 'sentencelength', 'linelength',
+    'integerless_pages', 'out_of_order_pages', 'skipped_pages', 'compromise_pg']
+
+pagestatfields = ['bodytokens', 'headertokens', 'titlecase', 'uppercase', 'lines', 'sentences']
+
+def config_hash(kind, normalizer, pagestoinclude = None):
+    '''Hashes everything besides the file itself that determines what
+    parsing a volume produces.'''
+
+    parts = [str(cacheversion), kind, normalizer.signature()]
+    if pagestoinclude:
+        parts.append(json.dumps(sorted(pagestoinclude)))
+    else:
+        parts.append('allpages')
+
+    return hashlib.sha1('\n'.join(parts).encode('utf-8')).hexdigest()
+
+def directory_size(path):
+    total = 0
+    for name in os.listdir(path):
+        try:
+            total += os.path.getsize(os.path.join(path, name))
+        except OSError:
+            pass
+    return total
+
+def counters_to_arrays(counters, tokens, tokenids):
+    '''Flattens a list of Counters (one per page) into the three arrays
+    of a CSR matrix, using ids from tokenids. New words are appended to
+    tokens. Each page keeps its words in their original order.'''
+
+    indptr = np.zeros(len(counters) + 1, dtype = np.int64)
+    ids = []
+    values = []
+
+    for i, counts in enumerate(counters):
+        for key, value in counts.items():
+            if key not in tokenids:
+                tokenids[key] = len(tokens)
+                tokens.append(key)
+            ids.append(tokenids[key])
+            values.append(value)
+        indptr[i + 1] = len(ids)
+
+    return indptr, np.array(ids, dtype = np.int32), np.array(values, dtype = np.int64)
+
+def arrays_to_counters(indptr, ids, values, tokens):
+    counters = []
+    ids = ids.tolist()
+    values = values.tolist()
+    for start, end in zip(indptr[ : -1].tolist(), indptr[1: ].tolist()):
+        counters.append(Counter(dict(zip([tokens[i] for i in ids[start: end]], values[start: end]))))
+
+    return counters
+
+class ResultCache:
+
+    def __init__(self, folder, maxbytes = 4 * 1024 ** 3, sharedbytes = None):
+        '''maxbytes bounds the total size of the entries in folder.
+        sharedbytes is a counter from shared_counter(), if other
+        processes are writing to the same folder.'''
+
+        self.folder = folder
+        self.maxbytes = maxbytes
+        self.hits = 0
+        self.misses = 0
+        self.currentbytes = None
+        # we only add up the size of the whole cache when we first need it
+        self.sharedbytes = sharedbytes
+
+        if not os.path.isdir(folder):
+            os.makedirs(folder, exist_ok = True)
+
+    def entry_key(self, volumepath, confighash):
+        '''Returns the key for a volume file, or None if the file doesn't exist.'''
+
+        if not isinstance(volumepath, str):
+            return None
+            # a file object, e.g. a member of a tar shard (see efsources),
+            # which has no path or mtime we could check later
+
+        try:
+            stat = os.stat(volumepath)
+        except OSError:
+            return None
+
+        description = '\n'.join([os.path.abspath(volumepath), str(stat.st_size), str(stat.st_mtime_ns), confighash])
+        return hashlib.sha1(description.encode('utf-8')).hexdigest()
+
+    def entry_path(self, key):
+        return os.path.join(self.folder, key[0: 2], key)
+
+    def read_entry(self, key, arraynames):
+        '''Returns (meta, tokens, arrays) for an entry, with arrays
+        memory-mapped, or None if the entry isn't there (or is damaged).'''
+
+        if key is None:
+            self.misses += 1
+            return None
+
+        path = self.entry_path(key)
+        metapath = os.path.join(path, 'meta.json')
+
+        try:
+            with open(metapath, encoding = 'utf-8') as f:
+                meta = json.load(f)
+            with open(os.path.join(path, 'tokens.json'), encoding = 'utf-8') as f:
+                tokens = json.load(f)
+            arrays = dict()
+            for name in arraynames:
+                arrays[name] = np.load(os.path.join(path, name + '.npy'), mmap_mode = 'r')
+        except (OSError, ValueError):
+            self.misses += 1
+            return None
+
+        try:
+            os.utime(metapath)
+            # this is what makes eviction least-recently-used
+        except OSError:
+            pass
+
+        self.hits += 1
+        return meta, tokens, arrays
+
+    def write_entry(self, key, meta, tokens, arrays):
+        '''Writes an entry under a temporary name and renames it into
+        place when complete. Failing to write is not an error; the
+        volume will just be parsed again next time.'''
+
+        if key is None:
+            return False
+
+        path = self.entry_path(key)
+        temppath = path + '.' + str(os.getpid()) + '.tmp'
+
+        try:
+            os.makedirs(temppath, exist_ok = True)
+            for name, array in arrays.items():
+                np.save(os.path.join(temppath, name + '.npy'), array)
+            with open(os.path.join(temppath, 'tokens.json'), mode = 'w', encoding = 'utf-8') as f:
+                json.dump(tokens, f, ensure_ascii = False)
+            with open(os.path.join(temppath, 'meta.json'), mode = 'w', encoding = 'utf-8') as f:
+                json.dump(meta, f, ensure_ascii = False)
+            entrybytes = directory_size(temppath)
+            if os.path.isdir(path):
+                shutil.rmtree(path, ignore_errors = True)
+            os.replace(temppath, path)
+        except OSError:
+            shutil.rmtree(temppath, ignore_errors = True)
+            return False
+
+        if self.sharedbytes is not None:
+            with self.sharedbytes.get_lock():
+                self.sharedbytes.value += entrybytes
+                if self.sharedbytes.value > self.maxbytes:
+                    self.evict(int(self.maxbytes * evictto))
+            # we hold the lock while evicting, so that two workers don't
+            # both scan the cache and evict twice as much
+            return True
+
+        if self.currentbytes is None:
+            self.currentbytes = self.total_bytes()
+        else:
+            self.currentbytes += entrybytes
+
+        if self.currentbytes > self.maxbytes:
+            self.evict(int(self.maxbytes * evictto))
+
+        return True
+
+    def shared_counter(self):
+        '''Adds up the size of the cache, and returns it in a
+        multiprocessing.Value that can be passed to worker processes
+        (e.g. through a pool initializer) as sharedbytes.'''
+
+        import multiprocessing
+
+        return multiprocessing.Value('q', self.total_bytes())
+
+    def list_entries(self):
+        '''Returns a list of (last used, bytes, path) for every entry.'''
+
+        entries = []
+        for prefix in os.listdir(self.folder):
+            prefixpath = os.path.join(self.folder, prefix)
+            if not os.path.isdir(prefixpath):
+                continue
+            for name in os.listdir(prefixpath):
+                path = os.path.join(prefixpath, name)
+                if name.endswith('.tmp'):
+                    continue
+                try:
+                    lastused = os.path.getmtime(os.path.join(path, 'meta.json'))
+                except OSError:
+                    lastused = 0
+                entries.append((lastused, directory_size(path), path))
+
+        return entries
+
+    def total_bytes(self):
+        return sum([x[1] for x in self.list_entries()])
+
+    def evict(self, maxbytes = None):
+        '''Removes the least recently used entries until the cache fits
+        in maxbytes (by default, the limit it was created with). Returns
+        the number of entries removed.'''
+
+        if maxbytes is None:
+            maxbytes = self.maxbytes
+
+        entries = sorted(self.list_entries())
+        total = sum([x[1] for x in entries])
+        removed = 0
+
+        for lastused, entrybytes, path in entries:
+            if total <= maxbytes:
+                break
+            shutil.rmtree(path, ignore_errors = True)
+            total -= entrybytes
+            removed += 1
+
+        self.currentbytes = total
+        if self.sharedbytes is not None:
+            with self.sharedbytes.get_lock():
+                self.sharedbytes.value = total
+
+        return removed
+
+    def prune(self, maxbytes = None):
+        '''Removes entries whose source file has been deleted or changed,
+        and temporary folders left by interrupted writes, then evicts
+        entries until the cache fits in maxbytes. Returns the number of
+        entries removed.'''
+
+        removed = 0
+        for prefix in os.listdir(self.folder):
+            prefixpath = os.path.join(self.folder, prefix)
+            if not os.path.isdir(prefixpath):
+                continue
+            for name in os.listdir(prefixpath):
+                path = os.path.join(prefixpath, name)
+                if name.endswith('.tmp'):
+                    shutil.rmtree(path, ignore_errors = True)
+                    continue
+                try:
+                    with open(os.path.join(path, 'meta.json'), encoding = 'utf-8') as f:
+                        meta = json.load(f)
+                    stat = os.stat(meta['sourcepath'])
+                    stale = stat.st_size != meta['sourcesize'] or stat.st_mtime_ns != meta['sourcemtime']
+                except (OSError, ValueError, KeyError):
+                    stale = True
+                if stale:
+                    shutil.rmtree(path, ignore_errors = True)
+                    removed += 1
+
+        return removed + self.evict(maxbytes)
+
+    def source_meta(self, volumepath):
+        stat = os.stat(volumepath)
+        return {'sourcepath': os.path.abspath(volumepath), 'sourcesize': stat.st_size,
+            'sourcemtime': stat.st_mtime_ns}
+
+    def volume_key(self, volume, volumepath, pagestoinclude):
+        return self.entry_key(volumepath, config_hash('volume', volume.normalizer, pagestoinclude))
+
+    def restore_volume(self, volume, volumepath, pagestoinclude):
+        '''
+        Fills in a VolumeFromJson (whose normalizer, compact and vocabulary
+        attributes are already set) from the cache. Returns False if the
+        volume isn't cached, in which case nothing has been changed.
+        '''
+
+        key = self.volume_key(volume, volumepath, pagestoinclude)
+        entry = self.read_entry(key, ['indptr', 'ids', 'values', 'totals'])
+        if entry is None:
+            return False
+        meta, tokens, arrays = entry
+
+        volume.start_volume(pagestoinclude)
+        for field in volumefields:
+            setattr(volume, field, meta[field])
+
+        if volume.compact:
+            mapping = np.array([volume.vocabulary.add(x) for x in tokens], dtype = np.int32)
+            ids = mapping[arrays['ids']]
+            values = np.array(arrays['values'])
+            indptr = arrays['indptr'].tolist()
+            volume.pageids = [ids[start: end] for start, end in zip(indptr[ : -1], indptr[1: ])]
+            volume.pagevalues = [values[start: end] for start, end in zip(indptr[ : -1], indptr[1: ])]
+            volume.sum_compact_counts()
+        else:
+            volume.cachedpages = (arrays['indptr'], arrays['ids'], arrays['values'], tokens)
+            volume.pagecounts = None
+            # built from cachedpages only if asked for; see pagecounts
+            volume.totalcounts = Counter(dict(zip(tokens, arrays['totals'].tolist())))
+
+        return True
+
+    def save_volume(self, volume, volumepath, pagestoinclude):
+        '''Caches a VolumeFromJson that has just been parsed.'''
+
+        key = self.volume_key(volume, volumepath, pagestoinclude)
+        if key is None:
+            return False
+
+        if volume.compact:
+            vocabtokens = volume.vocabulary.tokens
+            tokens = [vocabtokens[i] for i in volume.totalids.tolist()]
+            totals = volume.totalvalues
+            lengths = [len(x) for x in volume.pageids]
+            indptr = np.zeros(len(lengths) + 1, dtype = np.int64)
+            np.cumsum(lengths, out = indptr[1: ])
+            if len(lengths) > 0:
+                ids = np.searchsorted(volume.totalids, np.concatenate(volume.pageids)).astype(np.int32)
+                values = np.concatenate(volume.pagevalues)
+            else:
+                ids = np.zeros(0, dtype = np.int32)
+                values = np.zeros(0, dtype = np.int64)
+        else:
+            tokens = list(volume.totalcounts.keys())
+            # in the order words were first seen, which is the order
+            # totalcounts had when it was counted
+            tokenids = {x: i for i, x in enumerate(tokens)}
+            indptr, ids, values = counters_to_arrays(volume.pagecounts, tokens, tokenids)
+            totals = [volume.totalcounts[x] for x in tokens]
+
+        meta = self.source_meta(volumepath)
+        for field in volumefields:
+            meta[field] = getattr(volume, field)
+
+        arrays = {'indptr': indptr, 'ids': ids, 'values': values, 'totals': np.array(totals, dtype = np.int64)}
+        return self.write_entry(key, meta, tokens, arrays)
+
+    def pagelist_key(self, pagelist, volumepath, normalizer):
+        return self.entry_key(volumepath, config_hash('pagelist', normalizer))
+
+    def restore_pagelist(self, pagelist, volumepath, normalizer):
+        '''Fills in a PagelistFromJson from the cache, or returns False.
+        Unlike a volume's, every page is rebuilt as a Counter here.'''
+
+        key = self.pagelist_key(pagelist, volumepath, normalizer)
+        entry = self.read_entry(key, ['indptr', 'ids', 'values', 'pagestats', 'features'])
+        if entry is None:
+            return False
+        meta, tokens, arrays = entry
+
+        pagelist.volumeid = meta['volumeid']
+        pagelist.numpages = meta['numpages']
+        pagelist.features = None
+        pagelist.featurematrix = np.array(arrays['features'], order = 'F')
+
+        pagelist.pages = []
+        counters = arrays_to_counters(arrays['indptr'], arrays['ids'], arrays['values'], tokens)
+        for counts, stats in zip(counters, arrays['pagestats'].tolist()):
+            pagedata = dict(zip(pagestatfields, stats))
+            pagedata['tokens'] = counts
+            pagelist.pages.append(pagedata)
+
+        return True
+
+    def save_pagelist(self, pagelist, volumepath, normalizer):
+        '''Caches a PagelistFromJson that has just been parsed.'''
+
+        key = self.pagelist_key(pagelist, volumepath, normalizer)
+        if key is None:
+            return False
+
+        tokens = []
+        indptr, ids, values = counters_to_arrays([x['tokens'] for x in pagelist.pages], tokens, dict())
+        pagestats = np.array([[x[field] for field in pagestatfields] for x in pagelist.pages], dtype = np.int64)
+        pagestats = pagestats.reshape((pagelist.numpages, len(pagestatfields)))
+
+        meta = self.source_meta(volumepath)
+        meta['volumeid'] = pagelist.volumeid
+        meta['numpages'] = pagelist.numpages
+
+        arrays = {'indptr': indptr, 'ids': ids, 'values': values, 'pagestats': pagestats,
+            'features': pagelist.featurematrix}
+        return self.write_entry(key, meta, tokens, arrays)
+
+if __name__ == "__main__":
+
+    import argparse
+
+    parser = argparse.ArgumentParser(description = 'Report on or prune a cache of parsed extracted-feature volumes.')
+    parser.add_argument('folder', help = 'the cache folder')
+    parser.add_argument('--prune', action = 'store_true', help = 'remove entries whose source file has changed or vanished')
+    parser.add_argument('--maxmb', type = float, default = None, help = 'also evict least recently used entries down to this size')
+    args = parser.parse_args()
+
+    cache = ResultCache(args.folder)
+    before = cache.list_entries()
+    print(str(len(before)) + ' entries, ' + str(round(sum([x[1] for x in before]) / 1000000, 1)) + ' MB.')
+
+    if args.maxmb is not None:
+        maxbytes = int(args.maxmb * 1000000)
+    else:
+        maxbytes = float('inf')
+
+    if args.prune:
+        removed = cache.prune(maxbytes)
+    elif args.maxmb is not None:
+        removed = cache.evict(maxbytes)
+    else:
+        removed = 0
+
+    if removed > 0:
+        print('Removed ' + str(removed) + ' entries; ' + str(round(cache.total_bytes() / 1000000, 1)) + ' MB remain.')
@@ -0,0 +1,477 @@
+#!/usr/bin/env python3
+
+# efreader.py
+
+# Reads the extracted feature files created by HTRC incrementally.
+# The classes in parsefeaturejsons originally loaded a whole volume
+# with json.loads, which means that the decompressed string and the
+# whole tree of objects sit in memory together. For a volume with
+# thousands of pages that gets expensive. A VolumeStream instead
+# decodes the features.pages array one page at a time, so only one
+# page needs to be materialized at any moment.
+
+import bz2, gzip, lzma, io, os, json, re, csv
+
+decoder = json.JSONDecoder()
+whitespace = ' \t\n\r'
+
+pagestart = re.compile(r'\{\s*"seq"\s*:\s*"([^"\\]*)"')
+nextpage = re.compile(r'\}\s*,\s*\{\s*"seq"\s*:\s*"')
+# Used to skip pages without decoding them. In an extracted feature
+# file, the only place an object begins with a "seq" key that has a
+# string value is the start of a page; inside tokenPosCount every value
+# is an object, and quotes inside tokens are escaped. So the closing
+# brace before the next match of nextpage is the end of this page.
+
+# DECOMPRESSION
+
+# We used to choose between bz2.open and open by looking at the file
+# extension. Instead, files are now identified by their magic bytes, and
+# each codec is a function that takes a binary file object and returns a
+# binary file object of decompressed data. Other codecs can be added
+# with register_codec().
+
+def open_zstd(f):
+    try:
+        import zstandard
+    except ImportError:
+        raise ImportError('Reading zstd-compressed volumes requires the zstandard package.')
+    return zstandard.ZstdDecompressor().stream_reader(f, closefd = True)
+
+def open_plain(f):
+    return f
+
+codecs = dict()
+# maps codec name to a tuple (magic bytes, opener, file extension)
+
+def register_codec(name, magic, opener, extension):
+    codecs[name] = (magic, opener, extension)
+
+register_codec('bz2', b'BZh', lambda f: bz2.BZ2File(f), '.json.bz2')
+register_codec('gzip', b'\x1f\x8b', lambda f: gzip.GzipFile(fileobj = f), '.json.gz')
+register_codec('xz', b'\xfd7zXZ\x00', lambda f: lzma.LZMAFile(f), '.json.xz')
+register_codec('zstd', b'\x28\xb5\x2f\xfd', open_zstd, '.json.zst')
+register_codec('plain', b'', open_plain, '.json')
+
+decompressionthreads = 1
+# The default number of threads open_volume uses to decompress bz2
+# files. Set this once in a process (the corpus driver does it with
+# --threads) rather than passing it through every volume class.
+
+def detect_codec(header):
+    ''' Given the first few bytes of a file, returns the name of its
+    codec. Anything we don't recognize is assumed to be plain json.
+    '''
+
+    for name, (magic, opener, extension) in codecs.items():
+        if len(magic) > 0 and header.startswith(magic):
+            return name
+
+    return 'plain'
+
+bz2streamstart = re.compile(rb'BZh[1-9]1AY&SY')
+# a bz2 stream header followed by the magic number of its first block
+
+def decompress_bz2_parallel(data, threads):
+    ''' Decompresses bz2 data that consists of several concatenated
+    streams (as written by pbzip2, lbzip2, or transcode_volume) using a
+    pool of threads. The bz2 module releases the GIL while it works, so
+    the streams really are decompressed in parallel.
+
+    Blocks inside a single stream are not byte-aligned, so a file with
+    only one stream can't be split this way; it is simply decompressed in
+    one thread. Stream boundaries are found by searching for the stream
+    header, which could in principle also occur by accident inside
+    compressed data; if any piece fails to decompress cleanly we fall
+    back to decompressing the whole thing serially.
+    '''
+
+    starts = [m.start() for m in bz2streamstart.finditer(data)]
+    if len(starts) < 2 or starts[0] != 0:
+        return bz2.decompress(data)
+
+    pieces = [data[start: end] for start, end in zip(starts, starts[1: ] + [len(data)])]
+
+    def decompress_piece(piece):
+        decompressor = bz2.BZ2Decompressor()
+        try:
+            result = decompressor.decompress(piece)
+        except (OSError, EOFError):
+            return None
+        if not decompressor.eof or len(decompressor.unused_data) > 0:
+            return None
+        return result
+
+    from concurrent.futures import ThreadPoolExecutor
+
+    with ThreadPoolExecutor(max_workers = threads) as executor:
+        results = list(executor.map(decompress_piece, pieces))
+
+    if any(x is None for x in results):
+        return bz2.decompress(data)
+    else:
+        return b''.join(results)
+
+class VolumeTextFile(io.TextIOWrapper):
+
+    # The bz2, gzip and lzma file classes don't close a file object that
+    # was passed in to them, so we keep track of the underlying file and
+    # close it ourselves.
+
+    def __init__(self, binaryfile, rawfile):
+        super().__init__(binaryfile, encoding = 'utf-8')
+        self.rawfile = rawfile
+
+    def close(self):
+        super().close()
+        self.rawfile.close()
+
+def read_header(rawfile):
+    ''' Returns the first bytes of a binary file object without
+    consuming them. Members of a tar or zip file can be peeked at, but
+    not always rewound.
+    '''
+
+    if hasattr(rawfile, 'peek'):
+        return rawfile.peek(8)[0: 8]
+    else:
+        header = rawfile.read(8)
+        rawfile.seek(0)
+        return header
+
+def open_volume(volumepath, threads = None):
+    ''' Opens an extracted feature file as text, decompressing it if
+    necessary. The codec is detected from the file's first bytes.
+
+    volumepath can also be a binary file object that is already open
+    (e.g. a member of a tar shard; see efsources). It's read from its
+    current position, and closed when the volume is closed.
+
+    If threads > 1 and the file is bz2, the whole file is decompressed
+    at once with decompress_bz2_parallel; otherwise decompression is
+    streamed as the file is read.
+    '''
+
+    if threads is None:
+        threads = decompressionthreads
+
+    if hasattr(volumepath, 'read'):
+        rawfile = volumepath
+    else:
+        rawfile = open(volumepath, mode = 'rb')
+    codec = detect_codec(read_header(rawfile))
+
+    if codec == 'bz2' and threads > 1:
+        with rawfile:
+            data = decompress_bz2_parallel(rawfile.read(), threads)
+        binaryfile = io.BytesIO(data)
+    else:
+        magic, opener, extension = codecs[codec]
+        binaryfile = opener(rawfile)
+
+    return VolumeTextFile(binaryfile, rawfile)
+
+def write_compressed(data, outpath, codec, blocksize = 900000):
+    ''' Compresses bytes with the named codec and writes them to
+    outpath. bz2 output is written as a series of independent streams,
+    each holding blocksize bytes of input, so that it can be
+    decompressed in parallel; it is still an ordinary bz2 file that any
+    bz2 reader will accept.
+    '''
+
+    with open(outpath, mode = 'wb') as f:
+        if codec == 'bz2':
+            for start in range(0, len(data), blocksize):
+                f.write(bz2.compress(data[start: start + blocksize]))
+        elif codec == 'gzip':
+            f.write(gzip.compress(data))
+        elif codec == 'xz':
+            f.write(lzma.compress(data))
+        elif codec == 'zstd':
+            try:
+                import zstandard
+            except ImportError:
+                raise ImportError('Writing zstd-compressed volumes requires the zstandard package.')
+            f.write(zstandard.ZstdCompressor().compress(data))
+        elif codec == 'plain':
+            f.write(data)
+        else:
+            raise ValueError('Unknown codec: ' + codec)
+
+def transcode_volume(inpath, outfolder, codec):
+    ''' Rewrites one extracted feature file with a different codec,
+    keeping its name but changing the extension. Returns the new path.
+    '''
+
+    with open_volume(inpath, threads = 1) as f:
+        data = f.read().encode('utf-8')
+
+    name = os.path.basename(inpath)
+    for extension in ['.json.bz2', '.json.gz', '.json.xz', '.json.zst', '.json', '.bz2']:
+        if name.endswith(extension):
+            name = name[0: -len(extension)]
+            break
+
+    outpath = os.path.join(outfolder, name + codecs[codec][2])
+    temppath = outpath + '.tmp'
+    write_compressed(data, temppath, codec)
+    os.replace(temppath, outpath)
+
+    return outpath
+
+def transcode_task(task):
+    docid, inpath, outfolder, codec = task
+    return docid, transcode_volume(inpath, outfolder, codec)
+
+def transcode_corpus(metapath, outfolder, newmetapath, codec, processes = None):
+    ''' Transcodes every volume listed in a metadata csv (with columns
+    docid and filepath) to the codec, and writes a new metadata csv that
+    points at the transcoded files. This only has to be done once for a
+    corpus, after which every run reads the faster format.
+    '''
+
+    from multiprocessing import Pool
+
+    with open(metapath, encoding = 'utf-8') as f:
+        tasks = [(row['docid'], row['filepath'], outfolder, codec) for row in csv.DictReader(f)]
+
+    if not os.path.isdir(outfolder):
+        os.makedirs(outfolder)
+
+    with Pool(processes = processes) as pool:
+        results = pool.map(transcode_task, tasks, chunksize = 4)
+
+    with open(newmetapath, mode = 'w', encoding = 'utf-8') as f:
+        writer = csv.writer(f)
+        writer.writerow(['docid', 'filepath'])
+        for docid, outpath in results:
+            writer.writerow([docid, outpath])
+
+class VolumeStream:
+
+    # Walks the top level of an extracted feature file without
+    # decoding it all at once. Everything outside features.pages is
+    # small, so it is decoded normally and stored in self.fields
+    # (top-level keys like 'id' and 'metadata') and self.features
+    # (keys of the 'features' object other than 'pages').
+
+    def __init__(self, f, chunksize = 65536):
+        '''Takes a file object opened in text mode.'''
+
+        self.f = f
+        self.chunksize = chunksize
+        self.buffer = ''
+        self.pos = 0
+        self.eof = False
+        self.fields = dict()
+        self.features = dict()
+        self.numpages = 0
+
+    def refill(self, size):
+        ''' Reads more text onto the end of the buffer, discarding
+        whatever has already been consumed. Returns False at end
+        of file.
+        '''
+
+        if self.eof:
+            return False
+
+        chunk = self.f.read(size)
+        if len(chunk) < 1:
+            self.eof = True
+            return False
+
+        self.buffer = self.buffer[self.pos: ] + chunk
+        self.pos = 0
+        return True
+
+    def next_char(self):
+        ''' Skips whitespace and returns the next character without
+        consuming it; returns an empty string at end of file.
+        '''
+
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in whitespace:
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            elif not self.refill(self.chunksize):
+                return ''
+
+    def expect(self, chars):
+        ''' Consumes one of the structural characters in chars,
+        and returns the one that was found.
+        '''
+
+        char = self.next_char()
+        if len(char) < 1 or char not in chars:
+            raise ValueError('Expected one of ' + repr(chars) + ' in volume stream but found ' + repr(char))
+        self.pos += 1
+        return char
+
+    def read_value(self):
+        ''' Decodes the next complete json value. If the buffer ends
+        in the middle of the value, we read more and try again,
+        doubling the size of each read so that a very large value
+        doesn't cost quadratic time.
+        '''
+
+        self.next_char()
+        size = self.chunksize
+
+        while True:
+            try:
+                value, end = decoder.raw_decode(self.buffer, self.pos)
+            except json.JSONDecodeError:
+                if self.refill(size):
+                    size = size * 2
+                    continue
+                else:
+                    raise
+
+            if end < len(self.buffer) or not self.refill(size):
+                # A number that ends exactly at the end of the buffer
+                # might have been truncated, so in that case we read
+                # more and decode it again.
+                self.pos = end
+                return value
+
+    def read_object(self, target, special):
+        ''' Reads the members of an object into target, except for
+        the key named special, whose value is left unread so that
+        the caller can stream it. Returns True if special was found;
+        in that case the rest of the object is still unread.
+        '''
+
+        self.expect('{')
+        if self.next_char() == '}':
+            self.pos += 1
+            return False
+
+        while True:
+            key = self.read_value()
+            self.expect(':')
+
+            if key == special:
+                return True
+
+            target[key] = self.read_value()
+
+            if self.expect(',}') == '}':
+                return False
+
+    def finish_object(self, target):
+        ''' Reads the remaining members of an object whose special
+        key has already been streamed.
+        '''
+
+        if self.expect(',}') == '}':
+            return
+
+        while True:
+            key = self.read_value()
+            self.expect(':')
+            target[key] = self.read_value()
+            if self.expect(',}') == '}':
+                return
+
+    def peek_seq(self):
+        ''' If the next page begins with its "seq" field, as pages in
+        HTRC's files do, returns that seq without decoding the page.
+        Otherwise returns None.
+        '''
+
+        while True:
+            match = pagestart.match(self.buffer, self.pos)
+            if match is not None:
+                return match.group(1)
+            elif len(self.buffer) - self.pos > 1024 or not self.refill(self.chunksize):
+                return None
+
+    def skip_page(self):
+        ''' Moves past the page at the current position without decoding
+        it. The last page in the array isn't followed by another page,
+        so in that case we fall back to decoding it.
+        '''
+
+        searchfrom = self.pos
+        size = self.chunksize
+
+        while True:
+            match = nextpage.search(self.buffer, searchfrom)
+            if match is not None:
+                self.pos = match.start() + 1
+                return
+
+            consumed = self.pos
+            searchfrom = len(self.buffer) - 64
+            # back up a little, in case the boundary straddles the
+            # end of the buffer
+            if not self.refill(size):
+                break
+            searchfrom = max(searchfrom - consumed, 0)
+            size = size * 2
+
+        self.read_value()
+
+    def pages(self, include = None):
+        ''' A generator that yields the page objects in
+        features.pages one at a time. When it finishes, fields and
+        features have been filled in from the rest of the file.
+
+        If include is provided, it's a function that gets called exactly
+        once for each page with the page's seq (or None, if the page has
+        no seq), and returns True if the page should be decoded. Excluded
+        pages are skipped in the text without being decoded, and yielded
+        as None, so the caller can still count them.
+        '''
+
+        infeatures = self.read_object(self.fields, 'features')
+        if infeatures:
+            inpages = self.read_object(self.features, 'pages')
+
+            if inpages:
+                self.expect('[')
+                if self.next_char() == ']':
+                    self.pos += 1
+                else:
+                    while True:
+                        self.numpages += 1
+
+                        if include is None:
+                            yield self.read_value()
+                        else:
+                            self.next_char()
+                            seq = self.peek_seq()
+                            if seq is None:
+                                page = self.read_value()
+                                if include(page.get('seq')):
+                                    yield page
+                                else:
+                                    yield None
+                            elif include(seq):
+                                yield self.read_value()
+                            else:
+                                self.skip_page()
+                                yield None
+
+                        if self.expect(',]') == ']':
+                            break
+
+                self.finish_object(self.features)
+
+            self.finish_object(self.fields)
+
+if __name__ == "__main__":
+
+    import argparse
+
+    parser = argparse.ArgumentParser(description = 'Transcode a corpus of extracted feature files to another codec.')
+    parser.add_argument('metadata', help = 'csv with columns docid and filepath')
+    parser.add_argument('outfolder', help = 'folder for the transcoded files')
+    parser.add_argument('newmetadata', help = 'path for a new metadata csv pointing at the transcoded files')
+    parser.add_argument('--codec', default = 'bz2', choices = sorted(codecs.keys()))
+    parser.add_argument('--workers', type = int, default = None)
+    args = parser.parse_args()
+
+    transcode_corpus(args.metadata, args.outfolder, args.newmetadata, args.codec, processes = args.workers)
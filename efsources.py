@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+
+# efsources.py
+
+# Finds extracted feature files for the volume classes in
+# parsefeaturejsons, which accept either a path or a binary file object
+# (see efreader.open_volume).
+
+# HTRC distributes extracted features as a pairtree, where the file for
+# an htid like uc2.ark:/13960/t0ns0s59m lives at
+# root/uc2/pairtree_root/ar/k+/=1/39/60/=t/0n/s0/s5/9m/ark+=13960=t0ns0s59m/uc2.ark+=13960=t0ns0s59m.json.bz2
+# find_in_pairtree() resolves an htid to that path, so callers no longer
+# have to build it themselves with SonicScrewdriver.pairtreepath.
+
+# But a corpus of millions of small files is slow to read even when we
+# know where they are, because every volume costs a directory lookup, a
+# stat and an open, scattered across the disk. So volumes can also be
+# packed into shards: tar or zip files that hold a few thousand EF files
+# each, under their clean pairtree names. A Shard yields the volumes in
+# the order they're stored, as file objects that read straight out of
+# the archive, so a whole shard is processed with large sequential reads
+# and nothing is extracted to disk. Tar shards are read as a stream, so
+# they can also be compressed as a whole (.tar.gz), although there's
+# little point when the members are already bz2.
+
+# Usage: python efsources.py metadata.csv outfolder [--pershard N]
+# packs the volumes listed in metadata.csv (columns docid and filepath)
+# into tar shards in outfolder.
+
+import os, io, csv, tarfile, zipfile
+
+import efreader
+import SonicScrewdriver as utils
+
+def pairtree_path(htid, root, extension = '.json.bz2'):
+    '''Returns the path where an htid's extracted features would be
+    stored in the pairtree at root.'''
+
+    folder, postfix = utils.pairtreepath(htid, os.path.join(root, ''))
+    prefix = htid[0: htid.find('.')]
+    return os.path.join(folder, postfix, prefix + '.' + postfix + extension)
+
+def find_in_pairtree(htid, root):
+    '''Returns the path to an htid's extracted features in the pairtree,
+    or None if it isn't there. Files can have been transcoded (see
+    efreader.transcode_corpus), so we try each codec's extension, bz2
+    first.'''
+
+    for magic, opener, extension in efreader.codecs.values():
+        path = pairtree_path(htid, root, extension)
+        if os.path.isfile(path):
+            return path
+
+    return None
+
+extensions = sorted(set([x[2] for x in efreader.codecs.values()]), key = len, reverse = True)
+
+def docid_from_name(name):
+    '''Given the name of an EF file (e.g. a member of a shard), returns
+    the htid, or None if it isn't an EF file.'''
+
+    name = os.path.basename(name)
+    for extension in extensions:
+        if name.endswith(extension):
+            return utils.dirty_pairtree(name[0: -len(extension)])
+
+    return None
+
+class PairtreeSource:
+
+    # Yields the volumes for a list of htids from a pairtree. Volumes
+    # that can't be found are skipped, and listed in self.missing.
+
+    def __init__(self, root, htids):
+        self.root = root
+        self.htids = htids
+        self.missing = []
+
+    def __iter__(self):
+        '''Yields (htid, binary file object, size in bytes).'''
+
+        for htid in self.htids:
+            path = find_in_pairtree(htid, self.root)
+            if path is None:
+                self.missing.append(htid)
+                continue
+            with open(path, mode = 'rb') as f:
+                yield htid, f, os.fstat(f.fileno()).st_size
+
+class TarShard:
+
+    # Yields the volumes in a tar file, reading it as a stream. A member
+    # of a streamed tar can't tell io whether it's seekable, so each
+    # volume is read into memory (still compressed) with one read, and
+    # decompressed from there.
+
+    def __init__(self, path):
+        self.path = path
+
+    def __iter__(self):
+        '''Yields (htid, binary file object, size in bytes).'''
+
+        with tarfile.open(self.path, mode = 'r|*') as tar:
+            for member in tar:
+                if not member.isfile():
+                    continue
+                docid = docid_from_name(member.name)
+                if docid is None:
+                    continue
+                yield docid, io.BytesIO(tar.extractfile(member).read()), member.size
+
+class ZipShard:
+
+    # Yields the volumes in a zip file, in the order they were stored.
+
+    def __init__(self, path):
+        self.path = path
+
+    def __iter__(self):
+        '''Yields (htid, binary file object, size in bytes).'''
+
+        with zipfile.ZipFile(self.path) as archive:
+            for info in archive.infolist():
+                if info.is_dir():
+                    continue
+                docid = docid_from_name(info.filename)
+                if docid is None:
+                    continue
+                with archive.open(info) as f:
+                    yield docid, f, info.file_size
+
+def open_shard(path):
+    '''Returns a TarShard or ZipShard, depending on what kind of
+    archive path is.'''
+
+    if zipfile.is_zipfile(path):
+        return ZipShard(path)
+    elif tarfile.is_tarfile(path):
+        return TarShard(path)
+    else:
+        raise ValueError('Not a tar or zip shard: ' + path)
+
+def find_shards(path):
+    '''Returns a list of shard paths: path itself if it's a file, or
+    the tar and zip files in it if it's a folder.'''
+
+    if not os.path.isdir(path):
+        return [path]
+
+    shards = []
+    for name in sorted(os.listdir(path)):
+        if name.endswith('.zip') or '.tar' in name or name.endswith('.tgz'):
+            shards.append(os.path.join(path, name))
+
+    return shards
+
+def pack_shards(metapath, outfolder, pershard = 1000):
+    '''Packs the EF files listed in a metadata csv (columns docid and
+    filepath) into uncompressed tar shards of pershard volumes each,
+    named with their clean pairtree ids. Returns the shard paths.'''
+
+    with open(metapath, encoding = 'utf-8') as f:
+        rows = [(row['docid'], row['filepath']) for row in csv.DictReader(f)]
+
+    if not os.path.isdir(outfolder):
+        os.makedirs(outfolder)
+
+    shardpaths = []
+    for start in range(0, len(rows), pershard):
+        shardpath = os.path.join(outfolder, 'shard' + str(start // pershard).zfill(5) + '.tar')
+        temppath = shardpath + '.tmp'
+        with tarfile.open(temppath, mode = 'w') as tar:
+            for docid, filepath in rows[start: start + pershard]:
+                with open(filepath, mode = 'rb') as f:
+                    codec = efreader.detect_codec(f.read(8))
+                tar.add(filepath, arcname = utils.clean_pairtree(docid) + efreader.codecs[codec][2])
+        os.replace(temppath, shardpath)
+        shardpaths.append(shardpath)
+
+    return shardpaths
+
+if __name__ == "__main__":
+
+    import argparse
+
+    parser = argparse.ArgumentParser(description = 'Pack extracted feature files into tar shards.')
+    parser.add_argument('metadata', help = 'csv with columns docid and filepath')
+    parser.add_argument('outfolder', help = 'folder for the shards')
+    parser.add_argument('--pershard', type = int, default = 1000, help = 'volumes per shard')
+    args = parser.parse_args()
+
+    shardpaths = pack_shards(args.metadata, args.outfolder, args.pershard)
+    print('Wrote ' + str(len(shardpaths)) + ' shards to ' + args.outfolder)
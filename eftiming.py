@@ -0,0 +1,221 @@
+#!/usr/bin/env python3
+
+# eftiming.py
+
+# Optional timers for the volume parsers in parsefeaturejsons, for
+# finding out where a slow corpus run spends its time: reading and
+# decompressing, decoding json, counting tokenPosCount, normalizing
+# tokens, finishing the volume statistics, or writing output.
+
+# Timing is off unless enable() is called, and when it's off each
+# volume pays for one test of a module-level flag. When it's on, every
+# volume produces a record of seconds per phase and some counters
+# (tokens, pages, normalizer misses), which is appended as a json line
+# to a file of its own for each process. So worker processes needn't
+# send anything back to the parent, and report() can add up the files
+# from all workers afterward.
+
+# Normalizing is part of counting, so the 'normalize' phase overlaps the
+# 'count' phase. We time only normalizer cache misses, which is where
+# the work happens; hits are a dictionary lookup inside the count loop.
+
+# Usage: python eftiming.py timingfolder [--slowest N] [--json]
+
+import os, json, time
+
+enabled = False
+timingfolder = None
+
+normalizeseconds = 0.0
+normalizemisses = 0
+# running totals, which each VolumeTimer reads when it starts and stops
+
+phaseorder = ['read', 'decode', 'stream', 'count', 'normalize', 'finish', 'write']
+
+def enable(folder):
+    '''Turns timing on in this process, writing records to folder. Call
+    this before any normalizer is created (e.g. in a pool initializer).'''
+
+    global enabled, timingfolder
+
+    if not os.path.isdir(folder):
+        os.makedirs(folder, exist_ok = True)
+    timingfolder = folder
+    enabled = True
+
+def disable():
+    global enabled
+    enabled = False
+
+def timed_lookup(lookup):
+    '''Wraps a normalizer's uncached lookup so its time is counted.'''
+
+    def timed(token):
+        global normalizeseconds, normalizemisses
+        start = time.perf_counter()
+        result = lookup(token)
+        normalizeseconds += time.perf_counter() - start
+        normalizemisses += 1
+        return result
+
+    return timed
+
+class VolumeTimer:
+
+    # Times the phases of one volume. Each call to lap() charges the
+    # time since the previous lap (or since the timer was created) to a
+    # phase.
+
+    def __init__(self, volumeid, kind):
+        self.volumeid = volumeid
+        self.kind = kind
+        self.phases = dict()
+        self.counters = dict()
+        self.startnormalize = normalizeseconds
+        self.startmisses = normalizemisses
+        self.last = time.perf_counter()
+
+    def lap(self, phase):
+        now = time.perf_counter()
+        self.phases[phase] = self.phases.get(phase, 0.0) + now - self.last
+        self.last = now
+
+    def count(self, name, value):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def done(self):
+        '''Records the volume.'''
+
+        normalize = normalizeseconds - self.startnormalize
+        if normalize > 0:
+            self.phases['normalize'] = normalize
+            self.counters['normalizemisses'] = normalizemisses - self.startmisses
+
+        write_record({'volume': self.volumeid, 'kind': self.kind, 'phases': self.phases,
+            'counters': self.counters})
+
+def volume_timer(volumeid, kind):
+    '''Returns a VolumeTimer if timing is enabled, else None.'''
+
+    if enabled:
+        return VolumeTimer(volumeid, kind)
+    else:
+        return None
+
+def record_phase(volumeid, kind, phase, seconds, counters = dict()):
+    '''Records a single phase timed outside a VolumeTimer (e.g. writing
+    a volume's features, which happens after it has been parsed).'''
+
+    if enabled:
+        write_record({'volume': volumeid, 'kind': kind, 'phases': {phase: seconds}, 'counters': dict(counters)})
+
+def write_record(record):
+    path = os.path.join(timingfolder, 'timing-' + str(os.getpid()) + '.jsonl')
+    with open(path, mode = 'a', encoding = 'utf-8') as f:
+        f.write(json.dumps(record) + '\n')
+
+def read_records(folder):
+    '''Reads the records from every process, merging the records for
+    each volume.'''
+
+    volumes = dict()
+    for name in sorted(os.listdir(folder)):
+        if not (name.startswith('timing-') and name.endswith('.jsonl')):
+            continue
+        with open(os.path.join(folder, name), encoding = 'utf-8') as f:
+            for line in f:
+                line = line.strip()
+                if len(line) < 1:
+                    continue
+                record = json.loads(line)
+                key = (record['volume'], record['kind'])
+                if key not in volumes:
+                    volumes[key] = {'volume': record['volume'], 'kind': record['kind'],
+                        'phases': dict(), 'counters': dict()}
+                merged = volumes[key]
+                for phase, seconds in record['phases'].items():
+                    merged['phases'][phase] = merged['phases'].get(phase, 0.0) + seconds
+                for name, value in record['counters'].items():
+                    merged['counters'][name] = merged['counters'].get(name, 0) + value
+
+    return list(volumes.values())
+
+def percentile(sortedvalues, fraction):
+    if len(sortedvalues) < 1:
+        return 0.0
+    index = min(len(sortedvalues) - 1, int(round(fraction * (len(sortedvalues) - 1))))
+    return sortedvalues[index]
+
+def summarize(records, slowest = 10):
+    '''Returns a dictionary describing the run: for each phase, the
+    total, percentiles across volumes, share of the time and tokens per
+    phase-second; and the slowest volumes.'''
+
+    totaltokens = sum([r['counters'].get('tokens', 0) for r in records])
+    elapsed = dict()
+    for r in records:
+        # normalize overlaps count, so it's left out of a volume's total
+        elapsed[(r['volume'], r['kind'])] = sum([v for k, v in r['phases'].items() if k != 'normalize'])
+    alltime = sum(elapsed.values())
+
+    phases = dict()
+    names = [x for x in phaseorder if any(x in r['phases'] for r in records)]
+    names += sorted(set([x for r in records for x in r['phases'] if x not in phaseorder]))
+
+    for phase in names:
+        values = sorted([r['phases'][phase] for r in records if phase in r['phases']])
+        total = sum(values)
+        phases[phase] = {'volumes': len(values), 'total': total,
+            'p50': percentile(values, 0.5), 'p90': percentile(values, 0.9),
+            'p99': percentile(values, 0.99), 'max': values[-1],
+            'share': total / alltime if alltime > 0 else 0.0,
+            'tokens_per_sec': totaltokens / total if total > 0 else 0.0}
+
+    ranked = sorted(records, key = lambda r: elapsed[(r['volume'], r['kind'])], reverse = True)
+    slowestvolumes = [{'volume': r['volume'], 'kind': r['kind'], 'seconds': elapsed[(r['volume'], r['kind'])],
+        'phases': r['phases'], 'tokens': r['counters'].get('tokens', 0)} for r in ranked[0: slowest]]
+
+    return {'volumes': len(records), 'tokens': totaltokens, 'seconds': alltime,
+        'phases': phases, 'slowest': slowestvolumes}
+
+def format_summary(summary):
+    lines = [str(summary['volumes']) + ' volume records, ' + str(summary['tokens']) + ' tokens, ' +
+        str(round(summary['seconds'], 2)) + ' seconds of timed work.']
+    lines.append('phase'.ljust(10) + 'total s'.rjust(10) + 'share'.rjust(8) + 'p50 ms'.rjust(10) +
+        'p90 ms'.rjust(10) + 'p99 ms'.rjust(10) + 'max ms'.rjust(10) + 'Mtok/s'.rjust(10))
+    for phase, p in summary['phases'].items():
+        lines.append(phase.ljust(10) + str(round(p['total'], 2)).rjust(10) +
+            (str(round(100 * p['share'], 1)) + '%').rjust(8) +
+            ''.join([str(round(1000 * p[x], 1)).rjust(10) for x in ['p50', 'p90', 'p99', 'max']]) +
+            str(round(p['tokens_per_sec'] / 1000000, 3)).rjust(10))
+    if len(summary['slowest']) > 0:
+        lines.append('Slowest volumes:')
+        for r in summary['slowest']:
+            breakdown = ', '.join([k + ' ' + str(round(v, 3)) for k, v in r['phases'].items()])
+            lines.append('  ' + str(r['volume']) + ' (' + r['kind'] + ') ' + str(round(r['seconds'], 3)) +
+                ' s, ' + str(r['tokens']) + ' tokens: ' + breakdown)
+
+    return '\n'.join(lines)
+
+def report(folder, slowest = 10):
+    '''Reads the records in folder, and returns the summary and a
+    printable version of it.'''
+
+    summary = summarize(read_records(folder), slowest)
+    return summary, format_summary(summary)
+
+if __name__ == "__main__":
+
+    import argparse
+
+    parser = argparse.ArgumentParser(description = 'Summarize parser timing records.')
+    parser.add_argument('folder')
+    parser.add_argument('--slowest', type = int, default = 10)
+    parser.add_argument('--json', action = 'store_true', help = 'print the summary as json')
+    args = parser.parse_args()
+
+    summary, text = report(args.folder, args.slowest)
+    if args.json:
+        print(json.dumps(summary, indent = 1))
+    else:
+        print(text)
@@ -0,0 +1,301 @@
+#!/usr/bin/env python3
+
+# featurestore.py
+
+# A binary, columnar alternative to writing one small .csv per volume.
+# Volume features are accumulated in memory and written in shards of
+# (by default) a thousand volumes. Each shard is a folder of .npy files
+# holding a CSR matrix of raw counts (volumes x vocabulary) plus a
+# block of scalar features, so it can be memory-mapped rather than
+# parsed. All shards share one vocabulary, which only ever grows, so
+# the column ids in old shards stay valid as new shards are written.
+
+# Layout of a store folder:
+#   vocabulary.json        list of tokens; position is the column id
+#   shard00000/
+#       volumeids.json     list of volume ids; position is the row
+#       indptr.npy         int64, rows + 1
+#       indices.npy        int32 column ids
+#       data.npy           int64 raw counts
+#       scalars.npy        float64, rows x len(scalarfeatures)
+
+import os, json, shutil
+from collections import Counter
+
+import numpy as np
+
+from parsefeaturejsons import Vocabulary
+
+scalarfeatures = ['#totaltokens', '#sentencelength', '#typetoken', '#linelength']
+
+def write_json_atomically(obj, path):
+    temppath = path + '.tmp'
+    with open(temppath, mode = 'w', encoding = 'utf-8') as f:
+        json.dump(obj, f, ensure_ascii = False)
+    os.replace(temppath, path)
+
+def list_shards(folder):
+    '''Returns the names of complete shards, in order.'''
+
+    return sorted([x for x in os.listdir(folder) if x.startswith('shard') and not x.endswith('.tmp')])
+
+class FeatureStoreWriter:
+
+    # Collects volumes (anything with the attributes of a VolumeFromJson:
+    # volumeid, totalcounts, totaltokens, sentencelength, typetoken and
+    # linelength) and writes them to disk in shards.
+
+    def __init__(self, folder, shardsize = 1000):
+        '''If folder already contains a store, new shards are added to
+        it, extending the existing vocabulary.'''
+
+        self.folder = folder
+        self.shardsize = shardsize
+
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+
+        vocabpath = os.path.join(folder, 'vocabulary.json')
+        if os.path.isfile(vocabpath):
+            with open(vocabpath, encoding = 'utf-8') as f:
+                self.vocabulary = Vocabulary(json.load(f))
+        else:
+            self.vocabulary = Vocabulary()
+
+        self.nextshard = len(list_shards(folder))
+        self.clear_buffer()
+
+    def clear_buffer(self):
+        self.volumeids = []
+        self.indices = []
+        self.data = []
+        self.rowlengths = []
+        self.scalars = []
+
+    def add_volume(self, volume):
+        self.add_counts(volume.volumeid, volume.totalcounts, volume.totaltokens,
+            volume.sentencelength, volume.typetoken, volume.linelength)
+
+    def add_counts(self, volumeid, counts, totaltokens, sentencelength, typetoken, linelength):
+        '''Adds one volume described directly by its counts and scalar
+        features, for callers that don't have a volume object (e.g.
+        results sent back from worker processes).'''
+
+        before = len(self.indices)
+        for key, value in counts.items():
+            if value > 0:
+                self.indices.append(self.vocabulary.get(key))
+                self.data.append(value)
+
+        self.volumeids.append(volumeid)
+        self.rowlengths.append(len(self.indices) - before)
+        self.scalars.append([totaltokens, sentencelength, typetoken, linelength])
+
+        if len(self.volumeids) >= self.shardsize:
+            self.flush()
+
+    def flush(self):
+        '''Writes buffered volumes as a new shard. The shard is built
+        under a temporary name and renamed when complete, after the
+        vocabulary it depends on has been saved.'''
+
+        if len(self.volumeids) < 1:
+            return
+
+        shardname = 'shard' + str(self.nextshard).zfill(5)
+        shardpath = os.path.join(self.folder, shardname)
+        temppath = shardpath + '.tmp'
+        if os.path.isdir(temppath):
+            shutil.rmtree(temppath)
+        os.makedirs(temppath)
+
+        indptr = np.zeros(len(self.rowlengths) + 1, dtype = np.int64)
+        np.cumsum(self.rowlengths, out = indptr[1: ])
+
+        np.save(os.path.join(temppath, 'indptr.npy'), indptr)
+        np.save(os.path.join(temppath, 'indices.npy'), np.array(self.indices, dtype = np.int32))
+        np.save(os.path.join(temppath, 'data.npy'), np.array(self.data, dtype = np.int64))
+        np.save(os.path.join(temppath, 'scalars.npy'), np.array(self.scalars, dtype = np.float64))
+        write_json_atomically(self.volumeids, os.path.join(temppath, 'volumeids.json'))
+
+        write_json_atomically(self.vocabulary.tokens, os.path.join(self.folder, 'vocabulary.json'))
+        os.replace(temppath, shardpath)
+
+        self.nextshard += 1
+        self.clear_buffer()
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+class FeatureStoreReader:
+
+    # Reads a store written by FeatureStoreWriter. Shard arrays are
+    # memory-mapped when first needed, so reading a few volumes or a
+    # few features touches only the corresponding parts of the files.
+
+    def __init__(self, folder):
+
+        self.folder = folder
+
+        with open(os.path.join(folder, 'vocabulary.json'), encoding = 'utf-8') as f:
+            self.vocabulary = Vocabulary(json.load(f), growable = False)
+
+        self.shardnames = list_shards(folder)
+        self.shards = dict()
+        self.location = dict()
+        # maps volumeid to (shard number, row); if a volume was
+        # written more than once, the latest copy wins
+
+        for shardnum, shardname in enumerate(self.shardnames):
+            with open(os.path.join(folder, shardname, 'volumeids.json'), encoding = 'utf-8') as f:
+                for row, volumeid in enumerate(json.load(f)):
+                    self.location[volumeid] = (shardnum, row)
+
+    def __contains__(self, volumeid):
+        return volumeid in self.location
+
+    def __len__(self):
+        return len(self.location)
+
+    def get_volumeids(self):
+        return list(self.location.keys())
+
+    def get_shard(self, shardnum):
+        if shardnum not in self.shards:
+            shardpath = os.path.join(self.folder, self.shardnames[shardnum])
+            shard = dict()
+            for name in ['indptr', 'indices', 'data', 'scalars']:
+                shard[name] = np.load(os.path.join(shardpath, name + '.npy'), mmap_mode = 'r')
+            self.shards[shardnum] = shard
+
+        return self.shards[shardnum]
+
+    def get_row(self, volumeid):
+        '''Returns column ids, counts and scalar features for one volume.'''
+
+        shardnum, row = self.location[volumeid]
+        shard = self.get_shard(shardnum)
+        start = shard['indptr'][row]
+        end = shard['indptr'][row + 1]
+        return shard['indices'][start: end], shard['data'][start: end], shard['scalars'][row]
+
+    def get_raw_counts(self, volumeid):
+        '''Returns a Counter of raw counts, like VolumeFromJson.totalcounts.'''
+
+        indices, data, scalars = self.get_row(volumeid)
+        tokens = self.vocabulary.tokens
+        return Counter({tokens[i]: int(v) for i, v in zip(indices, data)})
+
+    def get_volume_features(self, volumeid):
+        '''
+        Just like VolumeFromJson.get_volume_features: returns a dictionary
+        of normalized frequencies plus scalar features, and the total
+        number of tokens.
+        '''
+
+        indices, data, scalars = self.get_row(volumeid)
+        totaltokens = int(scalars[0])
+        outdict = Counter()
+        if totaltokens < 1:
+            return outdict, 0
+
+        tokens = self.vocabulary.tokens
+        for i, v in zip(indices, data):
+            outdict[tokens[i]] = int(v) / totaltokens
+        outdict['#sentencelength'] = scalars[1]
+        outdict['#typetoken'] = scalars[2]
+        outdict['#linelength'] = scalars[3]
+
+        return outdict, totaltokens
+
+    def get_matrix(self, volumeids = None, features = None, normalize = True):
+        '''
+        Returns a dense array, volumes x features, for a chosen list of
+        features, which can include the scalar features listed in
+        scalarfeatures. By default word counts are divided by
+        #totaltokens, as in the .csvs we used to write.
+
+        If features is None, we return get_sparse_matrix() instead: a
+        dense row for every word in the shared vocabulary won't fit in
+        memory for a large corpus.
+        '''
+
+        if volumeids is None:
+            volumeids = self.get_volumeids()
+        if features is None:
+            return self.get_sparse_matrix(volumeids, normalize)
+
+        columnof = np.full(len(self.vocabulary), -1, dtype = np.int64)
+        scalarcolumns = []
+        for column, feature in enumerate(features):
+            if feature in scalarfeatures:
+                scalarcolumns.append((column, scalarfeatures.index(feature)))
+            elif feature in self.vocabulary:
+                columnof[self.vocabulary.ids[feature]] = column
+
+        matrix = np.zeros((len(volumeids), len(features)))
+
+        for rownum, volumeid in enumerate(volumeids):
+            indices, data, scalars = self.get_row(volumeid)
+            columns = columnof[indices]
+            wanted = columns >= 0
+            values = np.asarray(data[wanted], dtype = np.float64)
+            if normalize and scalars[0] > 0:
+                values = values / scalars[0]
+            matrix[rownum, columns[wanted]] = values
+
+            for column, scalarnum in scalarcolumns:
+                matrix[rownum, column] = scalars[scalarnum]
+
+        return matrix
+
+    def get_sparse_matrix(self, volumeids = None, normalize = True):
+        '''
+        Returns a scipy.sparse CSR matrix, volumes x (every word in the
+        vocabulary, then the scalar features after #totaltokens), with
+        the same values get_matrix() would give those columns. Each row
+        is sliced out of the memory-mapped shard arrays, so only the
+        volumes asked for are read, and memory goes with the number of
+        nonzero values rather than the size of the vocabulary.
+        '''
+
+        from scipy import sparse
+
+        if volumeids is None:
+            volumeids = self.get_volumeids()
+
+        numwords = len(self.vocabulary)
+        scalarindices = np.arange(numwords, numwords + len(scalarfeatures) - 1, dtype = np.int64)
+
+        alldata = []
+        allindices = []
+        rowlengths = np.zeros(len(volumeids), dtype = np.int64)
+
+        for rownum, volumeid in enumerate(volumeids):
+            indices, data, scalars = self.get_row(volumeid)
+            values = np.asarray(data, dtype = np.float64)
+            if normalize and scalars[0] > 0:
+                values = values / scalars[0]
+            alldata.extend([values, np.asarray(scalars[1: ], dtype = np.float64)])
+            allindices.extend([np.asarray(indices, dtype = np.int64), scalarindices])
+            rowlengths[rownum] = len(values) + len(scalarindices)
+
+        indptr = np.zeros(len(volumeids) + 1, dtype = np.int64)
+        np.cumsum(rowlengths, out = indptr[1: ])
+
+        if len(volumeids) > 0:
+            data = np.concatenate(alldata)
+            indices = np.concatenate(allindices)
+        else:
+            data = np.zeros(0, dtype = np.float64)
+            indices = np.zeros(0, dtype = np.int64)
+
+        matrix = sparse.csr_matrix((data, indices, indptr), shape = (len(volumeids), numwords + len(scalarindices)))
+        matrix.sort_indices()
+        return matrix
@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+
+# featurewriter.py
+
+# VolumeFromJson.append_volume_features reopens the output file for every
+# volume and writes it row by row. That's fine in one process, but when
+# several processes append to the same file their lines can interleave.
+# Here, workers instead put each finished volume on a queue, and a single
+# writer process owns the file. It buffers rows and writes them in large
+# blocks, in the order of the sequence numbers the volumes were given,
+# so the output is the same however the work was divided up.
+
+# The queue is bounded. If the writer falls behind, workers block when
+# they try to add to it; send_rows() returns how long a worker waited,
+# so callers can report that backpressure. The writer itself reports how
+# much of its time it spent busy writing rather than waiting for input.
+
+import csv, os, time, queue, multiprocessing
+
+def writer_loop(inqueue, statsqueue, outpath, flushrows, header, backlogwarning):
+    '''
+    The body of the writer process. Receives tuples (sequence, rows) until
+    it gets None, and writes the rows for each sequence number in order.
+    '''
+
+    pending = dict()
+    nextsequence = 0
+    block = []
+    stats = {'volumes': 0, 'rows': 0, 'flushes': 0, 'maxpending': 0,
+        'waitseconds': 0.0, 'writeseconds': 0.0, 'outoforder': 0}
+
+    def flush(f, writer):
+        start = time.time()
+        writer.writerows(block)
+        f.flush()
+        stats['writeseconds'] += time.time() - start
+        stats['rows'] += len(block)
+        stats['flushes'] += 1
+        del block[:]
+
+    isnew = not os.path.isfile(outpath) or os.path.getsize(outpath) == 0
+
+    with open(outpath, mode = 'a', encoding = 'utf-8') as f:
+        writer = csv.writer(f)
+        if header and isnew:
+            writer.writerow(['docid', 'feature', 'value'])
+
+        while True:
+            start = time.time()
+            item = inqueue.get()
+            stats['waitseconds'] += time.time() - start
+
+            if item is None:
+                break
+
+            sequence, rows = item
+            stats['volumes'] += 1
+            if sequence != nextsequence:
+                stats['outoforder'] += 1
+            pending[sequence] = rows
+
+            while nextsequence in pending:
+                block.extend(pending.pop(nextsequence))
+                nextsequence += 1
+
+            if len(pending) > stats['maxpending']:
+                stats['maxpending'] = len(pending)
+                if len(pending) == backlogwarning:
+                    print('Feature writer is waiting for volume ' + str(nextsequence) + '; ' +
+                        str(len(pending)) + ' later volumes are buffered.')
+
+            if len(block) >= flushrows:
+                flush(f, writer)
+
+        # If a volume never arrived (e.g. a worker died), we still write
+        # everything we have, in order, rather than losing it.
+        for sequence in sorted(pending.keys()):
+            block.extend(pending[sequence])
+        if len(pending) > 0:
+            print('Feature writer never received volume ' + str(nextsequence) + '.')
+
+        if len(block) > 0:
+            flush(f, writer)
+
+    statsqueue.put(stats)
+
+class LongFormatWriter:
+
+    # Starts the writer process. Pass self.queue to worker processes
+    # (e.g. through a Pool initializer that calls attach_writer), have them
+    # call send_rows() once for every sequence number from zero up, and
+    # call close() in the parent when all the workers have finished.
+
+    def __init__(self, outpath, maxqueue = 256, flushrows = 100000, header = False, backlogwarning = 1000):
+        '''header: whether to begin a new file with a header row.
+        maxqueue: how many volumes can wait for the writer before
+        workers block.'''
+
+        self.queue = multiprocessing.Queue(maxsize = maxqueue)
+        self.statsqueue = multiprocessing.Queue()
+        self.process = multiprocessing.Process(target = writer_loop,
+            args = (self.queue, self.statsqueue, outpath, flushrows, header, backlogwarning))
+        self.process.start()
+
+    def close(self):
+        '''Waits for the writer to finish, and returns its statistics.'''
+
+        self.queue.put(None)
+        stats = self.statsqueue.get()
+        self.process.join()
+
+        busy = stats['writeseconds'] + stats['waitseconds']
+        if busy > 0:
+            stats['busyfraction'] = stats['writeseconds'] / busy
+        else:
+            stats['busyfraction'] = 0.0
+
+        return stats
+
+workerqueue = None
+
+def attach_writer(outqueue):
+    '''Call this in each worker process (e.g. as a Pool initializer).'''
+
+    global workerqueue
+    workerqueue = outqueue
+
+def send_rows(sequence, rows):
+    '''
+    Sends the rows for one volume to the writer. Returns the number of
+    seconds we had to wait because the writer's queue was full; if that
+    number is often above zero, the writer is the bottleneck.
+    '''
+
+    try:
+        workerqueue.put_nowait((sequence, rows))
+        return 0.0
+    except queue.Full:
+        start = time.time()
+        workerqueue.put((sequence, rows))
+        return time.time() - start
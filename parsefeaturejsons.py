@@ -6,33 +6,61 @@
 # created by HTRC, and convert them into a .csv that is easier to
 # manipulate
 
-import csv, os, sys, bz2, random, json
+import csv, os, sys, random, json, functools, time
 from collections import Counter
 
-import numpy as np
-import pandas as pd
+import efreader, snapshots, featurewriter, eftiming
 
-# import utils
-currentdir = os.path.dirname(__file__)
-libpath = os.path.join(currentdir, '../lib')
-sys.path.append(libpath)
-
-import SonicScrewdriver as utils
+# Importing this module is deliberately cheap, because every worker in a
+# spawned pool pays for it. numpy, scipy and multiprocessing are imported
+# inside the functions that use them, and the wordlists are loaded the
+# first time they're needed (see get_wordlists).
 
 abspath = os.path.abspath(__file__)
 thisdirectory = os.path.dirname(abspath)
 namepath = os.path.join(thisdirectory, 'PersonalNames.txt')
 placepath = os.path.join(thisdirectory, 'PlaceNames.txt')
 romanpath = os.path.join(thisdirectory, 'RomanNumerals.txt')
+wordlistsnapshot = os.path.join(thisdirectory, 'wordlists.snapshot')
+
+wordlists = None
+
+def read_wordlists():
+    '''Parses the wordlist text files.'''
+
+    lists = dict()
+    for name, path in [('personalnames', namepath), ('placenames', placepath), ('romannumerals', romanpath)]:
+        with open(path, encoding = 'utf-8') as f:
+            lists[name] = set([x.strip().lower() for x in f.readlines()])
+
+    return lists
+
+def get_wordlists():
+    '''
+    Returns a dictionary containing the sets personalnames, placenames
+    and romannumerals. They're read once per process, from a pickled
+    snapshot if it's newer than the text files (snapshots rebuilds it
+    if not).
+    '''
+
+    global wordlists
 
-with open(namepath, encoding = 'utf-8') as f:
-    personalnames = set([x.strip().lower() for x in f.readlines()])
+    if wordlists is None:
+        wordlists = snapshots.load_with_snapshot(wordlistsnapshot, [namepath, placepath, romanpath], read_wordlists)
 
-with open(placepath, encoding = 'utf-8') as f:
-    placenames = set([x.strip().lower() for x in f.readlines()])
+    return wordlists
 
-with open(romanpath, encoding = 'utf-8') as f:
-    romannumerals = set([x.strip().lower() for x in f.readlines()])
+def import_utils():
+    '''SonicScrewdriver sometimes lives in ../lib, so importing it means
+    changing sys.path; we only do that when it's actually needed.'''
+
+    currentdir = os.path.dirname(__file__)
+    libpath = os.path.join(currentdir, '../lib')
+    if libpath not in sys.path:
+        sys.path.append(libpath)
+
+    import SonicScrewdriver as utils
+    return utils
 
 daysoftheweek = {'monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday', 'sunday'}
 monthsoftheyear = {'january', 'february', 'march', 'april', 'may', 'june', 'july', 'august', 'september', 'october', 'november', 'december'}
@@ -43,6 +71,215 @@ monthsoftheyear = {'january', 'february', 'march', 'april', 'may', 'june', 'july
 # level.
 ficwords = {'me', 'my', 'i', 'you', 'your', 'she', 'her', 'hers', 'he', 'him', 'his', 'the', 'said'}
 
+# The structural features that PagelistFromJson calculates for each page,
+# in the order used for columns of get_structural_features(). Words
+# can also begin with '#' (e.g. #personalname), so we list these explicitly
+# rather than identifying them by prefix.
+structuralfeatures = ['#totaltokens', '#typetoken', '#absfromedge', '#pctfromedge',
+    '#absupper', '#pctupper', '#abstitle', '#pcttitle', '#linelength', '#ficpct',
+    '#typetokennormed', '#pcttitlenormed', '#linelengthnormed', '#totaltokensnormed',
+    '#ficpctnormed']
+structuralcolumn = {feature: j for j, feature in enumerate(structuralfeatures)}
+
+class TokenNormalizer:
+
+    # Does the same thing as the chain of membership tests that
+    # normalize_token used to run for every token, but merges all the
+    # wordlists into a single dictionary, and memoizes the result for
+    # each surface form. The same few hundred thousand forms recur across
+    # millions of pages, so most lookups are cache hits. The cache is an
+    # lru_cache, which gives us bounded eviction and hit/miss counts.
+
+    # Note that the table is compiled from the wordlists when the
+    # normalizer is created; if you change the wordlists afterward,
+    # call compile() again.
+
+    # A normalizer can also apply a translation table (e.g. American
+    # to British spellings) to the words it returns. That used to happen
+    # in write_volume_features, once per translator entry per volume;
+    # here it's once per distinct token, and then it's in the cache.
+
+    def __init__(self, romannumerals = False, cachesize = 500000, translator = None):
+        '''If romannumerals is True, we behave like normalize_token_for_page,
+        recognizing roman numerals but leaving uppercase I alone.
+        Otherwise we behave like normalize_token. Set cachesize to None
+        for an unbounded cache.
+
+        translator is a dictionary mapping normalized words to their
+        equivalents, as formerly passed to write_volume_features.'''
+
+        self.romannumerals = romannumerals
+        self.cachesize = cachesize
+        self.translator = translator
+        self.compile()
+
+    def compile(self):
+        '''Merges the wordlists into one table. Categories are inserted
+        in reverse order of precedence, so that when a word appears in
+        more than one list, the category that normalize_token would have
+        checked first wins.'''
+
+        lists = get_wordlists()
+
+        table = dict()
+        if self.romannumerals:
+            for word in lists['romannumerals']:
+                table[word] = "#romannumeral"
+        for word in lists['placenames']:
+            table[word] = "#placename"
+        for word in lists['personalnames']:
+            table[word] = "#personalname"
+        for word in monthsoftheyear:
+            table[word] = "#monthoftheyear"
+        for word in daysoftheweek:
+            table[word] = "#dayoftheweek"
+
+        self.table = table
+        self.tablesignature = None
+        uncachedlookup = self.uncached_lookup
+        uncachedplainlookup = self.uncached_plain_lookup
+        if eftiming.enabled:
+            uncachedlookup = eftiming.timed_lookup(uncachedlookup)
+            uncachedplainlookup = eftiming.timed_lookup(uncachedplainlookup)
+
+        self.lookup = functools.lru_cache(maxsize = self.cachesize)(uncachedlookup)
+
+        if self.translator:
+            self.translation = compile_translator(self.translator)
+            self.plainlookup = functools.lru_cache(maxsize = self.cachesize)(uncachedplainlookup)
+        else:
+            self.translation = None
+            self.plainlookup = self.lookup
+        # plainlookup never translates; VolumeFromJson uses it for
+        # headers, which write_volume_features never translated
+
+    def signature(self):
+        '''A hash of everything that determines what this normalizer
+        does, so that results cached on disk (see efcache) can tell
+        whether they were produced with the same wordlists.'''
+
+        if self.tablesignature is None:
+            import hashlib
+            digest = hashlib.sha1(str(self.romannumerals).encode('utf-8'))
+            for word, category in sorted(self.table.items()):
+                digest.update((word + '\t' + category + '\n').encode('utf-8'))
+            if self.translation is not None:
+                for word, equivalent in sorted(self.translation.items()):
+                    digest.update(('translate\t' + word + '\t' + equivalent + '\n').encode('utf-8'))
+            self.tablesignature = digest.hexdigest()
+
+        return self.tablesignature
+
+    def uncached_lookup(self, token):
+        '''Returns a tuple: the lowercased token (which callers
+        often need for counting types), and the normalized token.'''
+
+        lowertoken, normaltoken = self.uncached_plain_lookup(token)
+        if self.translation is not None:
+            normaltoken = self.translation.get(normaltoken, normaltoken)
+
+        return lowertoken, normaltoken
+
+    def uncached_plain_lookup(self, token):
+        '''The same, without translation.'''
+
+        if self.romannumerals and token == "I":
+            return "i", "i"
+            # uppercase I is not usually a roman numeral!
+
+        lowertoken = token.lower()
+        if len(lowertoken) < 1:
+            return lowertoken, lowertoken
+        elif lowertoken[0].isdigit() and lowertoken[-1].isdigit():
+            return lowertoken, "#arabicnumeral"
+        else:
+            return lowertoken, self.table.get(lowertoken, lowertoken)
+
+    def normalize(self, token):
+        return self.lookup(token)[1]
+
+    def cache_info(self):
+        '''Hits, misses, maxsize and currsize for the memo cache,
+        which is useful when deciding how big to make it.'''
+
+        return self.lookup.cache_info()
+
+    def clear_cache(self):
+        self.lookup.cache_clear()
+        self.plainlookup.cache_clear()
+
+def compile_translator(translator):
+    '''
+    Turns a translation table into one that maps each word directly to
+    its final form. write_volume_features used to apply the table one
+    entry at a time, in order, moving each word's count to its equivalent.
+    So if 'a' maps to 'b', and a later entry maps 'b' to 'c', 'a' ends up
+    as 'c'; but if the entry for 'b' comes first, 'a' stops at 'b'. We
+    follow each chain the same way, so the results are the same.
+    '''
+
+    position = {word: i for i, word in enumerate(translator.keys())}
+
+    compiled = dict()
+    for word, equivalent in translator.items():
+        here = position[word]
+        while equivalent in position and position[equivalent] > here:
+            here = position[equivalent]
+            equivalent = translator[equivalent]
+        if equivalent != word:
+            compiled[word] = equivalent
+
+    return compiled
+
+compiledtranslators = dict()
+
+def translate_counts(counts, translator):
+    '''Returns a new Counter in which words have been replaced by their
+    equivalents in translator. counts is left as it was. Compiled
+    tables are reused for as long as the same translator object is.'''
+
+    key = id(translator)
+    if key not in compiledtranslators or compiledtranslators[key][0] is not translator:
+        compiledtranslators[key] = (translator, compile_translator(translator))
+    compiled = compiledtranslators[key][1]
+
+    translated = Counter()
+    for word, value in counts.items():
+        translated[compiled.get(word, word)] += value
+
+    return translated
+
+normalizers = dict()
+
+def get_normalizer(romannumerals = False, translator = None):
+    '''Returns the TokenNormalizer shared by all the volumes parsed in a
+    process, so the memo cache carries over from one volume to the next.
+    It's created on first use. There's one for each translator, which
+    is identified by the object itself, so build it once and reuse it.'''
+
+    if not translator:
+        key = romannumerals
+    else:
+        key = (romannumerals, id(translator))
+
+    if key not in normalizers or normalizers[key].translator is not (translator or None):
+        normalizers[key] = TokenNormalizer(romannumerals = romannumerals, translator = translator or None)
+
+    return normalizers[key]
+
+def __getattr__(name):
+    '''Module-level names that used to be created at import time are
+    still available as attributes, but are created lazily.'''
+
+    if name in ('personalnames', 'placenames', 'romannumerals'):
+        return get_wordlists()[name]
+    elif name == 'volumenormalizer':
+        return get_normalizer(romannumerals = False)
+    elif name == 'pagenormalizer':
+        return get_normalizer(romannumerals = True)
+    else:
+        raise AttributeError('module ' + repr(__name__) + ' has no attribute ' + repr(name))
+
 def normalize_token(token):
     ''' Normalizes a token by lowercasing it and by bundling
     certain categories together. The lists of personal and place names
@@ -50,23 +287,7 @@ def normalize_token(token):
     and deactivate this in corpora where it could pose a problem.
     '''
 
-    global personalnames, placenames, daysoftheweek, monthsoftheyear
-
-    token = token.lower()
-    if len(token) < 1:
-        return token
-    elif token[0].isdigit() and token[-1].isdigit():
-        return "#arabicnumeral"
-    elif token in daysoftheweek:
-        return "#dayoftheweek"
-    elif token in monthsoftheyear:
-        return "#monthoftheyear"
-    elif token in personalnames:
-        return "#personalname"
-    elif token in placenames:
-        return "#placename"
-    else:
-        return token
+    return get_normalizer(romannumerals = False).lookup(token)[1]
 
 def normalize_token_for_page(token):
     ''' Normalizes a token by lowercasing it and by bundling
@@ -74,29 +295,7 @@ def normalize_token_for_page(token):
     function in adding roman numerals.
     '''
 
-    global personalnames, placenames, daysoftheweek, monthsoftheyear, romannumerals
-
-    if token == "I":
-        return token.lower()
-        # uppercase I is not usually a roman numeral!
-
-    token = token.lower()
-    if len(token) < 1:
-        return token
-    elif token[0].isdigit() and token[-1].isdigit():
-        return "#arabicnumeral"
-    elif token in daysoftheweek:
-        return "#dayoftheweek"
-    elif token in monthsoftheyear:
-        return "#monthoftheyear"
-    elif token in personalnames:
-        return "#personalname"
-    elif token in placenames:
-        return "#placename"
-    elif token in romannumerals:
-        return "#romannumeral"
-    else:
-        return token
+    return get_normalizer(romannumerals = True).lookup(token)[1]
 
 class VolumeFromJson:
 
@@ -106,147 +305,378 @@ class VolumeFromJson:
     # Has been expanded in Jan 2017 by adding the default argument
     # pagestoinclude
 
-    def __init__(self, volumepath, volumeid, pagestoinclude = set()):
+    # With compact = True, words are interned as integer ids in a
+    # Vocabulary, and each page is stored as a pair of numpy arrays (ids and
+    # counts) in self.pageids and self.pagevalues instead of as a Counter.
+    # Volume totals are then a vectorized reduction over those arrays, kept
+    # in self.totalids and self.totalvalues. pagecounts and totalcounts
+    # still work, but in that mode they are built on demand as views.
+
+    # Keeping every page's counts is what makes a worker's memory grow
+    # with the length of the volume, and most callers only want totals.
+    # With pagestorage = 'none', pages are added to the totals and then
+    # discarded (self.pagecounts is None). With pagestorage = 'spill',
+    # each page is written as an array of ids and an array of counts to
+    # an anonymous temporary file, which is memory-mapped when the volume
+    # is finished; pagecounts and get_page_arrays() then read from it.
+
+    def __init__(self, volumepath, volumeid, pagestoinclude = set(), streaming = False, normalizer = None, compact = False, vocabulary = None, cache = None, pagestorage = 'memory', spillfolder = None, translator = None):
         '''Initializes a LoadedVolume by reading wordcounts from
         a json file. By default it reads all the pages. But if
         a set of pagestoinclude is passed in, it will read only page numbers
-        belonging to that set.'''
+        belonging to that set.
+
+        If streaming is True, pages are decoded one at a time from
+        the (possibly compressed) file instead of loading the whole
+        json, so memory use is bounded by the largest page rather
+        than the whole volume. The results are the same either way.
+        Pages outside pagestoinclude are never decoded at all.
+
+        normalizer is a TokenNormalizer; by default we use the one
+        shared by every volume in this process. If translator is
+        provided (and normalizer isn't), words are translated as they're
+        counted, by a shared normalizer for that translator; see
+        write_volume_features.
+
+        If compact is True, counts are stored as arrays of ids from
+        vocabulary (by default, one Vocabulary shared by every volume in
+        this process).
+
+        cache is an efcache.ResultCache; if the volume has been parsed
+        before with the same settings, we load it from there instead.
+        The cache is only used when pagestorage is 'memory'.
+
+        pagestorage is 'memory', 'none' or 'spill' (see above); spill
+        files are created in spillfolder, by default the system's
+        temporary folder.
+
+        If volumepath is None, nothing is read: the caller (e.g.
+        extract_views) adds pages and calls finish_volume() itself.
+        volumepath can also be an open binary file, e.g. a member of a
+        shard (see efsources); such volumes aren't cached. The same goes
+        for the other volume classes.'''
+
+        if normalizer is None:
+            normalizer = get_normalizer(romannumerals = False, translator = translator)
+        self.normalizer = normalizer
+
+        self.compact = compact
+        if compact and vocabulary is None:
+            vocabulary = get_shared_vocabulary()
+        self.vocabulary = vocabulary
+
+        if pagestorage not in ('memory', 'none', 'spill'):
+            raise ValueError('pagestorage must be memory, none or spill, not ' + str(pagestorage))
+        self.pagestorage = pagestorage
+        self.spillfolder = spillfolder
+        if pagestorage != 'memory':
+            cache = None
+
+        if volumepath is None:
+            self.start_volume(pagestoinclude)
+            self.volumeid = volumeid
+            self.numpages = 0
+            return
+
+        timer = eftiming.volume_timer(volumeid, 'volume')
+        # None unless timing is enabled; see eftiming
+
+        if cache is not None and cache.restore_volume(self, volumepath, pagestoinclude):
+            if timer is not None:
+                timer.lap('cache')
+                timer.count('tokens', self.totaltokens)
+                timer.done()
+            return
+
+        self.start_volume(pagestoinclude)
+
+        if streaming or self.pagestoinclude is not None:
+            # When only some pages are wanted, we stream even if not asked
+            # to, because the stream can skip excluded pages without
+            # decoding them.
+
+            with efreader.open_volume(volumepath) as f:
+                stream = efreader.VolumeStream(f)
+                for thispage in stream.pages(include = self.admit_page):
+                    if thispage is not None:
+                        if timer is not None:
+                            timer.lap('stream')
+                        self.count_page(thispage)
+                        if timer is not None:
+                            timer.lap('count')
+
+            if timer is not None:
+                timer.lap('stream')
+
+            self.volumeid = stream.fields['id']
+            self.numpages = stream.numpages
 
-        if volumepath.endswith('bz2'):
-            with bz2.open(volumepath, mode = 'rt', encoding = 'utf-8') as f:
-                thestring = f.read()
         else:
-            with open(volumepath, encoding = 'utf-8') as f:
+            with efreader.open_volume(volumepath) as f:
                 thestring = f.read()
 
-        thejson = json.loads(thestring)
+            if timer is not None:
+                timer.lap('read')
 
-        self.volumeid = thejson['id']
+            thejson = json.loads(thestring)
+
+            if timer is not None:
+                timer.lap('decode')
+
+            self.volumeid = thejson['id']
+
+            pagedata = thejson['features']['pages']
+            self.numpages = len(pagedata)
+
+            for thispage in pagedata:
+                self.add_page(thispage)
+
+            if timer is not None:
+                timer.lap('count')
+
+        self.finish_volume()
+
+        if timer is not None:
+            timer.lap('finish')
+
+        if cache is not None:
+            cache.save_volume(self, volumepath, pagestoinclude)
+
+        if timer is not None:
+            if cache is not None:
+                timer.lap('cache')
+            timer.count('tokens', self.totaltokens)
+            timer.count('pages', self.numpages)
+            timer.done()
+
+        # We are done with the __init__ method for this volume.
+
+        # When I get a better feature sample, we'll add some information about initial
+        # capitalization.
+
+    def start_volume(self, pagestoinclude):
+        '''Sets up the counters that add_page() accumulates into.'''
+
+        if self.compact:
+            import numpy as np
+            self.pageids = []
+            self.pagevalues = []
+            self.pagecounts = None
+            self.totalcounts = None
+            self.totalids = np.zeros(0, dtype = np.int32)
+            self.totalvalues = np.zeros(0, dtype = np.int64)
+        elif self.pagestorage == 'memory':
+            self.pagecounts = []
+            self.totalcounts = Counter()
+        else:
+            self.pagecounts = None
+            self.totalcounts = Counter()
+
+        self.spillfiles = None
+        self.spilllengths = []
+        self.cachedpages = None
+        # (indptr, ids, values, tokens) for a volume restored from a cache
+        if self.pagestorage == 'spill' and not self.compact:
+            self.spillvocabulary = Vocabulary()
+            # a spilled page needs integer ids, even if we're not compact
+        else:
+            self.spillvocabulary = self.vocabulary
 
-        pagedata = thejson['features']['pages']
-        self.numpages = len(pagedata)
-        self.pagecounts = []
-        self.totalcounts = Counter()
         self.totaltokens = 0
         self.bodytokens = 0
 
         self.sentencecount = 0
         self.linecount = 0
-        typetokenratios = []
+        self.typetokenratios = []
 
-        chunktokens = 0
-        typesinthischunk = set()
+        self.chunktokens = 0
+        self.typesinthischunk = set()
         # a set of types in the current 10k-word chunk; progress
         # toward which is tracked by chunktokens
 
         self.integerless_pages = 0
         self.out_of_order_pages = 0
         self.skipped_pages = 0
-        compromise_pg = 0
+        self.compromise_pg = 0
 
         if len(pagestoinclude) < 1:
-            pagestoinclude = set([x+1 for x in range(self.numpages)])
+            self.pagestoinclude = None
+        else:
+            self.pagestoinclude = pagestoinclude
         # If an empty set was passed in, or no set was provided,
-        # include all pages. the x+1 is because pages start counting
-        # at one, not zero.
+        # include all pages. We don't need to know how many pages
+        # there are to do that, because compromise_pg can never
+        # exceed the number of pages; it just has to be at least one,
+        # because pages start counting at one, not zero.
+
+    def admit_page(self, seq):
+        '''Decides whether a page belongs in the volume, given only its
+        seq, and keeps track of pages that are skipped or oddly numbered.
+        Because this doesn't need the rest of the page, a VolumeStream can
+        call it before decoding anything.'''
+
+        # There are really two ways of numbering pages. They come in an order,
+        # which gives them an inherent ordinality (this is the *first* page). But
+        # they also have cardinal *labels* attached, in the "seq" field. These labels
+        # are usually, but not necessarily, convertible to integers. (Usually "00000001",
+        # but could be "notes.") *Usually* they are == to the ordinal number,
+        # but again, not necessarily.
+
+        # Here, cardinal_page is the cardinal label; its value will be -1 if it
+        # can't be converted to an integer.
+
+        # compromise_pg skips pages that have no integer seq, but otherwise
+        # proceeds ordinally
+
+        try:
+            cardinal_page = int(seq)
+        except:
+            cardinal_page = -1
+
+        if cardinal_page > 0:
+            self.compromise_pg += 1
+        elif cardinal_page < 0:
+            self.integerless_pages += 1
+
+        compromise_pg = self.compromise_pg
+
+        if compromise_pg != cardinal_page:
+            self.out_of_order_pages += 1
+
+        if self.pagestoinclude is None:
+            included = compromise_pg > 0
+        else:
+            included = compromise_pg in self.pagestoinclude
 
-        for i in range(self.numpages):
-            thispagecounts = Counter()
-            thisbodytokens = 0
-            thisheadertokens = 0
-            thispage = pagedata[i]
+        if cardinal_page >= 0 and included:
+            return True
+        else:
+            # print(cardinal_page, compromise_pg)
+            self.skipped_pages += 1
+            return False
 
-            # There are really two ways of numbering pages. They come in an order,
-            # which gives them an inherent ordinality (this is the *first* page). But
-            # they also have cardinal *labels* attached, in the "seq" field. These labels
-            # are usually, but not necessarily, convertible to integers. (Usually "00000001",
-            # but could be "notes.") *Usually* they are == to the ordinal number,
-            # but again, not necessarily.
+    def add_page(self, thispage):
+        '''Counts the words on one page of the json, if it belongs
+        in the volume.'''
 
-            # In this loop, i is the ordinal page number, and cardinal_page is the cardinal
-            # label; its value will be -1 if it can't be converted to an integer.
+        if self.admit_page(thispage.get('seq')):
+            self.count_page(thispage)
 
-            # compromise_pg skips pages that have no integer seq, but otherwise
-            # proceeds ordinally
+    def count_page(self, thispage):
+        '''Counts the words on a page that has already been admitted.'''
 
-            try:
-                cardinal_page = int(thispage['seq'])
-            except:
-                cardinal_page = -1
-
-            if cardinal_page > 0:
-                compromise_pg += 1
-            elif cardinal_page < 0:
-                self.integerless_pages += 1
-
-            if compromise_pg != cardinal_page:
-                self.out_of_order_pages += 1
-
-            if cardinal_page >= 0 and compromise_pg in pagestoinclude:
-
-                linesonpage = int(thispage['lineCount'])
-                sentencesonpage = int(thispage['body']['sentenceCount'])
-                self.sentencecount += sentencesonpage
-                self.linecount += linesonpage
-                # I could look for sentences in the header or footer, but I think
-                # that would overvalue accidents of punctuation.
-
-                bodywords = thispage['body']['tokenPosCount']
-                for token, partsofspeech in bodywords.items():
-                    lowertoken = token.lower()
-                    typesinthischunk.add(lowertoken)
-                    # we do that to keep track of types -- notably, before nortmalizing
-                    normaltoken = normalize_token(lowertoken)
-
-                    for part, count in partsofspeech.items():
-                        thisbodytokens += count
-                        chunktokens += count
-                        thispagecounts[normaltoken] += count
-
-                        if chunktokens > 10000:
-                            typetoken = len(typesinthischunk) / chunktokens
-                            typetokenratios.append(typetoken)
-                            typesinthischunk = set()
-                            chunktokens = 0
-
-                            # generally speaking we count typetoken ratios on 10000-word chunks
-
-                headerwords = thispage['header']['tokenPosCount']
-                for token, partsofspeech in headerwords.items():
-                    lowertoken = token.lower()
-                    normaltoken = "#header" + normalize_token(lowertoken)
-
-                    for part, count in partsofspeech.items():
-                        thisheadertokens += count
-                        thispagecounts[normaltoken] += count
-
-                # You will notice that I treat footers (mostly) as part of the body
-                # Footers are rare, and rarely interesting.
-
-                footerwords = thispage['footer']['tokenPosCount']
-                for token, partsofspeech in footerwords.items():
-                    lowertoken = token.lower()
-                    typesinthischunk.add(lowertoken)
-                    # we do that to keep track of types -- notably before nortmalizing
-                    normaltoken = normalize_token(lowertoken)
-
-                    for part, count in partsofspeech.items():
-                        thisbodytokens += count
-                        chunktokens += count
-                        thispagecounts[normaltoken] += count
+        thispagecounts = Counter()
+        thisbodytokens = 0
+        thisheadertokens = 0
 
+        chunktokens = self.chunktokens
+        typesinthischunk = self.typesinthischunk
+        typetokenratios = self.typetokenratios
+        lookup = self.normalizer.lookup
+        plainlookup = self.normalizer.plainlookup
+
+        if self.compact:
+            intern = self.vocabulary.add
+        else:
+            intern = None
+
+        linesonpage = int(thispage['lineCount'])
+        sentencesonpage = int(thispage['body']['sentenceCount'])
+        self.sentencecount += sentencesonpage
+        self.linecount += linesonpage
+        # I could look for sentences in the header or footer, but I think
+        # that would overvalue accidents of punctuation.
+
+        bodywords = thispage['body']['tokenPosCount']
+        for token, partsofspeech in bodywords.items():
+            lowertoken, normaltoken = lookup(token)
+            typesinthischunk.add(lowertoken)
+            # we do that to keep track of types -- notably, before nortmalizing
+            if intern is not None:
+                normaltoken = intern(normaltoken)
+
+            for part, count in partsofspeech.items():
+                thisbodytokens += count
+                chunktokens += count
+                thispagecounts[normaltoken] += count
+
+                if chunktokens > 10000:
+                    typetoken = len(typesinthischunk) / chunktokens
+                    typetokenratios.append(typetoken)
+                    typesinthischunk = set()
+                    chunktokens = 0
+
+                    # generally speaking we count typetoken ratios on 10000-word chunks
+
+        headerwords = thispage['header']['tokenPosCount']
+        for token, partsofspeech in headerwords.items():
+            lowertoken, normaltoken = plainlookup(token)
+            normaltoken = "#header" + normaltoken
+            if intern is not None:
+                normaltoken = intern(normaltoken)
+
+            for part, count in partsofspeech.items():
+                thisheadertokens += count
+                thispagecounts[normaltoken] += count
+
+        # You will notice that I treat footers (mostly) as part of the body
+        # Footers are rare, and rarely interesting.
+
+        footerwords = thispage['footer']['tokenPosCount']
+        for token, partsofspeech in footerwords.items():
+            lowertoken, normaltoken = lookup(token)
+            typesinthischunk.add(lowertoken)
+            # we do that to keep track of types -- notably before nortmalizing
+            if intern is not None:
+                normaltoken = intern(normaltoken)
+
+            for part, count in partsofspeech.items():
+                thisbodytokens += count
+                chunktokens += count
+                thispagecounts[normaltoken] += count
+
+        self.chunktokens = chunktokens
+        self.typesinthischunk = typesinthischunk
+
+        self.record_page(thispagecounts, thisbodytokens, thisheadertokens)
+
+    def record_page(self, thispagecounts, thisbodytokens, thisheadertokens):
+        '''Adds the counts for one page to the volume.'''
+
+        if self.compact:
+            import numpy as np
+            numkeys = len(thispagecounts)
+            self.pageids.append(np.fromiter(thispagecounts.keys(), dtype = np.int32, count = numkeys))
+            self.pagevalues.append(np.fromiter(thispagecounts.values(), dtype = np.int64, count = numkeys))
+            if self.pagestorage == 'spill':
+                self.spill_page(self.pageids[-1], self.pagevalues[-1])
+            if self.pagestorage != 'memory' and len(self.pageids) >= 100:
+                self.sum_compact_counts()
+                # which folds these pages into the totals and lets them go
+        else:
+            if self.pagestorage == 'memory':
                 self.pagecounts.append(thispagecounts)
+            elif self.pagestorage == 'spill':
+                import numpy as np
+                numkeys = len(thispagecounts)
+                intern = self.spillvocabulary.add
+                ids = np.fromiter((intern(x) for x in thispagecounts.keys()), dtype = np.int32, count = numkeys)
+                self.spill_page(ids, np.fromiter(thispagecounts.values(), dtype = np.int64, count = numkeys))
 
-                for key, value in thispagecounts.items():
-                    self.totalcounts[key] += value
+            for key, value in thispagecounts.items():
+                self.totalcounts[key] += value
 
-                self.totaltokens += thisbodytokens
-                self.totaltokens += thisheadertokens
-                self.bodytokens += thisbodytokens
+        self.totaltokens += thisbodytokens
+        self.totaltokens += thisheadertokens
+        self.bodytokens += thisbodytokens
 
-            else:
-                # print(i, cardinal_page, compromise_pg)
-                self.skipped_pages += 1
+    def finish_volume(self):
+        '''Calculates volume-level statistics once all the pages
+        have been added.'''
+
+        typetokenratios = self.typetokenratios
+        chunktokens = self.chunktokens
+        typesinthischunk = self.typesinthischunk
 
         if len(typetokenratios) < 1 or chunktokens > 5000:
             # After all pages are counted, we may be left with a
@@ -278,35 +708,145 @@ class VolumeFromJson:
         self.sentencelength = self.bodytokens / (self.sentencecount + 1)
         self.linelength = self.totaltokens / self.linecount
 
-        # We are done with the __init__ method for this volume.
-
-        # When I get a better feature sample, we'll add some information about initial
-        # capitalization.
+        if self.compact:
+            self.sum_compact_counts()
+
+        if self.pagestorage == 'spill':
+            self.map_spilled_pages()
+
+    def sum_compact_counts(self):
+        '''Adds up page arrays into volume totals: the distinct ids that
+        occur in the volume, and their counts. Unless we're keeping pages
+        in memory, the page arrays are discarded once they're counted.'''
+
+        import numpy as np
+
+        if len(self.pageids) < 1:
+            return
+
+        allids = np.concatenate([self.totalids] + self.pageids)
+        allvalues = np.concatenate([self.totalvalues] + self.pagevalues)
+        self.totalids, inverse = np.unique(allids, return_inverse = True)
+        self.totalvalues = np.bincount(inverse, weights = allvalues).astype(np.int64)
+
+        if self.pagestorage != 'memory':
+            self.pageids = []
+            self.pagevalues = []
+
+    def spill_page(self, ids, values):
+        '''Appends one page's arrays to the spill files.'''
+
+        if self.spillfiles is None:
+            import tempfile
+            self.spillfiles = (tempfile.TemporaryFile(dir = self.spillfolder), tempfile.TemporaryFile(dir = self.spillfolder))
+
+        self.spillfiles[0].write(ids.tobytes())
+        self.spillfiles[1].write(values.tobytes())
+        self.spilllengths.append(len(ids))
+
+    def map_spilled_pages(self):
+        '''Memory-maps the spill files, once all pages are written.'''
+
+        import numpy as np
+
+        self.spillindptr = np.zeros(len(self.spilllengths) + 1, dtype = np.int64)
+        np.cumsum(self.spilllengths, out = self.spillindptr[1: ])
+        numentries = int(self.spillindptr[-1])
+
+        if numentries < 1:
+            self.spilledids = np.zeros(0, dtype = np.int32)
+            self.spilledvalues = np.zeros(0, dtype = np.int64)
+            return
+
+        for f in self.spillfiles:
+            f.flush()
+        self.spilledids = np.memmap(self.spillfiles[0], dtype = np.int32, mode = 'r', shape = (numentries,))
+        self.spilledvalues = np.memmap(self.spillfiles[1], dtype = np.int64, mode = 'r', shape = (numentries,))
+
+    def get_page_arrays(self, pagenum):
+        '''For a volume whose pages were spilled, returns the ids and
+        counts for one page, read from the memory-mapped spill files.
+        Ids index into self.spillvocabulary.'''
+
+        start = self.spillindptr[pagenum]
+        end = self.spillindptr[pagenum + 1]
+        return self.spilledids[start: end], self.spilledvalues[start: end]
+
+    def counter_from_arrays(self, ids, values, vocabulary = None):
+        if vocabulary is None:
+            vocabulary = self.vocabulary
+        tokens = vocabulary.tokens
+        return Counter({tokens[i]: v for i, v in zip(ids.tolist(), values.tolist())})
+
+    @property
+    def totalcounts(self):
+        '''A Counter of words in the volume. In compact mode this is
+        built from the arrays the first time it's requested.'''
+
+        if self.totalcountsview is None and self.compact:
+            self.totalcountsview = self.counter_from_arrays(self.totalids, self.totalvalues)
+        return self.totalcountsview
+
+    @totalcounts.setter
+    def totalcounts(self, counts):
+        self.totalcountsview = counts
+
+    @property
+    def pagecounts(self):
+        '''A list of Counters, one per page. In compact mode, or if
+        pages were spilled or restored from a cache, this is built from
+        the arrays each time it's requested. If pages weren't kept, it's
+        None.'''
+
+        if self.pagecountsview is None and self.cachedpages is not None:
+            import efcache
+            return efcache.arrays_to_counters(*self.cachedpages)
+        if self.pagecountsview is None and self.pagestorage == 'spill':
+            return [self.counter_from_arrays(*self.get_page_arrays(i), vocabulary = self.spillvocabulary) for i in range(len(self.spilllengths))]
+        if self.pagecountsview is None and self.compact and self.pagestorage == 'memory':
+            return [self.counter_from_arrays(ids, values) for ids, values in zip(self.pageids, self.pagevalues)]
+        return self.pagecountsview
+
+    @pagecounts.setter
+    def pagecounts(self, counts):
+        self.pagecountsview = counts
 
     def write_volume_features(self, outpath, override = False, translator = dict()):
         ''' This writes volume features while normalizing word frequencies,
         after using a translation table to, for instance, convert American spellings
         to British.
+
+        It's cheaper to translate words as they're counted, by passing
+        the translator to VolumeFromJson instead. If a translator is
+        passed here, we translate a copy of the counts; the volume itself
+        is no longer changed.
         '''
         if os.path.isfile(outpath) and not override:
             print('Error: you are asking me to override an existing')
             print('file without explicitly specifying to do so in your')
             print('invocation of write_volume_features.')
 
-        for word, equivalent in translator.items():
-            if word in self.totalcounts:
-                self.totalcounts[equivalent] += self.totalcounts.pop(word)
+        if eftiming.enabled:
+            start = time.perf_counter()
+
+        if translator:
+            totalcounts = translate_counts(self.totalcounts, translator)
+        else:
+            totalcounts = self.totalcounts
 
         with open(outpath, mode = 'w', encoding = 'utf-8') as f:
             writer = csv.writer(f)
             writer.writerow(['feature', 'count'])
-            for key, value in self.totalcounts.items():
+            for key, value in totalcounts.items():
                 if value > 0:
                     writer.writerow([key, value / self.totaltokens])
             writer.writerow(['#sentencelength', self.sentencelength])
             writer.writerow(['#typetoken', self.typetoken])
             writer.writerow(['#linelength', self.linelength])
 
+        if eftiming.enabled:
+            eftiming.record_phase(self.volumeid, 'volume', 'write', time.perf_counter() - start)
+
     def get_raw_body_features(self):
         '''
         Return features sans normalization.
@@ -349,23 +889,101 @@ class VolumeFromJson:
         incorporating a column that distinguishes them by docid.
         '''
 
+        if eftiming.enabled:
+            start = time.perf_counter()
+
         with open(outpath, mode = 'a', encoding = 'utf-8') as f:
             writer = csv.writer(f)
-            for key, value in self.totalcounts.items():
-                writer.writerow([self.volumeid, key, value / self.totaltokens])
-            writer.writerow([self.volumeid, '#sentencelength', self.sentencelength])
-            writer.writerow([self.volumeid, '#typetoken', self.typetoken])
-            writer.writerow([self.volumeid, '#linelength', self.linelength])
+            writer.writerows(self.get_long_rows())
+
+        if eftiming.enabled:
+            eftiming.record_phase(self.volumeid, 'volume', 'write', time.perf_counter() - start)
+
+    def get_long_rows(self):
+        '''
+        Returns the rows that append_volume_features writes, as a list, so
+        they can be sent to a featurewriter.LongFormatWriter instead.
+        '''
+
+        rows = []
+        for key, value in self.totalcounts.items():
+            rows.append([self.volumeid, key, value / self.totaltokens])
+        rows.append([self.volumeid, '#sentencelength', self.sentencelength])
+        rows.append([self.volumeid, '#typetoken', self.typetoken])
+        rows.append([self.volumeid, '#linelength', self.linelength])
+
+        return rows
+
+
+class Vocabulary:
+
+    # An interning table that maps tokens to integer ids, for use as the
+    # columns of a sparse page-by-word matrix. It grows as new words are
+    # seen, so one Vocabulary can be shared by many volumes, and their
+    # matrices will line up without any realignment.
+
+    def __init__(self, tokens = [], growable = True):
+        '''If growable is False, tokens not already in the vocabulary
+        are simply ignored, which is what you want when featurizing
+        against a fixed model vocabulary.'''
+
+        self.ids = dict()
+        self.tokens = []
+        for token in tokens:
+            self.add(token)
+        self.growable = growable
+
+    def add(self, token):
+        '''Returns the id for token, assigning a new one if necessary.'''
+
+        if token in self.ids:
+            return self.ids[token]
+        else:
+            tokenid = len(self.tokens)
+            self.ids[token] = tokenid
+            self.tokens.append(token)
+            return tokenid
+
+    def get(self, token):
+        '''Returns the id for token, or -1 if it is absent and the
+        vocabulary isn't growable.'''
 
+        tokenid = self.ids.get(token, -1)
+        if tokenid < 0 and self.growable:
+            tokenid = self.add(token)
+        return tokenid
 
-def log_tokens_for_page(pagejson, pagedict, typesonpage, ficcount, headerflag):
+    def __len__(self):
+        return len(self.tokens)
+
+    def __contains__(self, token):
+        return token in self.ids
+
+sharedvocabulary = None
+
+def get_shared_vocabulary():
+    '''Returns the Vocabulary shared by compact volumes in this process.'''
+
+    global sharedvocabulary
+
+    if sharedvocabulary is None:
+        sharedvocabulary = Vocabulary()
+
+    return sharedvocabulary
+
+def log_tokens_for_page(pagejson, pagedict, typesonpage, ficcount, headerflag, normalizer = None):
     '''
     Takes data from the pagejson and logs it appropriately in pagedict
-    and typesonpage.
+    and typesonpage. normalizer is a TokenNormalizer with roman numerals
+    turned on; by default, the shared pagenormalizer.
     '''
 
     global ficwords
 
+    if normalizer is None:
+        normalizer = get_normalizer(romannumerals = True)
+    lookup = normalizer.lookup
+
     for token, partsofspeech in pagejson.items():
 
         if token.istitle():
@@ -378,14 +996,13 @@ def log_tokens_for_page(pagejson, pagedict, typesonpage, ficcount, headerflag):
         else:
             upperflag = False
 
-        lowertoken = token.lower()
+        lowertoken, normaltoken = lookup(token)
+        # we don't want to *send in* a lowercased token, because
+        # the page normalizer treats uppercase I specially
+
         typesonpage.add(lowertoken)
         # we do that to keep track of types -- notably, before normalizing
 
-        normaltoken = normalize_token_for_page(token)
-        # normalizing also lowercases the token, but we don't
-        # want to *send in* a lowercased token
-
         for part, count in partsofspeech.items():
             if headerflag:
                 pagedict['headertokens'] += count
@@ -409,16 +1026,40 @@ class PagelistFromJson:
     # A data object that contains page-level wordcounts
     # for a volume,
 
-    def __init__(self, volumepath, volumeid):
+    def __init__(self, volumepath, volumeid, normalizer = None, cache = None):
         '''initializes a LoadedVolume by reading wordcounts from
-        a json file'''
+        a json file. normalizer is a TokenNormalizer with roman
+        numerals turned on; by default, the shared pagenormalizer.
+        cache is an efcache.ResultCache, as for VolumeFromJson.
 
-        if volumepath.endswith('bz2'):
-            with bz2.open(volumepath, mode = 'rt', encoding = 'utf-8') as f:
-                thestring = f.read()
-        else:
-            with open(volumepath, encoding = 'utf-8') as f:
-                thestring = f.read()
+        If volumepath is None, nothing is read: the caller (e.g.
+        extract_views) calls start_pagelist(), adds pages, and calls
+        finish_pagelist() itself.'''
+
+        if normalizer is None:
+            normalizer = get_normalizer(romannumerals = True)
+        self.normalizer = normalizer
+
+        if volumepath is None:
+            self.volumeid = volumeid
+            self.start_pagelist(0)
+            return
+
+        timer = eftiming.volume_timer(volumeid, 'pagelist')
+
+        if cache is not None and cache.restore_pagelist(self, volumepath, normalizer):
+            assert self.volumeid == volumeid
+            if timer is not None:
+                timer.lap('cache')
+                timer.count('tokens', self.count_tokens())
+                timer.done()
+            return
+
+        with efreader.open_volume(volumepath) as f:
+            thestring = f.read()
+
+        if timer is not None:
+            timer.lap('read')
 
         thejson = json.loads(thestring)
         assert thejson['id'] == volumeid
@@ -426,12 +1067,54 @@ class PagelistFromJson:
         # although I could infer it, because I don't want
         #any surprises.
 
+        if timer is not None:
+            timer.lap('decode')
+
         self.volumeid = thejson['id']
 
         pagejsons = thejson['features']['pages']
-        self.numpages = len(pagejsons)
+        self.start_pagelist(len(pagejsons))
+
+        for i in range(self.numpages):
+            self.add_page(i, pagejsons[i])
+
+        if timer is not None:
+            timer.lap('count')
+
+        self.finish_pagelist()
+
+        if timer is not None:
+            timer.lap('finish')
+
+        if cache is not None:
+            cache.save_pagelist(self, volumepath, normalizer)
+
+        if timer is not None:
+            if cache is not None:
+                timer.lap('cache')
+            timer.count('tokens', self.count_tokens())
+            timer.count('pages', self.numpages)
+            timer.done()
+
+        # We are done with the __init__ method for this volume.
+
+        # When I get a better feature sample, we'll add some information about initial
+        # capitalization.
+
+    def start_pagelist(self, numpages):
+        '''Sets up empty pages, and the array of structural features
+        that add_page() fills in.'''
+
+        import numpy as np
+
+        self.numpages = numpages
         self.pages = []
-        self.features = []
+        self.features = None
+        # per-page dictionaries are only built if get_feature_list() asks for them
+
+        self.featurematrix = np.zeros((self.numpages, len(structuralfeatures)), order = 'F')
+        # pages x structuralfeatures; stored column by column, because
+        # we normalize a column at a time
 
         # in this data structure, a volume is a list of pages
 
@@ -447,93 +1130,91 @@ class PagelistFromJson:
             pagedata['headertokens'] = 0
             self.pages.append(pagedata)
 
-        for i in range(self.numpages):
-            pagedata = self.pages[i]
-            thispage = pagejsons[i]
-
-            typesonpage = set()
-            ficcount = 0
-
-            pagedata['lines'] = int(thispage['lineCount'])
-            pagedata['sentences'] = int(thispage['body']['sentenceCount'])
-            # I could look for sentences in the header or footer, but I think
-            # that would overvalue accidents of punctuation.
+    def add_page(self, i, thispage):
+        '''Counts the words on the ith page of the json.'''
 
-            bodywords = thispage['body']['tokenPosCount']
-            ficcount = log_tokens_for_page(bodywords, pagedata, typesonpage, ficcount, headerflag = False)
+        pagedata = self.pages[i]
+        normalizer = self.normalizer
 
-            headerwords = thispage['header']['tokenPosCount']
-            ficcount = log_tokens_for_page(headerwords, pagedata, typesonpage, ficcount, headerflag = True)
+        typesonpage = set()
+        ficcount = 0
 
-            footerwords = thispage['footer']['tokenPosCount']
-            ficcount = log_tokens_for_page(footerwords, pagedata, typesonpage, ficcount, headerflag = True)
+        pagedata['lines'] = int(thispage['lineCount'])
+        pagedata['sentences'] = int(thispage['body']['sentenceCount'])
+        # I could look for sentences in the header or footer, but I think
+        # that would overvalue accidents of punctuation.
 
-            pagefeatures = dict()
-            # We don't directly return token counts, but normalize them
-            # in various ways
+        bodywords = thispage['body']['tokenPosCount']
+        ficcount = log_tokens_for_page(bodywords, pagedata, typesonpage, ficcount, headerflag = False, normalizer = normalizer)
 
-            totaltokens = pagedata['bodytokens'] + pagedata['headertokens']
+        headerwords = thispage['header']['tokenPosCount']
+        ficcount = log_tokens_for_page(headerwords, pagedata, typesonpage, ficcount, headerflag = True, normalizer = normalizer)
 
-            if totaltokens > 0:
-                for key, value in pagedata['tokens'].items():
-                    pagefeatures[key] = value / totaltokens
+        footerwords = thispage['footer']['tokenPosCount']
+        ficcount = log_tokens_for_page(footerwords, pagedata, typesonpage, ficcount, headerflag = True, normalizer = normalizer)
 
-            pagefeatures['#totaltokens'] = totaltokens
+        self.record_page(i, len(typesonpage), ficcount)
 
-            if totaltokens > 0:
-                pagefeatures['#typetoken'] = len(typesonpage) / totaltokens
-            else:
-                pagefeatures['#typetoken'] = 1
+    def record_page(self, i, numtypes, ficcount):
+        '''Calculates the structural features of the ith page, once its
+        words have been logged in self.pages[i].'''
 
-            pagefeatures['#absfromedge'] = min(i, self.numpages - i)
-            pagefeatures['#pctfromedge'] = pagefeatures['#absfromedge'] / self.numpages
+        pagedata = self.pages[i]
+        column = structuralcolumn
 
+        # We don't directly return token counts, but normalize them
+        # in various ways
 
-            pagefeatures['#absupper'] = pagedata['uppercase']
-            if totaltokens > 0:
-                pagefeatures['#pctupper'] = pagedata['uppercase'] / totaltokens
-            else:
-                pagefeatures['#pctupper'] = 0.5
+        totaltokens = pagedata['bodytokens'] + pagedata['headertokens']
+        row = self.featurematrix[i]
 
-            pagefeatures['#abstitle'] = pagedata['titlecase']
-            if totaltokens > 0:
-                pagefeatures['#pcttitle'] = pagedata['titlecase'] / totaltokens
-            else:
-                pagefeatures['#pcttitle'] = 0.5
+        row[column['#totaltokens']] = totaltokens
 
-            if pagedata['lines'] > 0:
-                pagefeatures['#linelength'] = totaltokens / pagedata['lines']
-            else:
-                pagefeatures['#linelength'] = 10
+        if totaltokens > 0:
+            row[column['#typetoken']] = numtypes / totaltokens
+        else:
+            row[column['#typetoken']] = 1
 
-            if totaltokens > 0:
-                pagefeatures['#ficpct'] = ficcount / totaltokens
-            else:
-                pagefeatures['#ficpct'] = 0
+        absfromedge = min(i, self.numpages - i)
+        row[column['#absfromedge']] = absfromedge
+        row[column['#pctfromedge']] = absfromedge / self.numpages
 
-            self.features.append(pagefeatures)
+        row[column['#absupper']] = pagedata['uppercase']
+        if totaltokens > 0:
+            row[column['#pctupper']] = pagedata['uppercase'] / totaltokens
+        else:
+            row[column['#pctupper']] = 0.5
 
-        # Some features also get recorded as Z values normalized by the mean and
-        # standard deviation for this volume.
+        row[column['#abstitle']] = pagedata['titlecase']
+        if totaltokens > 0:
+            row[column['#pcttitle']] = pagedata['titlecase'] / totaltokens
+        else:
+            row[column['#pcttitle']] = 0.5
 
-        tonormalize = ['#typetoken', '#pcttitle', '#linelength', '#totaltokens', '#ficpct']
-        for feature in tonormalize:
-            values = np.zeros(self.numpages)
-            for i in range(self.numpages):
-                pagefeatures = self.features[i]
-                values[i] = (pagefeatures[feature])
+        if pagedata['lines'] > 0:
+            row[column['#linelength']] = totaltokens / pagedata['lines']
+        else:
+            row[column['#linelength']] = 10
 
-            meanval = np.mean(values)
-            stdval = np.std(values) + .0001
+        if totaltokens > 0:
+            row[column['#ficpct']] = ficcount / totaltokens
+        else:
+            row[column['#ficpct']] = 0
 
-            normalizedfeature = feature + 'normed'
-            for i in range(self.numpages):
-                self.features[i][normalizedfeature] = (self.features[i][feature] - meanval) / stdval
+    def finish_pagelist(self):
+        '''Some features also get recorded as Z values normalized by the mean and
+        standard deviation for this volume. We do all of them at once.'''
 
-        # We are done with the __init__ method for this volume.
+        import numpy as np
 
-        # When I get a better feature sample, we'll add some information about initial
-        # capitalization.
+        tonormalize = ['#typetoken', '#pcttitle', '#linelength', '#totaltokens', '#ficpct']
+        if self.numpages > 0:
+            sourcecolumns = [structuralcolumn[feature] for feature in tonormalize]
+            normedcolumns = [structuralcolumn[feature + 'normed'] for feature in tonormalize]
+            values = self.featurematrix[ : , sourcecolumns]
+            meanvals = np.mean(values, axis = 0)
+            stdvals = np.std(values, axis = 0) + .0001
+            self.featurematrix[ : , normedcolumns] = (values - meanvals) / stdvals
 
     def get_feature_list(self):
         '''
@@ -542,8 +1223,301 @@ class PagelistFromJson:
         normalize them.
         '''
 
+        if self.features is None:
+            integercolumns = [structuralfeatures.index(x) for x in ['#totaltokens', '#absfromedge', '#absupper', '#abstitle']]
+            self.features = []
+            for pagedata, row in zip(self.pages, self.featurematrix.tolist()):
+                pagefeatures = dict()
+                totaltokens = pagedata['bodytokens'] + pagedata['headertokens']
+                if totaltokens > 0:
+                    for key, value in pagedata['tokens'].items():
+                        pagefeatures[key] = value / totaltokens
+                for j in integercolumns:
+                    row[j] = int(row[j])
+                pagefeatures.update(zip(structuralfeatures, row))
+                self.features.append(pagefeatures)
+
         return self.features
 
+    def count_tokens(self):
+        '''The number of tokens in the volume, headers and footers included.'''
+
+        return sum([x['bodytokens'] + x['headertokens'] for x in self.pages])
+
+    def get_feature_matrix(self):
+        '''
+        Returns the structural features of every page as a dense numpy
+        array, pages x structural features, with columns in the order of
+        the module-level list structuralfeatures. This is the array
+        PagelistFromJson keeps internally, so don't modify it.
+        '''
+
+        return self.featurematrix
+
+    def get_sparse_arrays(self, vocabulary):
+        '''
+        Returns the normalized word frequencies for this volume as the
+        three arrays of a CSR matrix without a shape: data, column indices
+        (ids from vocabulary), and the number of entries on each page.
+        Used by get_sparse_matrix() and stack_page_matrices().
+        '''
+
+        import numpy as np
+
+        data = []
+        indices = []
+        rowlengths = np.zeros(self.numpages, dtype = np.int64)
+
+        for i, pagedata in enumerate(self.pages):
+            totaltokens = pagedata['bodytokens'] + pagedata['headertokens']
+            if totaltokens < 1:
+                continue
+
+            before = len(indices)
+            for key, value in pagedata['tokens'].items():
+                tokenid = vocabulary.get(key)
+                if tokenid >= 0:
+                    indices.append(tokenid)
+                    data.append(value / totaltokens)
+            rowlengths[i] = len(indices) - before
+
+        return np.array(data, dtype = np.float64), np.array(indices, dtype = np.int32), rowlengths
+
+    def get_sparse_matrix(self, vocabulary):
+        '''
+        Returns the word features of every page as a scipy.sparse CSR
+        matrix, pages x vocabulary. Values are the same frequencies
+        that get_feature_list() reports. If vocabulary is growable, words
+        not yet in it are added, so the number of columns is the size of
+        the vocabulary after this volume has been included.
+        '''
+
+        import numpy as np
+        from scipy import sparse
+
+        data, indices, rowlengths = self.get_sparse_arrays(vocabulary)
+        indptr = np.zeros(self.numpages + 1, dtype = np.int64)
+        np.cumsum(rowlengths, out = indptr[1: ])
+
+        return sparse.csr_matrix((data, indices, indptr), shape = (self.numpages, len(vocabulary)))
+
+    def get_structural_features(self):
+        '''
+        Returns a dense numpy array, pages x structural features, with
+        columns in the order of the module-level list structuralfeatures.
+        '''
+
+        import numpy as np
+
+        return np.array(self.featurematrix, order = 'C')
+
+def stack_page_matrices(pagelists, vocabulary):
+    '''
+    Takes a list of PagelistFromJson objects and a shared Vocabulary,
+    and returns a tuple of three things:
+
+    1) a CSR matrix of word frequencies, (all pages) x vocabulary,
+    2) a dense array of structural features for the same pages, and
+    3) an array indicating which volume (by position in pagelists) each
+    row came from.
+
+    The sparse arrays for all volumes are concatenated and the matrix is
+    built once, so we never construct per-page dicts or intermediate
+    matrices.
+    '''
+
+    import numpy as np
+    from scipy import sparse
+
+    alldata = []
+    allindices = []
+    allrowlengths = []
+    structural = []
+    volumeindex = []
+
+    for volnum, pagelist in enumerate(pagelists):
+        data, indices, rowlengths = pagelist.get_sparse_arrays(vocabulary)
+        alldata.append(data)
+        allindices.append(indices)
+        allrowlengths.append(rowlengths)
+        structural.append(pagelist.get_structural_features())
+        volumeindex.append(np.full(pagelist.numpages, volnum, dtype = np.int32))
+
+    if len(pagelists) < 1:
+        return sparse.csr_matrix((0, len(vocabulary))), np.zeros((0, len(structuralfeatures))), np.zeros(0, dtype = np.int32)
+
+    matrix = csr_from_parts(alldata, allindices, allrowlengths, len(vocabulary))
+
+    return matrix, np.vstack(structural), np.concatenate(volumeindex)
+
+def csr_from_parts(alldata, allindices, allrowlengths, numcolumns):
+    '''Builds one CSR matrix from lists of the arrays returned by
+    get_sparse_arrays() for several volumes.'''
+
+    import numpy as np
+    from scipy import sparse
+
+    rowlengths = np.concatenate(allrowlengths)
+    indptr = np.zeros(len(rowlengths) + 1, dtype = np.int64)
+    np.cumsum(rowlengths, out = indptr[1: ])
+
+    return sparse.csr_matrix((np.concatenate(alldata), np.concatenate(allindices), indptr),
+        shape = (len(rowlengths), numcolumns))
+
+# BATCH PAGE FEATURIZATION
+
+# Training a page classifier needs page features for thousands of
+# volumes, aligned to one vocabulary. featurize_pages() does that in a
+# pool of worker processes. The vocabulary can have hundreds of
+# thousands of words, so rather than pickling it to every worker, the
+# parent writes it once into a block of shared memory (utf-8 text plus
+# an array of offsets), and each worker's initializer reads it from
+# there into a fixed Vocabulary. Workers send back only the sparse
+# arrays for each volume, which the parent stacks into one matrix.
+
+pagevocabulary = None
+# the fixed Vocabulary a page worker featurizes against
+
+def share_vocabulary(tokens):
+    '''Writes a list of tokens into a new block of shared memory, and
+    returns the SharedMemory object. The caller should unlink it when
+    the workers are done.'''
+
+    import numpy as np
+    from multiprocessing import shared_memory
+
+    encoded = [x.encode('utf-8') for x in tokens]
+    offsets = np.zeros(len(encoded) + 1, dtype = np.int64)
+    np.cumsum([len(x) for x in encoded], out = offsets[1: ])
+
+    headerbytes = 8 * (len(offsets) + 1)
+    block = shared_memory.SharedMemory(create = True, size = max(1, headerbytes + int(offsets[-1])))
+    header = np.ndarray(len(offsets) + 1, dtype = np.int64, buffer = block.buf)
+    header[0] = len(encoded)
+    header[1: ] = offsets
+    block.buf[headerbytes: headerbytes + int(offsets[-1])] = b''.join(encoded)
+    del header
+
+    return block
+
+def read_shared_vocabulary(name):
+    '''Reads the tokens written by share_vocabulary() into a list.'''
+
+    import numpy as np
+    from multiprocessing import shared_memory
+
+    block = shared_memory.SharedMemory(name = name)
+    try:
+        numtokens = int(np.ndarray(1, dtype = np.int64, buffer = block.buf)[0])
+        offsets = np.ndarray(numtokens + 1, dtype = np.int64, buffer = block.buf, offset = 8).tolist()
+        headerbytes = 8 * (numtokens + 2)
+        text = bytes(block.buf[headerbytes: headerbytes + offsets[-1]])
+        tokens = [text[start: end].decode('utf-8') for start, end in zip(offsets[ : -1], offsets[1: ])]
+    finally:
+        block.close()
+
+    return tokens
+
+def init_page_worker(vocabularyname, threads = 1, cachefolder = None, cachebytes = None, cachecounter = None):
+    '''Pool initializer for featurize_pages. cachecounter is the shared
+    counter of the cache's size (see efcache.ResultCache.shared_counter).'''
+
+    global pagevocabulary, resultcache
+
+    pagevocabulary = Vocabulary(read_shared_vocabulary(vocabularyname), growable = False)
+    efreader.decompressionthreads = threads
+    if cachefolder is not None:
+        import efcache
+        resultcache = efcache.ResultCache(cachefolder, maxbytes = cachebytes, sharedbytes = cachecounter)
+
+def featurize_pages_task(task):
+    '''
+    Takes (volnum, volumepath, volumeid), and returns (volnum, data,
+    indices, rowlengths, structural) for that volume's pages, or
+    (volnum, None, None, None, None) if it failed.
+    '''
+
+    volnum, volumepath, volumeid = task
+
+    try:
+        pagelist = PagelistFromJson(volumepath, volumeid, cache = resultcache)
+        data, indices, rowlengths = pagelist.get_sparse_arrays(pagevocabulary)
+        return volnum, data, indices, rowlengths, pagelist.get_structural_features()
+    except Exception as e:
+        print('Error processing ' + str(volumeid) + ': ' + repr(e))
+        return volnum, None, None, None, None
+
+def featurize_pages(volumes, vocabulary, workers = None, chunksize = 4, threads = 1, cache = None, cachebytes = 4 * 1024 ** 3):
+    '''
+    Featurizes the pages of many volumes against a fixed vocabulary,
+    in a pool of worker processes. volumes is a list of (volumepath,
+    volumeid) pairs; vocabulary is a Vocabulary or a list of tokens,
+    and words outside it are ignored. Returns a tuple of five things:
+
+    1) a CSR matrix of word frequencies, (all pages) x vocabulary,
+    2) a dense array of structural features for the same pages,
+    3) an array of the volume (by position in volumes) of each row,
+    4) an array of the position of each row's page in its volume, and
+    5) a list of the volumeids that failed, which contribute no rows.
+
+    Rows are in the order of volumes, exactly as stack_page_matrices()
+    would produce them. cache is a folder for efcache, as in
+    process_corpus.
+    '''
+
+    import numpy as np
+    from scipy import sparse
+    from multiprocessing import Pool
+
+    if isinstance(vocabulary, Vocabulary):
+        tokens = vocabulary.tokens
+    else:
+        tokens = list(vocabulary)
+
+    tasks = [(volnum, volumepath, volumeid) for volnum, (volumepath, volumeid) in enumerate(volumes)]
+    results = [None] * len(tasks)
+
+    cachecounter = None
+    if cache is not None:
+        import efcache
+        cachecounter = efcache.ResultCache(cache, maxbytes = cachebytes).shared_counter()
+
+    block = share_vocabulary(tokens)
+    try:
+        with Pool(processes = workers, initializer = init_page_worker, initargs = (block.name, threads, cache, cachebytes, cachecounter)) as pool:
+            for result in pool.imap_unordered(featurize_pages_task, tasks, chunksize = chunksize):
+                results[result[0]] = result
+    finally:
+        block.close()
+        block.unlink()
+
+    alldata = []
+    allindices = []
+    allrowlengths = []
+    structural = []
+    volumeindex = []
+    pageindex = []
+    failures = []
+
+    for volnum, data, indices, rowlengths, features in results:
+        if data is None:
+            failures.append(volumes[volnum][1])
+            continue
+        alldata.append(data)
+        allindices.append(indices)
+        allrowlengths.append(rowlengths)
+        structural.append(features)
+        volumeindex.append(np.full(len(rowlengths), volnum, dtype = np.int32))
+        pageindex.append(np.arange(len(rowlengths), dtype = np.int32))
+
+    if len(alldata) < 1:
+        return (sparse.csr_matrix((0, len(tokens))), np.zeros((0, len(structuralfeatures))),
+            np.zeros(0, dtype = np.int32), np.zeros(0, dtype = np.int32), failures)
+
+    matrix = csr_from_parts(alldata, allindices, allrowlengths, len(tokens))
+
+    return matrix, np.vstack(structural), np.concatenate(volumeindex), np.concatenate(pageindex), failures
+
 class LiteralVolumeFromJson:
 
     # Mainly a data object that contains page-level wordcounts
@@ -551,14 +1525,25 @@ class LiteralVolumeFromJson:
 
     def __init__(self, volumepath, volumeid):
         '''initializes a LoadedVolume by reading wordcounts from
-        a json file'''
+        a json file. If volumepath is None, nothing is read, and the
+        caller (e.g. extract_views) adds pages itself.'''
 
-        if volumepath.endswith('bz2'):
-            with bz2.open(volumepath, mode = 'rt', encoding = 'utf-8') as f:
-                thestring = f.read()
-        else:
-            with open(volumepath, encoding = 'utf-8') as f:
-                thestring = f.read()
+        self.pagecounts = []
+        self.totalcounts = Counter()
+        self.totaltokens = 0
+
+        if volumepath is None:
+            self.volumeid = volumeid
+            self.numpages = 0
+            return
+
+        timer = eftiming.volume_timer(volumeid, 'literal')
+
+        with efreader.open_volume(volumepath) as f:
+            thestring = f.read()
+
+        if timer is not None:
+            timer.lap('read')
 
         thejson = json.loads(thestring)
         assert thejson['id'] == volumeid
@@ -566,43 +1551,50 @@ class LiteralVolumeFromJson:
         # although I could infer it, because I don't want
         #any surprises.
 
+        if timer is not None:
+            timer.lap('decode')
+
         self.volumeid = thejson['id']
 
         pagedata = thejson['features']['pages']
         self.numpages = len(pagedata)
-        self.pagecounts = []
-        self.totalcounts = Counter()
-        self.totaltokens = 0
 
         for i in range(self.numpages):
-            thispagecounts = Counter()
-            thisbodytokens = 0
-            thisheadertokens = 0
-            thispage = pagedata[i]
+            self.add_page(pagedata[i])
 
-            linesonpage = int(thispage['lineCount'])
-            sentencesonpage = int(thispage['body']['sentenceCount'])
-            # I could look for sentences in the header or footer, but I think
-            # that would overvalue accidents of punctuation.
+        if timer is not None:
+            timer.lap('count')
+            timer.count('tokens', self.totaltokens)
+            timer.count('pages', self.numpages)
+            timer.done()
 
-            bodywords = thispage['body']['tokenPosCount']
-            for normaltoken, partsofspeech in bodywords.items():
+        # We are done with the __init__ method for this volume.
 
-                for part, count in partsofspeech.items():
-                    thisbodytokens += count
-                    thispagecounts[normaltoken] += count
+        # When I get a better feature sample, we'll add some information about initial
+        # capitalization.
 
-            self.pagecounts.append(thispagecounts)
+    def add_page(self, thispage):
+        '''Counts the body words on a page, exactly as they appear.'''
 
-            for key, value in thispagecounts.items():
-                self.totalcounts[key] += value
+        thispagecounts = Counter()
+        thisbodytokens = 0
 
-            self.totaltokens += thisbodytokens
+        bodywords = thispage['body']['tokenPosCount']
+        for normaltoken, partsofspeech in bodywords.items():
 
-        # We are done with the __init__ method for this volume.
+            for part, count in partsofspeech.items():
+                thisbodytokens += count
+                thispagecounts[normaltoken] += count
 
-        # When I get a better feature sample, we'll add some information about initial
-        # capitalization.
+        self.record_page(thispagecounts, thisbodytokens)
+
+    def record_page(self, thispagecounts, thisbodytokens):
+        self.pagecounts.append(thispagecounts)
+
+        for key, value in thispagecounts.items():
+            self.totalcounts[key] += value
+
+        self.totaltokens += thisbodytokens
 
     def write_volume_features(self, outpath, override = False):
         if os.path.isfile(outpath) and not override:
@@ -632,14 +1624,591 @@ class LiteralVolumeFromJson:
 
             return self.totalcounts, self.totaltokens
 
-if __name__ == "__main__":
+def extract_views(volumepath, volumeid, views = ('volume', 'pagelist', 'literal'), pagestoinclude = set(), normalizer = None, pagenormalizer = None, compact = False, vocabulary = None, translator = None):
+    '''
+    Our pipeline often needs a VolumeFromJson, a PagelistFromJson and a
+    LiteralVolumeFromJson for the same volume. Constructing them separately
+    decodes the file three times. This decodes it once, and counts every
+    page in a single pass over its tokenPosCount, filling in whichever of
+    the three views are requested. Returns a dictionary mapping each
+    requested view ('volume', 'pagelist' or 'literal') to an object that
+    is the same as the corresponding class would have produced.
+
+    pagestoinclude, compact, vocabulary and translator apply to the
+    volume view, as for VolumeFromJson; normalizer and pagenormalizer are the normalizers
+    for the volume and pagelist views.
+    '''
+
+    for view in views:
+        if view not in ('volume', 'pagelist', 'literal'):
+            raise ValueError('Unknown view: ' + str(view))
+
+    timer = eftiming.volume_timer(volumeid, 'views')
+
+    with efreader.open_volume(volumepath) as f:
+        thestring = f.read()
+
+    if timer is not None:
+        timer.lap('read')
+
+    thejson = json.loads(thestring)
+    assert thejson['id'] == volumeid
+
+    if timer is not None:
+        timer.lap('decode')
+
+    pagejsons = thejson['features']['pages']
+    numpages = len(pagejsons)
+
+    volume = None
+    pagelist = None
+    literal = None
+
+    if 'volume' in views:
+        volume = VolumeFromJson(None, volumeid, pagestoinclude = pagestoinclude, normalizer = normalizer,
+            compact = compact, vocabulary = vocabulary, translator = translator)
+        volume.numpages = numpages
+        vlookup = volume.normalizer.lookup
+        vplainlookup = volume.normalizer.plainlookup
+        typetokenratios = volume.typetokenratios
+        if compact:
+            intern = volume.vocabulary.add
+        else:
+            intern = None
+
+    if 'pagelist' in views:
+        pagelist = PagelistFromJson(None, volumeid, normalizer = pagenormalizer)
+        pagelist.start_pagelist(numpages)
+        plookup = pagelist.normalizer.lookup
+
+    if 'literal' in views:
+        literal = LiteralVolumeFromJson(None, volumeid)
+        literal.numpages = numpages
+
+    for i, thispage in enumerate(pagejsons):
+
+        # The volume view may leave out some pages; the others never do.
+        involume = volume is not None and volume.admit_page(thispage.get('seq'))
+        inpagelist = pagelist is not None
+        inliteral = literal is not None
+
+        if involume:
+            vcounts = Counter()
+            vbodytokens = 0
+            vheadertokens = 0
+            chunktokens = volume.chunktokens
+            typesinthischunk = volume.typesinthischunk
+            volume.linecount += int(thispage['lineCount'])
+            volume.sentencecount += int(thispage['body']['sentenceCount'])
+
+        if inpagelist:
+            pagedata = pagelist.pages[i]
+            pagetokens = pagedata['tokens']
+            typesonpage = set()
+            ficcount = 0
+            pagedata['lines'] = int(thispage['lineCount'])
+            pagedata['sentences'] = int(thispage['body']['sentenceCount'])
+
+        if inliteral:
+            lcounts = Counter()
+            lbodytokens = 0
+
+        # Each section is walked once. For each token, every view does
+        # exactly what its own class does; see VolumeFromJson.count_page,
+        # log_tokens_for_page, and LiteralVolumeFromJson.add_page.
+
+        for section in ('body', 'header', 'footer'):
+            isbody = section == 'body'
+            isheader = section == 'header'
+
+            for token, partsofspeech in thispage[section]['tokenPosCount'].items():
+
+                if involume:
+                    if isheader:
+                        vlower, vnormal = vplainlookup(token)
+                        vnormal = "#header" + vnormal
+                    else:
+                        vlower, vnormal = vlookup(token)
+                        typesinthischunk.add(vlower)
+                    if intern is not None:
+                        vnormal = intern(vnormal)
+
+                if inpagelist:
+                    titleflag = token.istitle()
+                    upperflag = token.isupper()
+                    plower, pnormal = plookup(token)
+                    typesonpage.add(plower)
+                    isfic = plower in ficwords
+
+                for part, count in partsofspeech.items():
+
+                    if involume:
+                        vcounts[vnormal] += count
+                        if isheader:
+                            vheadertokens += count
+                        else:
+                            vbodytokens += count
+                            chunktokens += count
+                            if isbody and chunktokens > 10000:
+                                typetokenratios.append(len(typesinthischunk) / chunktokens)
+                                typesinthischunk = set()
+                                chunktokens = 0
+
+                    if inpagelist:
+                        if isbody:
+                            pagedata['bodytokens'] += count
+                        else:
+                            pagedata['headertokens'] += count
+                        if upperflag:
+                            pagedata['uppercase'] += count
+                        if titleflag:
+                            pagedata['titlecase'] += count
+                        if isfic:
+                            ficcount += count
+                        pagetokens[pnormal] += count
+
+                    if inliteral and isbody:
+                        lbodytokens += count
+                        lcounts[token] += count
+
+        if involume:
+            volume.chunktokens = chunktokens
+            volume.typesinthischunk = typesinthischunk
+            volume.record_page(vcounts, vbodytokens, vheadertokens)
+
+        if inpagelist:
+            pagelist.record_page(i, len(typesonpage), ficcount)
+
+        if inliteral:
+            literal.record_page(lcounts, lbodytokens)
+
+    if timer is not None:
+        timer.lap('count')
+
+    results = dict()
+    if volume is not None:
+        volume.finish_volume()
+        results['volume'] = volume
+    if pagelist is not None:
+        pagelist.finish_pagelist()
+        results['pagelist'] = pagelist
+    if literal is not None:
+        results['literal'] = literal
+
+    if timer is not None:
+        timer.lap('finish')
+        if pagelist is not None:
+            timer.count('tokens', pagelist.count_tokens())
+        elif volume is not None:
+            timer.count('tokens', volume.totaltokens)
+        else:
+            timer.count('tokens', literal.totaltokens)
+        timer.count('pages', numpages)
+        timer.done()
+
+    return results
+
+resultcache = None
+# an efcache.ResultCache, if workers have been given one
+
+def worker_page_storage():
+    '''Workers only write volume totals, so they needn't keep pages,
+    unless they're caching volumes for later use.'''
 
-    meta = pd.read_csv('/Users/tunder/Dropbox/python/train20/bzipmeta.csv', dtype = 'object', index_col = 'docid')
-    for index, row in meta.iterrows():
-        inpath = row['filepath']
-        vol = VolumeFromJson(inpath, index)
-        outpath = '/Volumes/TARDIS/work/train20/' + utils.clean_pairtree(index) + '.csv'
-        vol.write_volume_features(outpath, override = True)
+    if resultcache is None:
+        return 'none'
+    else:
+        return 'memory'
+
+def featurize_volume(task):
+    '''
+    This function is designed explicitly for multiprocessing. It takes a
+    tuple (docid, inpath, outpath, streaming), writes volume features for
+    that docid, and returns a tuple (docid, succeeded, inputbytes).
+
+    Features are written to a temporary file that is renamed into place
+    only when complete, so an interrupted run never leaves a truncated
+    output that a later run would mistake for a finished volume.
+    '''
+
+    docid, inpath, outpath, streaming = task
+
+    try:
+        inputbytes = os.path.getsize(inpath)
+        vol = VolumeFromJson(inpath, docid, streaming = streaming, cache = resultcache, pagestorage = worker_page_storage())
+        temppath = outpath + '.tmp'
+        vol.write_volume_features(temppath, override = True)
+        os.replace(temppath, outpath)
+        return docid, True, inputbytes
+    except Exception as e:
+        print('Error processing ' + docid + ': ' + repr(e))
+        return docid, False, 0
+
+def extract_volume(task):
+    '''
+    Like featurize_volume, but instead of writing a file, returns the
+    volume's counts and scalar features to the parent process, which
+    adds them to a feature store. Returns (docid, succeeded, inputbytes,
+    record), where record is a tuple of arguments for
+    FeatureStoreWriter.add_counts().
+    '''
+
+    docid, inpath, outpath, streaming = task
+
+    try:
+        inputbytes = os.path.getsize(inpath)
+        vol = VolumeFromJson(inpath, docid, streaming = streaming, cache = resultcache, pagestorage = worker_page_storage())
+        record = (docid, dict(vol.totalcounts), vol.totaltokens, vol.sentencelength, vol.typetoken, vol.linelength)
+        return docid, True, inputbytes, record
+    except Exception as e:
+        print('Error processing ' + docid + ': ' + repr(e))
+        return docid, False, 0, None
+
+def append_volume(task):
+    '''
+    Like featurize_volume, but sends long-format rows to the writer
+    process attached by init_worker. The task begins with a sequence
+    number that fixes the volume's place in the output. Returns
+    (docid, succeeded, inputbytes, seconds spent waiting for the writer).
+    '''
+
+    sequence, docid, inpath, outpath, streaming = task
+
+    try:
+        inputbytes = os.path.getsize(inpath)
+        vol = VolumeFromJson(inpath, docid, streaming = streaming, cache = resultcache, pagestorage = worker_page_storage())
+        rows = vol.get_long_rows()
+        succeeded = True
+    except Exception as e:
+        print('Error processing ' + docid + ': ' + repr(e))
+        inputbytes = 0
+        rows = []
+        succeeded = False
+
+    # We send something even if the volume failed, because the writer
+    # needs every sequence number in order to keep going.
+    waited = featurewriter.send_rows(sequence, rows)
+
+    return docid, succeeded, inputbytes, waited
+
+def featurize_shard(task):
+    '''
+    Like featurize_volume, for every volume in a tar or zip shard of EF
+    files (see efsources). The task is (shardpath, outfolder, override,
+    streaming), and we return a list of (docid, succeeded, inputbytes),
+    one for each volume in the shard that was processed. Volumes are read
+    straight out of the shard, in order, without extracting them.
+    '''
 
+    import efsources
 
+    utils = import_utils()
+    shardpath, outfolder, override, streaming = task
 
+    results = []
+    try:
+        for docid, f, inputbytes in efsources.open_shard(shardpath):
+            outpath = os.path.join(outfolder, utils.clean_pairtree(docid) + '.csv')
+            if os.path.isfile(outpath) and not override:
+                continue
+            try:
+                vol = VolumeFromJson(f, docid, streaming = streaming, pagestorage = 'none')
+                temppath = outpath + '.tmp'
+                vol.write_volume_features(temppath, override = True)
+                os.replace(temppath, outpath)
+                results.append((docid, True, inputbytes))
+            except Exception as e:
+                print('Error processing ' + docid + ': ' + repr(e))
+                results.append((docid, False, 0))
+    except Exception as e:
+        print('Error reading shard ' + shardpath + ': ' + repr(e))
+        results.append((shardpath, False, 0))
+
+    return results
+
+def get_long_format_docids(outpath):
+    '''Returns the set of docids already present in a long-format file.'''
+
+    finished = set()
+    if os.path.isfile(outpath):
+        with open(outpath, encoding = 'utf-8') as f:
+            for row in csv.reader(f):
+                if len(row) > 0:
+                    finished.add(row[0])
+
+    return finished
+
+def get_corpus_tasks(metapath, outfolder, override = False, streaming = False, finished = None, pairtree = None):
+    '''
+    Reads a metadata table with columns 'docid' and 'filepath' and returns
+    a list of tasks for featurize_volume, plus the number of volumes
+    skipped because their output already exists. If finished is
+    provided, it's a collection of docids already processed, and
+    outfolder isn't checked; it can then be None, in which case tasks
+    have None for their outpath (as when appending to one file).
+
+    If pairtree is the root of a pairtree of EF files, the table only
+    needs a docid column; volumes are found in the pairtree (see
+    efsources), and those that aren't there are skipped with a warning.
+    '''
+
+    utils = import_utils()
+    if pairtree is not None:
+        import efsources
+    missing = 0
+
+    tasks = []
+    alreadydone = 0
+
+    with open(metapath, encoding = 'utf-8') as f:
+        reader = csv.DictReader(f)
+        for row in reader:
+            docid = row['docid']
+            if outfolder is not None:
+                outpath = os.path.join(outfolder, utils.clean_pairtree(docid) + '.csv')
+            else:
+                outpath = None
+            if finished is not None:
+                isdone = docid in finished
+            else:
+                isdone = os.path.isfile(outpath)
+            if isdone and not override:
+                alreadydone += 1
+                continue
+            if pairtree is not None:
+                inpath = efsources.find_in_pairtree(docid, pairtree)
+                if inpath is None:
+                    missing += 1
+                    continue
+            else:
+                inpath = row['filepath']
+            tasks.append((docid, inpath, outpath, streaming))
+
+    if missing > 0:
+        print(str(missing) + ' volumes not found in the pairtree at ' + pairtree + '.')
+
+    return tasks, alreadydone
+
+def init_worker(threads, writerqueue, cachefolder = None, cachebytes = None, timingfolder = None, cachecounter = None):
+    '''Pool initializer, so that spawned workers see these settings too.
+    cachecounter is the shared counter of the cache's size (see
+    efcache.ResultCache.shared_counter), so that workers evict when the
+    cache as a whole, not just their share of it, is full.'''
+
+    global resultcache
+
+    if timingfolder is not None:
+        eftiming.enable(timingfolder)
+        normalizers.clear()
+        # in case normalizers were inherited from the parent without timers
+
+    efreader.decompressionthreads = threads
+    if writerqueue is not None:
+        featurewriter.attach_writer(writerqueue)
+    if cachefolder is not None:
+        import efcache
+        resultcache = efcache.ResultCache(cachefolder, maxbytes = cachebytes, sharedbytes = cachecounter)
+
+def process_corpus(metapath, outfolder, workers = None, chunksize = 4, override = False, streaming = False, reportevery = 100, store = False, shardsize = 1000, threads = 1, append = None, cache = None, cachebytes = 4 * 1024 ** 3, timing = None, pairtree = None):
+    '''
+    Writes volume features for every volume in the metadata table at
+    metapath, using a pool of worker processes. Volumes whose output
+    already exists are skipped unless override is True, so an interrupted
+    run can simply be restarted. Progress and throughput are printed
+    every reportevery volumes. Returns a list of docids that failed.
+
+    If store is True, outfolder is a featurestore folder, and features
+    are written there in shards of shardsize volumes instead of one
+    .csv per volume.
+
+    threads is the number of threads each worker uses to decompress
+    a multi-stream bz2 file (see efreader.decompress_bz2_parallel).
+
+    If append is a path, all volumes are written to that one long-format
+    file (as by append_volume_features) by a single writer process, in
+    the order of the metadata; outfolder is ignored, and can be None.
+
+    If cache is a folder, parsed volumes are cached there (see efcache),
+    up to cachebytes, so that running again over the same files, e.g.
+    with override, doesn't parse them again.
+
+    If timing is a folder, workers record how long each phase of
+    parsing takes (see eftiming), and a summary is printed at the end.
+
+    If pairtree is a folder, volumes are looked up there by docid
+    instead of using the filepath column of the metadata.
+    '''
+
+    longwriter = None
+    writerqueue = None
+
+    if append is None:
+        os.makedirs(outfolder, exist_ok = True)
+
+    if append is not None:
+        finished = get_long_format_docids(append)
+        writer = None
+        worker = append_volume
+        override = False
+        # overriding individual volumes in a long-format file isn't possible
+    elif store:
+        import featurestore
+        finished = set()
+        if os.path.isfile(os.path.join(outfolder, 'vocabulary.json')):
+            finished = set(featurestore.FeatureStoreReader(outfolder).get_volumeids())
+        writer = featurestore.FeatureStoreWriter(outfolder, shardsize = shardsize)
+        worker = extract_volume
+    else:
+        finished = None
+        writer = None
+        worker = featurize_volume
+
+    from multiprocessing import Pool
+
+    if append is not None:
+        tasks, alreadydone = get_corpus_tasks(metapath, None, override, streaming, finished, pairtree)
+    else:
+        tasks, alreadydone = get_corpus_tasks(metapath, outfolder, override, streaming, finished, pairtree)
+    print(str(alreadydone) + ' volumes already done; ' + str(len(tasks)) + ' to process.')
+
+    if append is not None:
+        tasks = [(sequence, ) + task for sequence, task in enumerate(tasks)]
+        longwriter = featurewriter.LongFormatWriter(append)
+        writerqueue = longwriter.queue
+
+    failures = []
+    done = 0
+    totalbytes = 0
+    waited = 0.0
+    starttime = time.time()
+
+    def report():
+        elapsed = max(time.time() - starttime, 1e-9)
+        print(str(done) + ' / ' + str(len(tasks)) + ' volumes, ' +
+            str(round(done / elapsed, 2)) + ' volumes/sec, ' +
+            str(round(totalbytes / elapsed / 1000000, 2)) + ' MB/sec')
+
+    cachecounter = None
+    if cache is not None:
+        import efcache
+        cachecounter = efcache.ResultCache(cache, maxbytes = cachebytes).shared_counter()
+
+    with Pool(processes = workers, initializer = init_worker, initargs = (threads, writerqueue, cache, cachebytes, timing, cachecounter)) as pool:
+        for result in pool.imap_unordered(worker, tasks, chunksize = chunksize):
+            docid, succeeded, inputbytes = result[0: 3]
+            done += 1
+            totalbytes += inputbytes
+            if not succeeded:
+                failures.append(docid)
+            elif writer is not None:
+                writer.add_counts(*result[3])
+            elif longwriter is not None:
+                waited += result[3]
+            if done % reportevery == 0:
+                report()
+
+    if writer is not None:
+        writer.close()
+
+    if longwriter is not None:
+        stats = longwriter.close()
+        print('Writer wrote ' + str(stats['rows']) + ' rows in ' + str(stats['flushes']) + ' blocks, busy ' +
+            str(round(100 * stats['busyfraction'], 1)) + '% of the time.')
+        if waited > 0:
+            print('Workers spent ' + str(round(waited, 2)) + ' seconds waiting for the writer to catch up.')
+
+    if done % reportevery != 0 or done == 0:
+        report()
+    if len(failures) > 0:
+        print(str(len(failures)) + ' volumes failed.')
+
+    if timing is not None:
+        summary, text = eftiming.report(timing)
+        print(text)
+
+    return failures
+
+def process_shards(shardpaths, outfolder, workers = None, override = False, streaming = False, reportevery = 100, threads = 1, timing = None):
+    '''
+    Writes volume features for every volume in a list of tar or zip
+    shards (see efsources), one .csv per volume in outfolder as
+    process_corpus does. Each worker takes a whole shard at a time.
+    Returns a list of docids that failed.
+    '''
+
+    from multiprocessing import Pool
+
+    if not os.path.isdir(outfolder):
+        os.makedirs(outfolder)
+
+    tasks = [(shardpath, outfolder, override, streaming) for shardpath in shardpaths]
+    print(str(len(tasks)) + ' shards to process.')
+
+    failures = []
+    done = 0
+    shardsdone = 0
+    totalbytes = 0
+    starttime = time.time()
+
+    def report():
+        elapsed = max(time.time() - starttime, 1e-9)
+        print(str(shardsdone) + ' / ' + str(len(tasks)) + ' shards, ' + str(done) + ' volumes, ' +
+            str(round(done / elapsed, 2)) + ' volumes/sec, ' +
+            str(round(totalbytes / elapsed / 1000000, 2)) + ' MB/sec')
+
+    with Pool(processes = workers, initializer = init_worker, initargs = (threads, None, None, None, timing)) as pool:
+        for results in pool.imap_unordered(featurize_shard, tasks, chunksize = 1):
+            shardsdone += 1
+            for docid, succeeded, inputbytes in results:
+                done += 1
+                totalbytes += inputbytes
+                if not succeeded:
+                    failures.append(docid)
+                if done % reportevery == 0:
+                    report()
+
+    report()
+    if len(failures) > 0:
+        print(str(len(failures)) + ' volumes failed.')
+
+    if timing is not None:
+        summary, text = eftiming.report(timing)
+        print(text)
+
+    return failures
+
+if __name__ == "__main__":
+
+    import argparse
+
+    parser = argparse.ArgumentParser(description = 'Convert HTRC extracted feature files into volume feature .csvs.')
+    parser.add_argument('metadata', help = 'csv with columns docid and filepath, e.g. bzipmeta.csv')
+    parser.add_argument('outfolder', help = 'folder where feature files will be written')
+    parser.add_argument('--workers', type = int, default = None, help = 'number of worker processes (default: all cores)')
+    parser.add_argument('--chunksize', type = int, default = 4, help = 'volumes handed to a worker at a time')
+    parser.add_argument('--override', action = 'store_true', help = 'rewrite outputs that already exist')
+    parser.add_argument('--streaming', action = 'store_true', help = 'decode pages one at a time to save memory')
+    parser.add_argument('--reportevery', type = int, default = 100, help = 'volumes between progress reports')
+    parser.add_argument('--store', action = 'store_true', help = 'write a binary featurestore in outfolder instead of .csvs')
+    parser.add_argument('--shardsize', type = int, default = 1000, help = 'volumes per featurestore shard')
+    parser.add_argument('--threads', type = int, default = 1, help = 'decompression threads per worker')
+    parser.add_argument('--append', default = None, help = 'write all volumes to this long-format csv instead')
+    parser.add_argument('--cache', default = None, help = 'folder for a cache of parsed volumes')
+    parser.add_argument('--cachemb', type = float, default = 4096, help = 'maximum size of the cache in MB')
+    parser.add_argument('--timing', default = None, help = 'folder for per-phase timing records')
+    parser.add_argument('--pairtree', default = None, help = 'root of a pairtree of EF files, to look up docids in')
+    parser.add_argument('--shards', action = 'store_true', help = 'metadata is instead a tar or zip shard of EF files, or a folder of them')
+    args = parser.parse_args()
+
+    if args.shards:
+        if args.store or args.append is not None:
+            parser.error('--shards only writes one .csv per volume')
+        import efsources
+        process_shards(efsources.find_shards(args.metadata), args.outfolder, workers = args.workers,
+            override = args.override, streaming = args.streaming, reportevery = args.reportevery,
+            threads = args.threads, timing = args.timing)
+    else:
+        process_corpus(args.metadata, args.outfolder, workers = args.workers, chunksize = args.chunksize,
+            override = args.override, streaming = args.streaming, reportevery = args.reportevery,
+            store = args.store, shardsize = args.shardsize, threads = args.threads, append = args.append,
+            cache = args.cache, cachebytes = int(args.cachemb * 1000000), timing = args.timing, pairtree = args.pairtree)
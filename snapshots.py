@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+
+# snapshots.py
+
+# Wordlists and rule sets are stored as text so they're easy to edit,
+# but parsing them every time a process starts adds up, especially when
+# a pool spawns dozens of workers. These functions cache the parsed
+# result as a pickle, along with the size and modification time of each
+# source file. If any source has changed since the snapshot was made,
+# the snapshot is ignored and rebuilt.
+
+import os, pickle, hashlib
+
+snapshotversion = 1
+
+def file_hash(path):
+    with open(path, mode = 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+def source_signature(sourcepaths, usehash = False):
+    '''Returns a list describing each source file: its path, size,
+    modification time, and (if usehash is True) a hash of its contents.'''
+
+    signature = []
+    for path in sourcepaths:
+        stat = os.stat(path)
+        if usehash:
+            digest = file_hash(path)
+        else:
+            digest = None
+        signature.append((os.path.abspath(path), stat.st_size, stat.st_mtime_ns, digest))
+
+    return signature
+
+def signature_matches(saved, sourcepaths, usehash = False):
+    '''Checks a saved signature against the current source files. Sizes
+    and mtimes are compared first. If they differ (e.g. because the files
+    were copied to another machine) and usehash is True, we fall back to
+    comparing hashes.'''
+
+    if len(saved) != len(sourcepaths):
+        return False
+
+    for (savedpath, savedsize, savedmtime, saveddigest), path in zip(saved, sourcepaths):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return False
+
+        if stat.st_size != savedsize:
+            return False
+        if stat.st_mtime_ns == savedmtime:
+            continue
+        if not usehash or saveddigest is None or file_hash(path) != saveddigest:
+            return False
+
+    return True
+
+def read_snapshot(snapshotpath, sourcepaths, usehash = False):
+    '''Returns the data in a snapshot if it's still valid, else None.'''
+
+    try:
+        with open(snapshotpath, mode = 'rb') as f:
+            snapshot = pickle.load(f)
+    except Exception:
+        return None
+
+    if not isinstance(snapshot, dict) or snapshot.get('version') != snapshotversion:
+        return None
+    if not signature_matches(snapshot['signature'], sourcepaths, usehash):
+        return None
+
+    return snapshot['data']
+
+def write_snapshot(data, snapshotpath, sourcepaths, usehash = False):
+    '''Writes a snapshot atomically. Returns False if the location isn't
+    writable, which is not an error; we'll just rebuild next time.'''
+
+    snapshot = {'version': snapshotversion,
+        'signature': source_signature(sourcepaths, usehash),
+        'data': data}
+
+    temppath = snapshotpath + '.' + str(os.getpid()) + '.tmp'
+    try:
+        with open(temppath, mode = 'wb') as f:
+            pickle.dump(snapshot, f, protocol = pickle.HIGHEST_PROTOCOL)
+        os.replace(temppath, snapshotpath)
+        return True
+    except OSError:
+        try:
+            os.remove(temppath)
+        except OSError:
+            pass
+        return False
+
+def load_with_snapshot(snapshotpath, sourcepaths, build, usehash = False, sharedpaths = []):
+    '''
+    Returns build(), using a snapshot if a valid one exists. sharedpaths
+    lists snapshots to try first, e.g. one prebuilt in a read-only folder
+    shared by all workers; those are only read, never written. If no
+    snapshot is valid, we call build() and save the result at
+    snapshotpath (if snapshotpath isn't None).
+    '''
+
+    for path in list(sharedpaths) + [snapshotpath]:
+        if path is None:
+            continue
+        data = read_snapshot(path, sourcepaths, usehash)
+        if data is not None:
+            return data
+
+    data = build()
+    if snapshotpath is not None:
+        write_snapshot(data, snapshotpath, sourcepaths, usehash)
+
+    return data
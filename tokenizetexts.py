@@ -19,16 +19,57 @@
 # cutting them out might do a lot to speed things
 # up.
 
-import csv, os, sys, re, glob
+import csv, os, sys, re, glob, itertools, time, pickle, bisect, functools
 
 from collections import Counter
 
 from multiprocessing import Pool
 
-def get_rules(ruledirectory = '/Users/tunder/Dropbox/DataMunging/rulesets/'):
+import snapshots
+
+defaultruledirectory = '/Users/tunder/Dropbox/DataMunging/rulesets/'
+
+rulefiles = ['MainDictionary.txt', 'PersonalNames.txt', 'PlaceNames.txt', 'RomanNumerals.txt', 'CorrectionRules.txt',
+    'VariantSpellings.txt', 'Contractions.tsv', 'top_fiction_bigrams.tsv']
+
+# Parsing the rule files as text takes a while, and every run (and every
+# spawned worker) used to do it. So get_rules() keeps the parsed rules in
+# a binary snapshot (see snapshots.py) next to the rule files, and loads
+# that instead whenever the files haven't changed. Files are compared by
+# size and mtime, and if the mtimes differ (say, the folder was copied to
+# another machine) by a hash of their contents. A snapshot prebuilt in a
+# read-only folder that all workers can see (python tokenizetexts.py
+# --makesnapshot path) can be passed as sharedsnapshots; those are tried
+# first, and never written.
+
+def get_rules(ruledirectory = defaultruledirectory, snapshotpath = None, sharedsnapshots = [], malformed = None, usesnapshot = True):
     '''
     Tokenizing is going to depend on a variety of wordlists and rules.
-    This function loads them from a directory.
+    This function loads them from a directory, or from a snapshot of
+    them (by default rules.snapshot in the same directory). Rows of the
+    bigram file that aren't bigrams (e.g. its header) used to be printed;
+    if malformed is a list, they're added to it.
+    '''
+
+    if usesnapshot:
+        if snapshotpath is None:
+            snapshotpath = os.path.join(ruledirectory, 'rules.snapshot')
+        sourcepaths = [os.path.join(ruledirectory, x) for x in rulefiles]
+        rules, problems = snapshots.load_with_snapshot(snapshotpath, sourcepaths, lambda: read_rules(ruledirectory),
+            usehash = True, sharedpaths = sharedsnapshots)
+    else:
+        rules, problems = read_rules(ruledirectory)
+
+    if malformed is not None:
+        malformed.extend(problems)
+
+    return rules
+
+def read_rules(ruledirectory):
+    '''
+    Parses the rule files in ruledirectory. Returns the tuple that
+    get_rules() returns, plus a list of the rows in the bigram file that
+    couldn't be split into two words.
     '''
 
     specialfeatures = {"#arabicnumeral", "#romannumeral", "#dayoftheweek", "#monthoftheyear", "#personalname", "#placename"}
@@ -95,6 +136,7 @@ def get_rules(ruledirectory = '/Users/tunder/Dropbox/DataMunging/rulesets/'):
     bigrampath = os.path.join(ruledirectory, 'top_fiction_bigrams.tsv')
     top5kbigrams = set()
     bigramlex = set()
+    malformed = []
     ctr = 0
     with open(bigrampath, encoding = 'utf-8') as f:
         for line in f:
@@ -106,13 +148,14 @@ def get_rules(ruledirectory = '/Users/tunder/Dropbox/DataMunging/rulesets/'):
                 bigramlex.add(bparts[1])
                 bigramlex.add(bparts[2])
             else:
-                print(bparts)
+                malformed.append(bparts)
             ctr += 1
             if ctr >= 5000:
                 break
 
 
-    return lexicon, personalnames, placenames, daysoftheweek, monthsoftheyear, correctionrules, variants, romannumerals, contractionrules, top5kbigrams, bigramlex
+    rules = (lexicon, personalnames, placenames, daysoftheweek, monthsoftheyear, correctionrules, variants, romannumerals, contractionrules, top5kbigrams, bigramlex)
+    return rules, malformed
 
 def normalize_token(token, personalnames, placenames, daysoftheweek, monthsoftheyear, correctionrules, variants, romannumerals):
     ''' Normalizes a token by lowercasing it and by bundling
@@ -146,6 +189,71 @@ def normalize_token(token, personalnames, placenames, daysoftheweek, monthsofthe
     else:
         return token
 
+class RuleNormalizer:
+
+    # Does what normalize_token does, but with one dictionary lookup
+    # instead of a chain of them. normalize_token applies correctionrules,
+    # then variants, then checks for digits, then tries each category in
+    # turn. The result depends only on the lowercased token, so we work it
+    # out in advance for every lowercase form that any of those tables
+    # mentions. A form that none of them mentions comes out of the chain
+    # unchanged, unless it begins and ends with a digit; that check is the
+    # only rule left to apply at lookup time. Lookups are memoized in a
+    # bounded lru_cache, as in parsefeaturejsons.TokenNormalizer.
+
+    # The table is compiled when the normalizer is created; if you
+    # change the rules afterward, call compile() again.
+
+    def __init__(self, personalnames, placenames, daysoftheweek, monthsoftheyear, correctionrules, variants, romannumerals, cachesize = 200000):
+        self.rules = (personalnames, placenames, daysoftheweek, monthsoftheyear, correctionrules, variants, romannumerals)
+        self.cachesize = cachesize
+        self.compile()
+
+    def compile(self):
+        '''Runs every form the rules mention through normalize_token. A
+        key that isn't lowercase can never be looked up (tokens are
+        lowercased first), so it's left out.'''
+
+        personalnames, placenames, daysoftheweek, monthsoftheyear, correctionrules, variants, romannumerals = self.rules
+
+        forms = set()
+        for table in (correctionrules, variants, romannumerals, daysoftheweek, monthsoftheyear, personalnames, placenames):
+            forms.update([x for x in table if len(x) > 0 and x == x.lower()])
+
+        self.table = {x: normalize_token(x, *self.rules) for x in forms}
+        self.lookup = functools.lru_cache(maxsize = self.cachesize)(self.uncached_lookup)
+
+    def uncached_lookup(self, token):
+        lowertoken = token.lower()
+        if lowertoken in self.table:
+            return self.table[lowertoken]
+        elif len(lowertoken) > 0 and lowertoken[0].isdigit() and lowertoken[-1].isdigit():
+            return "#arabicnumeral"
+        else:
+            return lowertoken
+
+    def normalize(self, token):
+        return self.lookup(token)
+
+    def cache_info(self):
+        return self.lookup.cache_info()
+
+rulenormalizers = dict()
+
+def get_rule_normalizer(personalnames, placenames, daysoftheweek, monthsoftheyear, correctionrules, variants, romannumerals):
+    '''Returns the RuleNormalizer for these rules, creating it on first
+    use, so that every FeatureVector in a process shares one table and
+    one cache. The rules are identified by the objects themselves, so
+    load them once and reuse them (as Rules and init_worker do).'''
+
+    rules = (personalnames, placenames, daysoftheweek, monthsoftheyear, correctionrules, variants, romannumerals)
+    key = tuple([id(x) for x in rules])
+
+    if key not in rulenormalizers or any(x is not y for x, y in zip(rulenormalizers[key].rules, rules)):
+        rulenormalizers[key] = RuleNormalizer(*rules)
+
+    return rulenormalizers[key]
+
 def tokenize_line(line, previous_word, lexicon, personalnames, placenames, daysoftheweek, monthsoftheyear, correctionrules, variants, romannumerals, contractionrules):
     '''
     Breaks a line into words wherever non-word ~[a-z0-9] characters occur. This
@@ -263,33 +371,442 @@ def tokenize_line(line, previous_word, lexicon, personalnames, placenames, dayso
 
     return wordcounts, punctcounts, capitalized, allwords, allpunct, lengths, previous_word, bigrams
 
+# A FASTER SCANNER
+
+# tokenize_line() does five str.replace calls and a re.split on every
+# line, and then walks the pieces in Python. TextScanner produces the same
+# counts for a whole volume in one pass of a compiled regex over the text
+# (lines joined by newlines), with the quote folding and underscores
+# handled by the pattern itself. The rules are applied exactly as in
+# tokenize_line, including its quirks:
+
+# - Each line is stripped, so whitespace at either end of a line is
+#   ignored; but whitespace inside a line other than a plain space (a tab,
+#   say) counts as punctuation. Underscores become spaces only after the
+#   line is stripped, so they're never stripped themselves.
+# - A contraction takes back one count of the word before the quote only
+#   if some word has already been counted on the same line.
+# - twowordsback starts each line equal to the previous word.
+# - A word that ends up with a count of zero is dropped, as it is when
+#   FeatureVector adds up the Counters for each line.
+
+# Bigrams used to be counted as strings ("#bi_" + word + '_' + word), but
+# only the few thousand in top5kbigrams are ever written, so most of those
+# strings were built to be thrown away. The scanner gives each distinct
+# word an integer id, and counts a bigram as a single int that packs the
+# ids of its two words; strings are made from the ids only for bigrams
+# that are written or asked for. Given the set of top bigrams, the scanner
+# can also skip every other bigram as it goes, keeping only their total.
+
+# benchmarks/bench_tokenizer.py checks that the two agree, and measures
+# how fast each of them is.
+
+scanpattern = re.compile(r"^[^\S\n]+|([^\W_]+)|(['`‘’])([^\W_]*)|(\n)|([^\w\s]|[^\S\n ](?=[^\S\n]*\S))", re.MULTILINE)
+# In order: whitespace at the start of a line, which is skipped; a word;
+# a single quote, with the word right after it, if any (which is what
+# tokenize_line looks up in contractionrules); a line break; and any other
+# character that isn't a word character, space, underscore, or
+# whitespace at the end of a line. Everything the pattern doesn't match
+# (spaces, underscores, trailing whitespace) is skipped by finditer.
+
+quotefolds = {'“': '"', '”': '"'}
+
+class WordIndex:
+
+    # Gives each word an integer id, so that a bigram can be counted as
+    # (first id << 32) | second id. One index is shared by all the
+    # scanners in a process, so that the pairs for the top bigrams are
+    # worked out once rather than once per volume; see get_word_index.
+
+    # The pairs for a set of bigrams are remembered for as long as the
+    # same set object is passed in, so don't change it afterward.
+
+    def __init__(self):
+        self.wordids = dict()
+        self.idwords = []
+        # each word's id, and the word for each id
+        self.pairsets = dict()
+
+    def intern(self, word):
+        '''Returns word's id, giving it one if it has none yet.'''
+
+        if word not in self.wordids:
+            self.wordids[word] = len(self.idwords)
+            self.idwords.append(word)
+        return self.wordids[word]
+
+    def bigram_string(self, pair):
+        return "#bi_" + self.idwords[pair >> 32] + '_' + self.idwords[pair & 0xffffffff]
+
+    def bigram_counts(self, paircounts, pairs = None):
+        '''
+        Returns a Counter of bigram strings, for the pairs in paircounts
+        (or only those in pairs, if it isn't None). Two different pairs
+        can make the same string, if a word contains an underscore, so
+        their counts are added together; and since the pairs are listed
+        in order of first occurrence, so are the strings.
+        '''
+
+        bigrams = Counter()
+        for pair, count in paircounts.items():
+            if pairs is None or pair in pairs:
+                bigrams[self.bigram_string(pair)] += count
+
+        return bigrams
+
+    def pair_keys(self, bigrams):
+        '''
+        Returns the set of pairs whose strings are in bigrams. A string
+        like #bi_a_b_c could have come from (a, b_c) or (a_b, c), so we
+        include every split.
+        '''
+
+        key = id(bigrams)
+        if key in self.pairsets and self.pairsets[key][0] is bigrams:
+            return self.pairsets[key][1]
+
+        pairs = set()
+        for bigram in bigrams:
+            if not bigram.startswith("#bi_"):
+                continue
+            parts = bigram[4: ].split('_')
+            for i in range(1, len(parts)):
+                first = self.intern('_'.join(parts[0: i]))
+                second = self.intern('_'.join(parts[i: ]))
+                pairs.add((first << 32) | second)
+
+        self.pairsets[key] = (bigrams, pairs)
+        return pairs
+
+wordindex = None
+maxindexedwords = 2000000
+
+def get_word_index():
+    '''Returns the WordIndex for this process. Every word a worker ever
+    sees gets an id, so once the index holds maxindexedwords we start a
+    new one; scanners already made keep using the old one.'''
+
+    global wordindex
+
+    if wordindex is None or len(wordindex.idwords) > maxindexedwords:
+        wordindex = WordIndex()
+
+    return wordindex
+
+class TextScanner:
+
+    def __init__(self, lexicon, personalnames, placenames, daysoftheweek, monthsoftheyear, correctionrules, variants, romannumerals, contractionrules, topbigrams = None):
+        '''If topbigrams is a set of bigram strings (e.g. top5kbigrams),
+        only those bigrams are counted, along with the total of all.'''
+
+        self.lexicon = lexicon
+        self.contractionrules = contractionrules
+        self.rules = (personalnames, placenames, daysoftheweek, monthsoftheyear, correctionrules, variants, romannumerals)
+        self.normalizer = get_rule_normalizer(*self.rules)
+        self.normalized = dict()
+        # maps each word seen to (normalized word, whether that's in the
+        # lexicon, and if so its id and its id << 32)
+
+        self.index = get_word_index()
+        self.toppairs = None
+        if topbigrams is not None:
+            self.toppairs = self.index.pair_keys(topbigrams)
+
+    def normalize(self, token):
+        return self.normalizer.normalize(token)
+
+    def scan_lines(self, lines, previous_word = ''):
+        '''Scans a sequence of lines, as from readlines().'''
+
+        return self.scan('\n'.join(lines), previous_word)
+
+    def scan(self, text, previous_word = ''):
+        '''
+        Tokenizes text, which can contain many lines, and returns the
+        same tuple as tokenize_line(): wordcounts, punctcounts,
+        capitalized, allwords, allpunct, lengths, previous_word, bigrams.
+        The counts are for the whole text, as if tokenize_line had been
+        called on each line and the results added up.
+        '''
+
+        counts = self.count(text, previous_word)
+        return counts[0: 7] + (self.index.bigram_counts(counts[7]), )
+
+    def count(self, text, previous_word = ''):
+        '''
+        Does the work for scan(), but returns bigrams as a Counter of
+        pairs (see bigram_string), followed by the number of bigrams in
+        the text, which is larger than the sum of the Counter if the
+        scanner only counts top bigrams.
+        '''
+
+        # Rather than incrementing Counters for each token, we append
+        # tokens to lists and count each list once at the end. Each
+        # distinct word is normalized once by this scanner, and remembered
+        # along with whether the result is in the lexicon.
+
+        words = []
+        puncts = []
+        bigrams = []
+        lengths = []
+        takenback = []
+        # (word, line) for each count taken back by a contraction
+        linestarts = []
+        # where each line after the first starts in words
+        capitalized = 0
+
+        lexicon = self.lexicon
+        contractionrules = self.contractionrules
+        normalize = self.normalize
+        normalized = self.normalized
+        intern = self.index.intern
+
+        twowordsback = previous_word
+        previousinlexicon = previous_word in lexicon
+        previousshifted = intern(previous_word) << 32
+        twowordsbackshifted = previousshifted
+        # the ids of the last two words, shifted, so that a bigram is
+        # previousshifted + the id of the word after
+        skipnext = False
+        wordonline = False
+        # whether a word has been counted on this line yet; see above
+
+        for word, quote, afterquote, newline, punct in scanpattern.findall(text):
+
+            if word:
+                if skipnext:
+                    skipnext = False
+                    continue
+                w = word
+
+            elif quote:
+                w = afterquote
+
+                if skipnext:
+                    skipnext = False
+                    # the quote is skipped, but not the word after it
+
+                elif (previous_word, w.lower()) in contractionrules:
+                    contraction = contractionrules[(previous_word, w.lower())]
+                    if wordonline:
+                        takenback.append((previous_word, len(linestarts)))
+
+                    words.append(contraction)
+                    wordonline = True
+                    contractionid = intern(contraction)
+
+                    if twowordsback in lexicon:
+                        bigrams.append(twowordsbackshifted + contractionid)
+
+                    twowordsback = previous_word
+                    twowordsbackshifted = previousshifted
+                    previous_word = contraction
+                    previousshifted = contractionid << 32
+                    previousinlexicon = contraction in lexicon
+
+                    if not w:
+                        skipnext = True
+                    continue
+                    # the second half of the contraction is skipped
+
+                else:
+                    puncts.append("'")
+
+                if not w:
+                    continue
+
+            elif newline:
+                linestarts.append(len(words))
+                twowordsback = previous_word
+                twowordsbackshifted = previousshifted
+                skipnext = False
+                wordonline = False
+                continue
+
+            elif punct:
+                if skipnext:
+                    skipnext = False
+                    continue
+                puncts.append(quotefolds.get(punct, punct))
+                continue
+
+            else:
+                continue
+                # whitespace at the start of a line
+
+            # w is a word
+
+            if w[0].isupper():
+                capitalized += 1
+
+            lengths.append(len(w))
+
+            if w in normalized:
+                normalized_word, inlexicon, wordid, shifted = normalized[w]
+            else:
+                normalized_word = normalize(w)
+                inlexicon = normalized_word in lexicon
+                if inlexicon:
+                    wordid = intern(normalized_word)
+                    shifted = wordid << 32
+                else:
+                    wordid = shifted = None
+                    # only words in the lexicon are ever part of a bigram
+                normalized[w] = (normalized_word, inlexicon, wordid, shifted)
+
+            words.append(normalized_word)
+            wordonline = True
+
+            if previousinlexicon and inlexicon:
+                bigrams.append(previousshifted + wordid)
+
+            twowordsback = previous_word
+            twowordsbackshifted = previousshifted
+            previous_word = normalized_word
+            previousshifted = shifted
+            previousinlexicon = inlexicon
+
+        wordcounts = Counter(words)
+        for word, line in takenback:
+            wordcounts[word] -= 1
+        for word, line in takenback:
+            if word in wordcounts and wordcounts[word] < 1:
+                del wordcounts[word]
+
+        if len(takenback) > 0:
+            wordcounts = self.reorder_taken_back(wordcounts, words, linestarts, takenback)
+
+        numbigrams = len(bigrams)
+        if self.toppairs is not None:
+            toppairs = self.toppairs
+            bigrams = [x for x in bigrams if x in toppairs]
+
+        return wordcounts, Counter(puncts), capitalized, len(words), len(puncts), lengths, previous_word, Counter(bigrams), numbigrams
+
+    def reorder_taken_back(self, wordcounts, words, linestarts, takenback):
+        '''
+        Counter(words) lists words in the order they first occur. Adding
+        up a Counter for each line, as FeatureVector used to, lists a word
+        from the first line where its count is positive; and a word that
+        a contraction took back can have a count of zero on the line
+        where it first occurs. So we move such words to where they used
+        to be, and feature files come out exactly as before.
+        '''
+
+        takenbyline = Counter(takenback)
+
+        moved = dict()
+        for word in set([x for x, line in takenback]):
+            if word not in wordcounts:
+                continue
+
+            first = words.index(word)
+            i = first
+            while True:
+                line = bisect.bisect_right(linestarts, i)
+                if line < len(linestarts):
+                    end = linestarts[line]
+                else:
+                    end = len(words)
+                if words[i: end].count(word) > takenbyline[(word, line)]:
+                    break
+                i = words.index(word, end)
+                # there is a later line, since the word's total is positive
+
+            if i != first:
+                moved[word] = i
+
+        if len(moved) < 1:
+            return wordcounts
+
+        # Everything else stays in order of first occurrence, and a moved
+        # word goes after the words that first occur before it now does.
+
+        rest = [x for x in wordcounts if x not in moved]
+        insertions = []
+        for word, i in moved.items():
+            before = len([x for x in dict.fromkeys(words[0: i]) if x not in moved and x in wordcounts])
+            insertions.append((before, i, word))
+        insertions.sort()
+
+        order = []
+        nextinsertion = 0
+        for position, word in enumerate(rest + [None]):
+            while nextinsertion < len(insertions) and insertions[nextinsertion][0] == position:
+                order.append(insertions[nextinsertion][2])
+                nextinsertion += 1
+            if word is not None:
+                order.append(word)
+
+        return Counter({x: wordcounts[x] for x in order})
+
 class FeatureVector:
 
-    def __init__(self, linelist, lexicon, personalnames, placenames, daysoftheweek, monthsoftheyear, correctionrules, variants, romannumerals, contractionrules):
-        ''' To create a feature vector, you pass in a list of lines to be tokenized,
+    def __init__(self, linelist, lexicon, personalnames, placenames, daysoftheweek, monthsoftheyear, correctionrules, variants, romannumerals, contractionrules, topbigrams = None):
+        ''' To create a feature vector, you pass in the lines to be tokenized,
         plus a whole bunch of rules and wordlists that we use to categorize tokens.
+
+        linelist can be a list of lines, an open file, or any other iterable
+        of lines; or None, in which case lines are passed to update() later.
+
+        If you're only going to write features, pass top5kbigrams as
+        topbigrams, and other bigrams won't be kept (only counted); but
+        then get_top_bigrams() only knows about those.
         '''
 
+        # The lines are tokenized by a TextScanner, which gives the same
+        # counts as calling tokenize_line on each line. We used to add
+        # up a Counter for each line with +, which makes a new Counter
+        # every time, so a long volume cost lines x vocabulary; now the
+        # lines are scanned in batches, and each batch's counts are added
+        # to ours in place.
+
+        self.scanner = TextScanner(lexicon, personalnames, placenames, daysoftheweek, monthsoftheyear, correctionrules, variants, romannumerals, contractionrules, topbigrams)
+
         self.wordcounts = Counter()
         self.punctcounts = Counter()
         self.capitalized = 0
         self.totalnumwords = 0
         self.totalnumpunct = 0
         self.allwordlengths = []
-        self.allbigrams = Counter()
+        self.bigrampairs = Counter()
+        self.totalbigrams = 0
+        # bigrams are counted as pairs of ids (see TextScanner); the
+        # strings are in allbigrams
+        self.previous_word = ''
+
+        if linelist is not None:
+            self.update(linelist)
+
+    batchlines = 5000
+    # lines scanned at a time by update()
+
+    def update(self, lines):
+        '''Tokenizes more lines, which follow any lines already counted,
+        and adds their counts to this vector's.'''
+
+        lines = iter(lines)
+        while True:
+            batch = list(itertools.islice(lines, self.batchlines))
+            if len(batch) < 1:
+                break
+
+            words, puncts, capitalized, numwords, numpunct, lengths, self.previous_word, pairs, numbigrams = self.scanner.count('\n'.join(batch), self.previous_word)
 
-        previous_word = ''
+            self.wordcounts.update(words)
+            self.punctcounts.update(puncts)
+            self.capitalized += capitalized
+            self.totalnumwords += numwords
+            self.totalnumpunct += numpunct
+            self.allwordlengths.extend(lengths)
+            self.bigrampairs.update(pairs)
+            self.totalbigrams += numbigrams
 
-        for l in linelist:
-            linewords, linepunct, linecaps, linenumwords, linenumpunct, linelens, previous_word, linebigrams = tokenize_line(l, previous_word, lexicon, personalnames, placenames, daysoftheweek, monthsoftheyear, correctionrules, variants, romannumerals, contractionrules)
+    @property
+    def allbigrams(self):
+        '''A Counter of bigram strings, made from the pairs.'''
 
-            self.wordcounts = self.wordcounts + linewords
-            self.punctcounts = self.punctcounts + linepunct
-            self.capitalized = self.capitalized + linecaps
-            self.totalnumwords = self.totalnumwords + linenumwords
-            self.totalnumpunct = self.totalnumpunct + linenumpunct
-            self.allwordlengths.extend(linelens)
-            self.allbigrams = self.allbigrams + linebigrams
+        return self.scanner.index.bigram_counts(self.bigrampairs)
 
     def write_normalized_features(self, outpath, top5kbigrams, bigramlex):
         '''
@@ -363,16 +880,18 @@ class FeatureVector:
         line = "#fogindex" + '\t' + str(fogindex)
         outlines.append(line)
 
-        totalbigrams = sum(self.allbigrams.values())
+        totalbigrams = self.totalbigrams
         bigramsintop5k = 0
 
-        for bigram, count in self.allbigrams.items():
+        toppairs = self.scanner.index.pair_keys(top5kbigrams)
+        # only the top bigrams are turned into strings
 
-            if bigram in top5kbigrams:
-                frequency = count / totalbigrams
-                line = bigram + '\t' + str(frequency)
-                outlines.append(line)
-                bigramsintop5k += count
+        for bigram, count in self.scanner.index.bigram_counts(self.bigrampairs, toppairs).items():
+
+            frequency = count / totalbigrams
+            line = bigram + '\t' + str(frequency)
+            outlines.append(line)
+            bigramsintop5k += count
 
         bigramcommonnness = bigramsintop5k / totalbigrams
         line = "#bigramcommon" + '\t' + str(bigramcommonnness)
@@ -405,122 +924,216 @@ class FeatureVector:
         bigramstoreturn = self.allbigrams.most_common(n)
         return bigramstoreturn
 
-def get_vol_bigrams(tentuple):
-    '''
-    This function is designed explicitly for multiprocessing. It takes a tuple with a linelist
-    for a particular volume, plus a bunch of rules and wordlists, and uses all that data to create
-    a FeatureVector.
-    '''
-    lines, lexicon, personalnames, placenames, daysoftheweek, monthsoftheyear, correctionrules, variants, romannumerals, contractionrules = tentuple
-    vector = FeatureVector(lines, lexicon, personalnames, placenames, daysoftheweek, monthsoftheyear, correctionrules, variants, romannumerals, contractionrules)
-    these_bigrams = vector.get_top_bigrams(10000)
-    return these_bigrams
+# RUNNING IN PARALLEL
 
-def print_features(thirteentuple):
-    '''
-    This function is designed explicitly for multiprocessing. It takes a tuple with a linelist
-    for a particular volume, plus a destination path, and a bunch of rules and wordlists, and uses
-    all that data to create a FeatureVector. Then it tells the FeatureVector to print a
-    feature file to the designated destinationpath. Because absolutely everything you need is
-    packaged in the tuple, you can map tuples across a pool of worker processes.
-    '''
-    lines, lexicon, personalnames, placenames, daysoftheweek, monthsoftheyear, correctionrules, variants, romannumerals, contractionrules, top5kbigrams, bigramlex, destinationpath = thirteentuple
-    vector = FeatureVector(lines, lexicon, personalnames, placenames, daysoftheweek, monthsoftheyear, correctionrules, variants, romannumerals, contractionrules)
-    vector.write_normalized_features(destinationpath, top5kbigrams, bigramlex)
+# The drivers below used to pack the lines of each volume, together with
+# every wordlist and rule table, into a tuple for each task, so Pool
+# pickled the whole rule set (hundreds of thousands of words) once per
+# volume and unpickled it in a worker. Now the rules live in a Rules
+# object that is installed once in each worker, by a pool initializer
+# (or simply inherited, if the pool forks after the parent has loaded
+# them), and a task is only a path and a destination. Workers read the
+# texts themselves.
 
-    # the return value has no real meaning here; the point i
+class Rules:
 
-    return True
+    # The wordlists and rules returned by get_rules(), as attributes.
 
-if __name__ == "__main__":
+    names = ['lexicon', 'personalnames', 'placenames', 'daysoftheweek', 'monthsoftheyear', 'correctionrules',
+        'variants', 'romannumerals', 'contractionrules', 'top5kbigrams', 'bigramlex']
 
-    arguments = sys.argv
+    def __init__(self, lexicon, personalnames, placenames, daysoftheweek, monthsoftheyear, correctionrules, variants, romannumerals, contractionrules, top5kbigrams, bigramlex):
+        self.lexicon = lexicon
+        self.personalnames = personalnames
+        self.placenames = placenames
+        self.daysoftheweek = daysoftheweek
+        self.monthsoftheyear = monthsoftheyear
+        self.correctionrules = correctionrules
+        self.variants = variants
+        self.romannumerals = romannumerals
+        self.contractionrules = contractionrules
+        self.top5kbigrams = top5kbigrams
+        self.bigramlex = bigramlex
 
-    lexicon, personalnames, placenames, daysoftheweek, monthsoftheyear, correctionrules, variants, romannumerals, contractionrules, top5kbigrams, bigramlex = get_rules()
+    def tokenizing_rules(self):
+        '''The arguments FeatureVector and TextScanner take after the lines.'''
 
-    if arguments[1] == "--folder":
-        sourcefolder = arguments[2]
-        destinationfolder = arguments[3]
-        if not os.path.isdir(sourcefolder) or not os.path.isdir(destinationfolder):
-            print('What kind of fool do you take me for? Those are not')
-            print('both valid directories.')
-            sys.exit(0)
+        return (self.lexicon, self.personalnames, self.placenames, self.daysoftheweek, self.monthsoftheyear,
+            self.correctionrules, self.variants, self.romannumerals, self.contractionrules)
 
-        if not sourcefolder.endswith('/'):
-            sourcefolder += '/'
-        if not destinationfolder.endswith('/'):
-            destinationfolder += '/'
-        paths = glob.glob(sourcefolder + '*.txt')
+    def feature_vector(self, lines, topbigrams = None):
+        return FeatureVector(lines, *self.tokenizing_rules(), topbigrams = topbigrams)
 
-        ctr = 0
-        for floor in range(970, 1100, 200):
-            print(ctr)
-            ctr += 1
-            linelists = []
-            ceiling = floor + 200
-            if ceiling > len(paths):
-                ceiling = len(paths)
-            print(ceiling)
-            for p in paths[floor: ceiling]:
-                docid = p.replace(sourcefolder, '')
-                docid = docid.replace('.txt', '')
-                destinationpath = destinationfolder + docid + '.tsv'
-                if os.path.isfile(destinationpath):
-                    print(destinationpath + ' already exists.')
-                    continue
-                with open(p, encoding = 'utf-8') as f:
-                    lines = f.readlines()
-                    linelists.append((lines, lexicon, personalnames, placenames, daysoftheweek, monthsoftheyear, correctionrules, variants, romannumerals, contractionrules,top5kbigrams, bigramlex, destinationpath))
+def load_rules(ruledirectory = None, sharedsnapshots = []):
+    '''Returns a Rules object for the files in ruledirectory (by default,
+    get_rules' default folder), with the malformed rows of the bigram
+    file as its malformed attribute.'''
 
-            pool = Pool(processes = 12)
-            res = pool.map_async(print_features, linelists)
-            res.wait()
+    if ruledirectory is None:
+        ruledirectory = defaultruledirectory
 
-            resultlist = res.get()
+    malformed = []
+    rules = Rules(*get_rules(ruledirectory, sharedsnapshots = sharedsnapshots, malformed = malformed))
+    rules.malformed = malformed
+    return rules
 
-            pool.close()
+workerrules = None
+# the Rules used by print_features and get_vol_bigrams in this process
 
+def init_worker(ruledirectory = None, sharedsnapshots = []):
+    '''Pool initializer. A forked worker already has the parent's rules;
+    a spawned one loads them, ordinarily from a snapshot.'''
 
+    global workerrules
 
-    elif arguments[1] == "--bigrams":
-        paths = glob.glob('/Users/tunder/Dropbox/fiction/newtexts/*.txt')
+    if workerrules is None:
+        workerrules = load_rules(ruledirectory, sharedsnapshots)
 
-        top_bigrams = Counter()
+def get_vol_bigrams(path):
+    '''
+    This function is designed explicitly for multiprocessing. It takes the path
+    to a text, and uses the rules installed by init_worker to create a FeatureVector.
+    Returns (path, the 10000 most common bigrams, seconds spent).
+    '''
 
-        ctr = 0
-        for floor in range(0, 1000, 100):
-            linelists = []
-            for p in paths[floor: (floor + 50)]:
-                with open(p, encoding = 'utf-8') as f:
-                    lines = f.readlines()
-                    linelists.append((lines, lexicon, personalnames, placenames, daysoftheweek, monthsoftheyear, correctionrules, variants, romannumerals, contractionrules))
+    start = time.perf_counter()
+    with open(path, encoding = 'utf-8') as f:
+        vector = workerrules.feature_vector(f)
+    these_bigrams = vector.get_top_bigrams(10000)
+    return path, these_bigrams, time.perf_counter() - start
 
-            pool = Pool(processes = 12)
-            res = pool.map_async(get_vol_bigrams, linelists)
-            res.wait()
+def print_features(task):
+    '''
+    This function is designed explicitly for multiprocessing. It takes a tuple
+    (path to a text, destination path), uses the rules installed by init_worker
+    to create a FeatureVector, and tells the FeatureVector to print a feature
+    file to the destination. Returns (path, whether a file was written,
+    seconds spent).
+    '''
 
-            resultlist = res.get()
+    path, destinationpath = task
 
-            ctr +=1
-            print(ctr)
+    start = time.perf_counter()
+    with open(path, encoding = 'utf-8') as f:
+        vector = workerrules.feature_vector(f, workerrules.top5kbigrams)
+    written = vector.write_normalized_features(destinationpath, workerrules.top5kbigrams, workerrules.bigramlex)
 
-            for bigram_tuple_list in resultlist:
+    return path, written, time.perf_counter() - start
 
-                for bigram, count in bigram_tuple_list:
-                    top_bigrams[bigram] += count
+def map_with_rules(function, tasks, ruledirectory = None, processes = 12, chunksize = 1, sharedsnapshots = []):
+    '''
+    Maps function over tasks in a pool of workers that each have the rules
+    installed once. Each result must end with the seconds the task took.
+    Returns the results, in order of completion, and a dictionary that
+    describes what it cost to send tasks and results between processes.
+    '''
 
-            pool.close()
+    global workerrules
 
-        with open('top_fiction_bigrams.tsv', mode = 'w', encoding = 'utf-8') as f:
-            f.write('bigram' + '\t' + 'count' + '\n')
-            for bigram, count in top_bigrams.most_common(10000):
-                f.write(bigram + '\t' + str(count) + '\n')
+    if workerrules is None:
+        workerrules = load_rules(ruledirectory, sharedsnapshots)
 
+    taskbytes = sum([len(pickle.dumps(x)) for x in tasks])
 
+    results = []
+    start = time.time()
+    with Pool(processes = processes, initializer = init_worker, initargs = (ruledirectory, sharedsnapshots)) as pool:
+        for result in pool.imap_unordered(function, tasks, chunksize = chunksize):
+            results.append(result)
+    elapsed = time.time() - start
 
+    resultbytes = sum([len(pickle.dumps(x)) for x in results])
+    busy = sum([x[-1] for x in results])
+    numtasks = max(len(tasks), 1)
 
+    stats = {'tasks': len(tasks), 'processes': processes, 'seconds': elapsed, 'busyseconds': busy,
+        'taskbytes': taskbytes / numtasks, 'resultbytes': resultbytes / numtasks,
+        'rulesbytes': len(pickle.dumps(workerrules)),
+        'overheadseconds': max(0.0, elapsed * min(processes, numtasks) - busy) / numtasks}
 
+    return results, stats
 
+def format_task_stats(stats):
+    return '\n'.join([str(stats['tasks']) + ' tasks in ' + str(round(stats['seconds'], 2)) + ' seconds with ' +
+            str(stats['processes']) + ' workers, which were busy for ' + str(round(stats['busyseconds'], 2)) + ' seconds.',
+        'Bytes pickled per task: ' + str(round(stats['taskbytes'], 1)) + ' sent, ' + str(round(stats['resultbytes'], 1)) +
+            ' returned (the rules, which tasks used to carry, are ' + str(stats['rulesbytes']) + ' bytes).',
+        'Overhead per task (wall time x workers, less time in tasks): ' + str(round(1000 * stats['overheadseconds'], 2)) + ' ms.'])
 
+if __name__ == "__main__":
 
+    import argparse
+
+    parser = argparse.ArgumentParser(description = 'Tokenize texts into normalized feature files, or count their bigrams.')
+    parser.add_argument('--folder', nargs = 2, metavar = ('SOURCEFOLDER', 'DESTINATIONFOLDER'),
+        help = 'write a .tsv of features for each .txt file in sourcefolder')
+    parser.add_argument('--bigrams', nargs = '?', const = '/Users/tunder/Dropbox/fiction/newtexts/', metavar = 'SOURCEFOLDER',
+        help = 'write the most common bigrams in a sample of texts to top_fiction_bigrams.tsv')
+    parser.add_argument('--rules', default = None, help = 'folder of wordlists and rules (default: see get_rules)')
+    parser.add_argument('--workers', type = int, default = 12)
+    parser.add_argument('--chunksize', type = int, default = 1, help = 'tasks handed to a worker at a time')
+    parser.add_argument('--sharedsnapshot', action = 'append', default = [], metavar = 'PATH',
+        help = 'a prebuilt, read-only snapshot of the rules to try first')
+    parser.add_argument('--makesnapshot', default = None, metavar = 'PATH',
+        help = 'write a snapshot of the rules to PATH (e.g. for --sharedsnapshot) and stop')
+    args = parser.parse_args()
+
+    ruledirectory = args.rules
+    if ruledirectory is None:
+        ruledirectory = defaultruledirectory
+
+    if args.makesnapshot is not None:
+        start = time.perf_counter()
+        get_rules(ruledirectory, snapshotpath = args.makesnapshot)
+        print('Snapshot of the rules in ' + ruledirectory + ' at ' + args.makesnapshot + ', in ' +
+            str(round(time.perf_counter() - start, 3)) + ' seconds.')
+        sys.exit(0)
+
+    if args.folder is not None or args.bigrams is not None:
+        workerrules = load_rules(ruledirectory, args.sharedsnapshot)
+        if len(workerrules.malformed) > 0:
+            print('Skipped ' + str(len(workerrules.malformed)) + ' rows of top_fiction_bigrams.tsv that are not bigrams, e.g. ' +
+                str(workerrules.malformed[0]))
+
+    if args.folder is not None:
+        sourcefolder, destinationfolder = args.folder
+        if not os.path.isdir(sourcefolder) or not os.path.isdir(destinationfolder):
+            print('What kind of fool do you take me for? Those are not')
+            print('both valid directories.')
+            sys.exit(0)
 
+        tasks = []
+        for p in sorted(glob.glob(os.path.join(sourcefolder, '*.txt'))):
+            docid = os.path.basename(p).replace('.txt', '')
+            destinationpath = os.path.join(destinationfolder, docid + '.tsv')
+            if os.path.isfile(destinationpath):
+                print(destinationpath + ' already exists.')
+                continue
+            tasks.append((p, destinationpath))
+
+        results, stats = map_with_rules(print_features, tasks, ruledirectory, args.workers, args.chunksize, args.sharedsnapshot)
+        print(str(sum([1 for x in results if x[1]])) + ' feature files written.')
+        print(format_task_stats(stats))
+
+    elif args.bigrams is not None:
+        paths = glob.glob(os.path.join(args.bigrams, '*.txt'))
+        sample = []
+        for floor in range(0, 1000, 100):
+            sample.extend(paths[floor: (floor + 50)])
+
+        results, stats = map_with_rules(get_vol_bigrams, sample, ruledirectory, args.workers, args.chunksize, args.sharedsnapshot)
+
+        top_bigrams = Counter()
+        for path, bigram_tuple_list, seconds in results:
+            for bigram, count in bigram_tuple_list:
+                top_bigrams[bigram] += count
+
+        with open('top_fiction_bigrams.tsv', mode = 'w', encoding = 'utf-8') as f:
+            f.write('bigram' + '\t' + 'count' + '\n')
+            for bigram, count in top_bigrams.most_common(10000):
+                f.write(bigram + '\t' + str(count) + '\n')
+
+        print(format_task_stats(stats))
+
+    else:
+        parser.print_help()